@@ -0,0 +1,463 @@
+"""Нагрузочный бенчмарк обработчиков бота.
+
+Прогоняет настоящие обработчики (new_project, add_task, tasks,
+button_handler, web_app_data, process_message) через Application с
+синтетическими Update. Запросы к Bot API перехватывает StubRequest, а
+OpenAI заменяет локальный mock-сервер с настраиваемой задержкой и
+долей ошибок (нужен aiohttp).
+
+Каждое число пользователей прогоняется в отдельном процессе, чтобы пиковый
+RSS не накапливался между прогонами:
+
+    python benchmark.py --users 1000,10000,100000 --latency 0.2 --error-rate 0.05
+
+С --startup N бенчмарк N раз запускает бота в новом процессе и измеряет
+время импорта модулей, готовности (post_init) и обработки первого
+обновления, а также показывает самые медленные при импорте зависимости:
+
+    python benchmark.py --startup 10
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+MOCK_REPLY = (
+    "Предлагаю разбить проект на этапы, назначить сроки и начать с задач, "
+    "которые блокируют остальные. Хотите, я помогу составить список?"
+)
+
+# Пользователи бенчмарка не пересекаются с реальными идентификаторами
+BASE_USER_ID = 10 ** 9
+
+
+def run_mock_openai(port, latency, jitter, error_rate, chunk_delay):
+    """Mock-сервер Chat Completions (запускается в отдельном процессе)"""
+    from aiohttp import web
+
+    async def handle(request):
+        payload = await request.json()
+        await asyncio.sleep(latency + random.uniform(0, jitter))
+
+        if random.random() < error_rate:
+            status = random.choice((429, 500, 503))
+            return web.json_response({"error": {"message": "injected error"}}, status=status)
+
+        if not payload.get("stream"):
+            return web.json_response({
+                "choices": [{"message": {"role": "assistant", "content": MOCK_REPLY}}],
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for word in MOCK_REPLY.split(" "):
+            chunk = {"choices": [{"delta": {"content": word + " "}}]}
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+            if chunk_delay:
+                await asyncio.sleep(chunk_delay)
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", handle)
+    web.run_app(app, host="127.0.0.1", port=port, print=None, access_log=None)
+
+
+def make_stub_request():
+    """Транспорт Bot API, отвечающий на все методы без обращения к Telegram"""
+    from telegram.request import BaseRequest
+
+    class StubRequest(BaseRequest):
+        def __init__(self):
+            self.calls = {}
+            self._message_ids = itertools.count(1)
+
+        @property
+        def read_timeout(self):
+            return None
+
+        async def initialize(self):
+            pass
+
+        async def shutdown(self):
+            pass
+
+        async def do_request(self, url, method, request_data=None, read_timeout=None,
+                             write_timeout=None, connect_timeout=None, pool_timeout=None):
+            endpoint = url.rsplit("/", 1)[-1]
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+            params = request_data.parameters if request_data else {}
+
+            if endpoint == "getMe":
+                result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+            elif endpoint in ("sendMessage", "editMessageText"):
+                chat_id = params.get("chat_id", BASE_USER_ID)
+                result = {
+                    "message_id": params.get("message_id") or next(self._message_ids),
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private"},
+                    "text": params.get("text", ""),
+                }
+            else:
+                result = True
+
+            return 200, json.dumps({"ok": True, "result": result}).encode()
+
+    return StubRequest()
+
+
+def message_dict(user_id, message_id, **fields):
+    return {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+        **fields,
+    }
+
+
+def command_update(bot, user_id, text):
+    from telegram import Update
+
+    command = text.split(" ", 1)[0]
+    return Update.de_json({
+        "update_id": user_id,
+        "message": message_dict(
+            user_id, 1, text=text,
+            entities=[{"type": "bot_command", "offset": 0, "length": len(command)}],
+        ),
+    }, bot)
+
+
+def text_update(bot, user_id, text):
+    from telegram import Update
+
+    return Update.de_json({"update_id": user_id, "message": message_dict(user_id, 1, text=text)}, bot)
+
+
+def callback_update(bot, user_id, data):
+    from telegram import Update
+
+    return Update.de_json({
+        "update_id": user_id,
+        "callback_query": {
+            "id": str(user_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": "User"},
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": message_dict(user_id, 1, text="Задача"),
+        },
+    }, bot)
+
+
+def web_app_update(bot, user_id, data):
+    from telegram import Update
+
+    return Update.de_json({
+        "update_id": user_id,
+        "message": message_dict(
+            user_id, 1, web_app_data={"data": json.dumps(data), "button_text": "Канбан"},
+        ),
+    }, bot)
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def peak_rss_mb():
+    """Пиковый RSS процесса в мегабайтах"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдает килобайты, macOS — байты
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+async def run_scenario(application, updates, concurrency):
+    """Прогнать обновления через обработчики при concurrency одновременных клиентах"""
+    latencies = []
+    updates = iter(updates)
+
+    async def client():
+        for update in updates:
+            started = time.perf_counter()
+            await application.update_processor.process_update(update, application.process_update(update))
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "count": len(latencies),
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "throughput": len(latencies) / elapsed if elapsed else 0.0,
+    }
+
+
+async def run_child(args):
+    import bot
+
+    application = bot.build_application(request=make_stub_request())
+    await application.initialize()
+    bot.openai_client.start()
+    tg = application.bot
+
+    users = range(BASE_USER_ID, BASE_USER_ID + args.users)
+    ai_users = users[:args.ai_sample]
+    batch = {
+        "version": bot.WEBAPP_BATCH_VERSION,
+        "actions": [
+            {"action": "createTask", "projectId": 1, "id": -1, "name": "Новая задача", "status": "Создана"},
+            {"action": "statusUpdate", "projectId": 1, "id": 1, "status": "Завершена"},
+        ],
+    }
+
+    scenarios = [
+        ("new_project", users, lambda uid: command_update(tg, uid, "/new_project Бенчмарк")),
+        ("add_task", users, lambda uid: command_update(tg, uid, "/add_task 1 Подготовить отчет")),
+        ("tasks", users, lambda uid: command_update(tg, uid, "/tasks 1")),
+        ("button_handler", users, lambda uid: callback_update(tg, uid, "task_1_1_В работе")),
+        ("web_app_data", users, lambda uid: web_app_update(tg, uid, batch)),
+        ("process_message", ai_users, lambda uid: text_update(tg, uid, f"Как спланировать проект {uid}?")),
+    ]
+
+    results = {"users": args.users, "scenarios": {}}
+    for name, scenario_users, make_update in scenarios:
+        updates = (make_update(uid) for uid in scenario_users)
+        results["scenarios"][name] = await run_scenario(application, updates, args.concurrency)
+
+    results["peak_rss_mb"] = peak_rss_mb()
+    results["openai"] = bot.openai_scheduler.stats()
+
+    await bot.openai_client.close()
+    await application.shutdown()
+    bot.storage.close()
+    return results
+
+
+async def run_startup_child():
+    started = time.perf_counter()
+    import bot
+    imported = time.perf_counter()
+
+    application = bot.build_application(request=make_stub_request())
+    await application.initialize()
+    await bot.post_init(application)
+    await application.start()
+    ready = time.perf_counter()
+
+    update = command_update(application.bot, BASE_USER_ID, "/start")
+    await application.update_processor.process_update(update, application.process_update(update))
+    first_update = time.perf_counter()
+
+    await application.stop()
+    await application.shutdown()
+    await bot.post_shutdown(application)
+    return {
+        "import_s": imported - started,
+        "ready_s": ready - started,
+        "first_update_s": first_update - started,
+    }
+
+
+def import_costs(stderr, limit=8):
+    """Прямые зависимости bot по суммарному времени импорта (вывод -X importtime)"""
+    children = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line.split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        # Вложенные модули печатаются перед модулем, который их импортирует
+        if depth == 1:
+            children.append((int(cumulative_us) / 1e6, name.strip()))
+        elif depth == 0:
+            if name.strip() == "bot":
+                return sorted(children, reverse=True)[:limit]
+            children = []
+    return []
+
+
+def run_startup(env, runs):
+    """Запустить бота runs раз в новых процессах: медианы этапов запуска"""
+    command = [sys.executable, os.path.abspath(__file__), "--startup-child"]
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        output = subprocess.run(command, env=env, capture_output=True, text=True, check=True).stdout
+        sample = json.loads(output.strip().splitlines()[-1])
+        sample["process_s"] = time.perf_counter() - started
+        samples.append(sample)
+
+    profile = subprocess.run([sys.executable, "-X", "importtime", *command[1:]],
+                             env=env, capture_output=True, text=True, check=True)
+    results = {
+        stage: statistics.median(sample[stage] for sample in samples)
+        for stage in ("import_s", "ready_s", "first_update_s", "process_s")
+    }
+    results["runs"] = runs
+    results["imports"] = import_costs(profile.stderr)
+    return results
+
+
+def print_startup_report(results):
+    print(f"\nЗапуск бота, медиана по {results['runs']} запускам:")
+    print(f"  импорт модулей:     {results['import_s']:.3f} с")
+    print(f"  готов к работе:     {results['ready_s']:.3f} с")
+    print(f"  первое обновление:  {results['first_update_s']:.3f} с")
+    print(f"  процесс целиком:    {results['process_s']:.3f} с")
+    print("Самые долгие при импорте зависимости:")
+    for seconds, name in results["imports"]:
+        print(f"  {name:<24}{seconds:.3f} с")
+
+
+def child_main(args):
+    import logging
+    logging.disable(logging.WARNING)
+    print(json.dumps(asyncio.run(run_child(args)), ensure_ascii=False))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def print_report(results):
+    print(f"\nПользователей: {results['users']}, пиковый RSS: {results['peak_rss_mb']:.1f} МБ")
+    print(f"{'сценарий':<16}{'запросов':>10}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}{'в сек.':>10}")
+    for name, stats in results["scenarios"].items():
+        print(f"{name:<16}{stats['count']:>10}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}"
+              f"{stats['p99_ms']:>10.2f}{stats['throughput']:>10.0f}")
+    openai_stats = results["openai"]
+    print(f"OpenAI: повторов {openai_stats['retries']}, дублей {openai_stats['hedges']}, "
+          f"ошибок {openai_stats['failures']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный бенчмарк обработчиков бота")
+    parser.add_argument("--users", default="1000,10000,100000",
+                        help="числа пользователей через запятую")
+    parser.add_argument("--concurrency", type=int, default=64,
+                        help="одновременных клиентов")
+    parser.add_argument("--ai-sample", type=int, default=1000,
+                        help="сколько пользователей отправляют сообщение ИИ")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="задержка mock-сервера OpenAI, с")
+    parser.add_argument("--jitter", type=float, default=0.02,
+                        help="случайная добавка к задержке, с")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="доля ответов mock-сервера с ошибкой 429/5xx")
+    parser.add_argument("--chunk-delay", type=float, default=0.0,
+                        help="пауза между фрагментами потокового ответа, с")
+    parser.add_argument("--storage", default="memory", choices=("memory", "sqlite", "journal"))
+    parser.add_argument("--startup", type=int, metavar="N",
+                        help="вместо нагрузки измерить запуск бота (N запусков)")
+    parser.add_argument("--json", help="сохранить результаты в файл")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--startup-child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        args.users = int(args.users)
+        child_main(args)
+        return
+    if args.startup_child:
+        import logging
+        logging.disable(logging.WARNING)
+        print(json.dumps(asyncio.run(run_startup_child())))
+        return
+
+    if args.startup:
+        env = {
+            **os.environ,
+            "BOT_TOKEN": os.environ.get("BOT_TOKEN", "123456:benchmark"),
+            "STORAGE_BACKEND": args.storage,
+            "STORAGE_PATH": os.environ.get("STORAGE_PATH", f"benchmark-{os.getpid()}.db"),
+            "WEBAPP_API_PORT": "0",
+            "METRICS_PORT": "0",
+        }
+        results = run_startup(env, args.startup)
+        print_startup_report(results)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+        return
+
+    port = free_port()
+    mock = multiprocessing.Process(
+        target=run_mock_openai,
+        args=(port, args.latency, args.jitter, args.error_rate, args.chunk_delay),
+        daemon=True,
+    )
+    mock.start()
+
+    env = {
+        **os.environ,
+        "BOT_TOKEN": os.environ.get("BOT_TOKEN", "123456:benchmark"),
+        "OPENAI_API_URL": f"http://127.0.0.1:{port}/v1/chat/completions",
+        "OPENAI_BACKOFF_MAX": os.environ.get("OPENAI_BACKOFF_MAX", "1"),
+        "STORAGE_BACKEND": args.storage,
+        "STORAGE_PATH": os.environ.get("STORAGE_PATH", f"benchmark-{os.getpid()}.db"),
+        "WEBAPP_API_PORT": "0",
+        "METRICS_PORT": "0",
+        # Лимиты Telegram в бенчмарке не нужны: измеряется сам бот
+        "SEND_GLOBAL_RATE": "1e9",
+        "SEND_CHAT_RATE": "1e9",
+        "SEND_CHAT_BURST": "1000000000",
+    }
+
+    all_results = []
+    try:
+        # Ждем, пока mock-сервер начнет принимать соединения
+        for _ in range(100):
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        for users in args.users.split(","):
+            command = [
+                sys.executable, os.path.abspath(__file__), "--child",
+                "--users", users.strip(),
+                "--concurrency", str(args.concurrency),
+                "--ai-sample", str(args.ai_sample),
+            ]
+            output = subprocess.run(command, env=env, capture_output=True, text=True, check=True).stdout
+            results = json.loads(output.strip().splitlines()[-1])
+            all_results.append(results)
+            print_report(results)
+
+            if args.storage == "journal":
+                shutil.rmtree(env["STORAGE_PATH"], ignore_errors=True)
+            elif args.storage == "sqlite":
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(env["STORAGE_PATH"] + suffix):
+                        os.remove(env["STORAGE_PATH"] + suffix)
+    finally:
+        mock.terminate()
+        mock.join()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(all_results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,51 @@
+import startup  # первым: от импорта этого модуля отсчитывается время запуска
+import io
 import logging
 import os
 import json
-from datetime import datetime
+import asyncio
+import sys
+import tempfile
+import time
+from collections import deque
+from datetime import datetime, timezone
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
+    TypeHandler,
     filters,
 )
-import openai
-import httpx
+
+from cache import LRUCache, ResponseCache, context_digest
+from digest import DIGEST_PROMPT, DigestScheduler, format_utc_offset, parse_utc_offset
+from intents import IntentRouter
+from llm import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, OpenAIClient, OpenAIError, OpenAIScheduler
+from memory import ConversationMemory
+from metrics import Metrics
+from outbound import TELEGRAM_MESSAGE_LIMIT, Outbox, TelegramRateLimiter
+from models import (
+    Project,
+    ProjectStatus,
+    Task,
+    TaskStatus,
+    deadline_ordinal,
+    format_deadline,
+    parse_deadline,
+    timestamp,
+)
+from reminders import DeadlineScheduler
+from search import SearchQuery, TaskSearchIndex
+from storage import build_user, create_storage, next_version, user_rows
+from transfer import FORMATS, TransferError, detect_format, export_chunks, parse_record, read_records
+from webapp_api import WebAppAPI
+
+startup.mark("imports", "Модули загружены")
 
 # Настройка логирования
 logging.basicConfig(
@@ -25,165 +58,903 @@ BOT_TOKEN = os.environ.get("BOT_TOKEN", "YOUR_TELEGRAM_BOT_TOKEN")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "YOUR_OPENAI_API_KEY")
 WEBAPP_URL = os.environ.get("WEBAPP_URL", "https://your-webapp-url.com/kanban-app")
 
-# Инициализация OpenAI API
-openai.api_key = OPENAI_API_KEY
+# Хранилище данных: "memory" (как раньше, в памяти процесса), "sqlite" или
+# "journal" (журнал изменений со снимками; STORAGE_PATH — каталог)
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "memory")
+STORAGE_PATH = os.environ.get("STORAGE_PATH", "flowento.db")
+STORAGE_BATCH_SIZE = int(os.environ.get("STORAGE_BATCH_SIZE", "100"))
+STORAGE_FLUSH_INTERVAL = float(os.environ.get("STORAGE_FLUSH_INTERVAL", "1.0"))
+STORAGE_CACHE_SIZE = int(os.environ.get("STORAGE_CACHE_SIZE", "1000"))
+# Как часто проверять, пора ли записать снимок журнала (секунды), и при каком
+# размере журнала снимок записывается (байты)
+STORAGE_SNAPSHOT_INTERVAL = float(os.environ.get("STORAGE_SNAPSHOT_INTERVAL", "60"))
+STORAGE_SNAPSHOT_MIN_BYTES = int(os.environ.get("STORAGE_SNAPSHOT_MIN_BYTES", str(16 * 1024 * 1024)))
+
+# Параметры HTTP-клиента для OpenAI
+OPENAI_API_URL = os.environ.get("OPENAI_API_URL", "https://api.openai.com/v1/chat/completions")
+OPENAI_HTTP2 = os.environ.get("OPENAI_HTTP2", "0") == "1"
+OPENAI_MAX_CONNECTIONS = int(os.environ.get("OPENAI_MAX_CONNECTIONS", "100"))
+OPENAI_MAX_KEEPALIVE = int(os.environ.get("OPENAI_MAX_KEEPALIVE", "20"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.environ.get("OPENAI_KEEPALIVE_EXPIRY", "30"))
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", "30"))
+OPENAI_CONNECT_TIMEOUT = float(os.environ.get("OPENAI_CONNECT_TIMEOUT", "5"))
+
+# Планировщик запросов к OpenAI: не больше OPENAI_MAX_CONCURRENT запросов
+# одновременно, бюджеты запросов и токенов в минуту, повторы при 429/5xx с
+# задержкой от OPENAI_BACKOFF_BASE до OPENAI_BACKOFF_MAX секунд и дубль
+# запроса, если ответа нет дольше OPENAI_HEDGE_AFTER секунд (0 — без дублей)
+OPENAI_MAX_CONCURRENT = int(os.environ.get("OPENAI_MAX_CONCURRENT", "10"))
+OPENAI_RPM = int(os.environ.get("OPENAI_RPM", "3500"))
+OPENAI_TPM = int(os.environ.get("OPENAI_TPM", "90000"))
+OPENAI_MAX_RETRIES = int(os.environ.get("OPENAI_MAX_RETRIES", "3"))
+OPENAI_BACKOFF_BASE = float(os.environ.get("OPENAI_BACKOFF_BASE", "0.5"))
+OPENAI_BACKOFF_MAX = float(os.environ.get("OPENAI_BACKOFF_MAX", "20"))
+OPENAI_HEDGE_AFTER = float(os.environ.get("OPENAI_HEDGE_AFTER", "10"))
+
+# Потоковые ответы ИИ: сообщение-заглушка обновляется по мере генерации.
+# Telegram ограничивает частоту редактирования, поэтому правки идут не чаще
+# одной за AI_STREAM_EDIT_INTERVAL секунд
+AI_STREAMING = os.environ.get("AI_STREAMING", "1") == "1"
+AI_STREAM_EDIT_INTERVAL = float(os.environ.get("AI_STREAM_EDIT_INTERVAL", "1.0"))
+
+# Память разговора с ИИ: буфер последних сообщений ограничен числом сообщений
+# и бюджетом токенов, вытесненные сообщения сворачиваются в резюме каждые
+# AI_SUMMARY_REFRESH сообщений
+AI_CONTEXT_MAX_MESSAGES = int(os.environ.get("AI_CONTEXT_MAX_MESSAGES", "20"))
+AI_CONTEXT_TOKEN_BUDGET = int(os.environ.get("AI_CONTEXT_TOKEN_BUDGET", "1500"))
+AI_SUMMARY_REFRESH = int(os.environ.get("AI_SUMMARY_REFRESH", "6"))
+
+# Кеш ответов ИИ на повторяющиеся запросы (AI_CACHE_SIZE=0 отключает кеш).
+# В ключ входят последние AI_CACHE_CONTEXT_MESSAGES сообщений разговора:
+# по умолчанию последний обмен репликами, чтобы ответ на короткое «да» или
+# «что дальше?» не брался из кеша другого разговора
+AI_CACHE_SIZE = int(os.environ.get("AI_CACHE_SIZE", "10000"))
+AI_CACHE_TTL = float(os.environ.get("AI_CACHE_TTL", "600"))
+AI_CACHE_CONTEXT_MESSAGES = int(os.environ.get("AI_CACHE_CONTEXT_MESSAGES", "2"))
+
+# Сколько обновлений обрабатывается одновременно (обновления одного
+# пользователя всегда обрабатываются по очереди)
+MAX_CONCURRENT_UPDATES = int(os.environ.get("MAX_CONCURRENT_UPDATES", "64"))
+
+# Режим получения обновлений: "polling" (long polling) или "webhook".
+# В режиме webhook бот поднимает HTTP-сервер на WEBHOOK_LISTEN:WEBHOOK_PORT
+# и принимает обновления по пути WEBHOOK_PATH; WEBHOOK_URL — публичный адрес,
+# который регистрируется в Telegram, WEBHOOK_SECRET_TOKEN проверяется в
+# заголовке каждого запроса
+BOT_MODE = os.environ.get("BOT_MODE", "polling")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_SECRET_TOKEN = os.environ.get("WEBHOOK_SECRET_TOKEN", "")
+
+# Число рабочих процессов. Если больше 0, процесс бота становится фронтом:
+# получает обновления и раздает их рабочим процессам по user_id, а данные
+# пользователей хранятся в рабочих процессах (у каждого свое хранилище
+# STORAGE_PATH.workerN). Лимиты Telegram и OpenAI делятся между рабочими
+# поровну; метрики каждый рабочий отдает на порту METRICS_PORT + 1 + N.
+# SIGTTIN и SIGTTOU фронт-процессу добавляют и убирают рабочий процесс
+BOT_WORKERS = int(os.environ.get("BOT_WORKERS", "0"))
+# Номер рабочего процесса и сокет фронта задает фронт-процесс при запуске рабочего
+BOT_WORKER_ID = os.environ.get("BOT_WORKER_ID")
+BOT_FRONT_SOCKET = os.environ.get("BOT_FRONT_SOCKET", "")
+CLUSTER_FRONT = BOT_WORKERS > 0 and BOT_WORKER_ID is None
+
+# Типы обновлений, которые обрабатывает бот (данные мини-приложения
+# приходят в обычных сообщениях)
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
+
+# Напоминания о дедлайнах: в REMINDER_HOUR часов за REMINDER_DAYS_BEFORE дней
+# до дедлайна; наступившие напоминания проверяются раз в REMINDER_CHECK_INTERVAL секунд
+REMINDER_HOUR = int(os.environ.get("REMINDER_HOUR", "10"))
+REMINDER_DAYS_BEFORE = int(os.environ.get("REMINDER_DAYS_BEFORE", "1"))
+REMINDER_CHECK_INTERVAL = float(os.environ.get("REMINDER_CHECK_INTERVAL", "60"))
+
+# Ежедневные сводки по проектам (пользователь включает их командой /digest):
+# в DIGEST_HOUR часов по времени пользователя, часовой пояс по умолчанию —
+# DIGEST_UTC_OFFSET (например, +3 или +5:30). Сводка, не отправленная вовремя,
+# уходит в течение DIGEST_WINDOW минут; наступившие сводки проверяются раз в
+# DIGEST_CHECK_INTERVAL секунд. Сводки запрашивают у ИИ не больше
+# DIGEST_MAX_CONCURRENT одновременно и с фоновым приоритетом, чтобы не
+# отнимать слоты и бюджет у ответов пользователям; ответы ИИ кешируются по
+# состоянию проектов (DIGEST_CACHE_SIZE записей)
+DIGEST_HOUR = int(os.environ.get("DIGEST_HOUR", "9"))
+DIGEST_UTC_OFFSET = os.environ.get("DIGEST_UTC_OFFSET", "+3")
+DIGEST_WINDOW = int(os.environ.get("DIGEST_WINDOW", "60"))
+DIGEST_CHECK_INTERVAL = float(os.environ.get("DIGEST_CHECK_INTERVAL", "60"))
+DIGEST_MAX_CONCURRENT = int(os.environ.get("DIGEST_MAX_CONCURRENT", str(max(1, OPENAI_MAX_CONCURRENT // 4))))
+DIGEST_CACHE_SIZE = int(os.environ.get("DIGEST_CACHE_SIZE", "10000"))
+
+# Постраничный вывод /tasks и /my_projects; отрисованные страницы кешируются
+# по версии проекта (PAGE_CACHE_SIZE — сколько наборов страниц держать в памяти)
+TASKS_PAGE_SIZE = int(os.environ.get("TASKS_PAGE_SIZE", "30"))
+PROJECTS_PAGE_SIZE = int(os.environ.get("PROJECTS_PAGE_SIZE", "10"))
+PAGE_CACHE_SIZE = int(os.environ.get("PAGE_CACHE_SIZE", "1000"))
+
+# HTTP API для канбан-доски (WEBAPP_API_PORT=0 отключает API). Сервер также
+# отдает index.html по адресу "/", так что мини-приложение можно открывать с него
+WEBAPP_API_HOST = os.environ.get("WEBAPP_API_HOST", "0.0.0.0")
+WEBAPP_API_PORT = int(os.environ.get("WEBAPP_API_PORT", "8080"))
+WEBAPP_API_CORS_ORIGIN = os.environ.get("WEBAPP_API_CORS_ORIGIN", "*")
+WEBAPP_INIT_DATA_MAX_AGE = int(os.environ.get("WEBAPP_INIT_DATA_MAX_AGE", "86400"))
+
+# Локальное распознавание команд в свободном тексте: сообщения вроде
+# "покажи задачи проекта 2" обрабатываются без запроса к ИИ, если уверенность
+# классификатора не ниже INTENT_CONFIDENCE (INTENT_ROUTING=0 отключает).
+# Классификатор применяется только к сообщениям не длиннее INTENT_MAX_WORDS
+# слов, все слова которых ему знакомы; создание проектов и задач — только
+# по точным шаблонам
+INTENT_ROUTING = os.environ.get("INTENT_ROUTING", "1") == "1"
+INTENT_CONFIDENCE = float(os.environ.get("INTENT_CONFIDENCE", "0.75"))
+INTENT_MAX_WORDS = int(os.environ.get("INTENT_MAX_WORDS", "6"))
+
+# Поиск задач: сколько результатов показывать и для скольких пользователей
+# держать построенный поисковый индекс
+SEARCH_RESULTS_LIMIT = int(os.environ.get("SEARCH_RESULTS_LIMIT", "20"))
+SEARCH_INDEX_USERS = int(os.environ.get("SEARCH_INDEX_USERS", "10000"))
+
+# Выгрузка и загрузка проектов (/export, /import): выгрузка пишется во
+# временный файл, который держится в памяти до EXPORT_SPOOL_SIZE байт; файл
+# импорта — не больше IMPORT_MAX_BYTES байт и IMPORT_MAX_TASKS задач
+EXPORT_SPOOL_SIZE = int(os.environ.get("EXPORT_SPOOL_SIZE", str(1024 * 1024)))
+IMPORT_MAX_BYTES = int(os.environ.get("IMPORT_MAX_BYTES", str(10 * 1024 * 1024)))
+IMPORT_MAX_TASKS = int(os.environ.get("IMPORT_MAX_TASKS", "20000"))
+
+# Метрики Prometheus на http://METRICS_HOST:METRICS_PORT/metrics (METRICS_PORT=0
+# отключает метрики); число сущностей в хранилище обновляется раз в METRICS_INTERVAL секунд
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "9100"))
+METRICS_INTERVAL = float(os.environ.get("METRICS_INTERVAL", "30"))
+
+# Версия формата пакета изменений из мини-приложения
+WEBAPP_BATCH_VERSION = 2
+
+# Лимиты исходящих сообщений: всего SEND_GLOBAL_RATE в секунду, в один чат —
+# SEND_CHAT_RATE в секунду с запасом SEND_CHAT_BURST; при ответе 429 запрос
+# повторяется не больше SEND_MAX_RETRIES раз
+SEND_GLOBAL_RATE = float(os.environ.get("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(os.environ.get("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = int(os.environ.get("SEND_CHAT_BURST", "3"))
+SEND_MAX_RETRIES = int(os.environ.get("SEND_MAX_RETRIES", "3"))
+
+# Сколько символов страницы отводится под список (остальное — заголовок и подсказки)
+PAGE_BODY_LIMIT = 3500
+
+# Метрики Prometheus (сервер /metrics запускается в post_init)
+metrics = Metrics()
+
+# Общий клиент OpenAI с пулом соединений (HTTP-клиент создается в post_init)
+openai_client = OpenAIClient(
+    OPENAI_API_KEY,
+    OPENAI_API_URL,
+    http2=OPENAI_HTTP2,
+    max_connections=OPENAI_MAX_CONNECTIONS,
+    max_keepalive_connections=OPENAI_MAX_KEEPALIVE,
+    keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+    timeout=OPENAI_TIMEOUT,
+    connect_timeout=OPENAI_CONNECT_TIMEOUT,
+)
+
+# Все запросы к OpenAI проходят через планировщик
+openai_scheduler = OpenAIScheduler(
+    openai_client,
+    max_concurrent=OPENAI_MAX_CONCURRENT,
+    requests_per_minute=OPENAI_RPM,
+    tokens_per_minute=OPENAI_TPM,
+    max_retries=OPENAI_MAX_RETRIES,
+    backoff_base=OPENAI_BACKOFF_BASE,
+    backoff_max=OPENAI_BACKOFF_MAX,
+    hedge_after=OPENAI_HEDGE_AFTER,
+    on_request=metrics.observe_openai,
+)
+
+# Память разговоров с ИИ
+conversation_memory = ConversationMemory(
+    max_messages=AI_CONTEXT_MAX_MESSAGES,
+    token_budget=AI_CONTEXT_TOKEN_BUDGET,
+    summary_refresh=AI_SUMMARY_REFRESH,
+)
+
+# Кеш ответов ИИ
+response_cache = ResponseCache(max_size=AI_CACHE_SIZE, ttl=AI_CACHE_TTL)
+
+# Распознавание команд в свободном тексте
+intent_router = IntentRouter(threshold=INTENT_CONFIDENCE, model_max_words=INTENT_MAX_WORDS)
+
+# Кеш отрисованных страниц /tasks и /my_projects
+page_cache = LRUCache(max_size=PAGE_CACHE_SIZE)
+
+# Поисковый индекс задач
+search_index = TaskSearchIndex(max_users=SEARCH_INDEX_USERS)
 
-# Хранилище данных пользователей (в реальном приложении лучше использовать базу данных)
-user_data = {}
+# Планировщик напоминаний о дедлайнах
+deadline_scheduler = DeadlineScheduler(reminder_hour=REMINDER_HOUR, days_before=REMINDER_DAYS_BEFORE)
+
+# Расписание сводок по проектам, очередь сводок к отправке и кеш ответов ИИ
+# по хешу состояния проектов
+digest_scheduler = DigestScheduler(window=DIGEST_WINDOW)
+digest_backlog = deque()
+digest_tasks = set()
+digest_cache = LRUCache(max_size=DIGEST_CACHE_SIZE)
+
+# Ограничитель исходящих запросов к Bot API
+rate_limiter = TelegramRateLimiter(
+    global_rate=SEND_GLOBAL_RATE,
+    chat_rate=SEND_CHAT_RATE,
+    chat_burst=SEND_CHAT_BURST,
+    max_retries=SEND_MAX_RETRIES,
+)
+
+# Фоновые задачи обновления резюме (ссылки нужны, чтобы задачи не собрал GC)
+summary_tasks = {}
+
+# Хранилище данных пользователей. Открывается в build_application():
+# фронт-процессу кластера и проверке настроек оно не нужно
+storage = None
+
+# API канбан-доски (сервер запускается в post_init)
+webapp_api = WebAppAPI(
+    BOT_TOKEN,
+    lambda user_id: ProjectManager.get_user(user_id),
+    host=WEBAPP_API_HOST,
+    port=WEBAPP_API_PORT,
+    cors_origin=WEBAPP_API_CORS_ORIGIN,
+    init_data_max_age=WEBAPP_INIT_DATA_MAX_AGE,
+    index_path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "index.html"),
+    search_tasks=lambda user_id, query, limit: ProjectManager.search_tasks(user_id, query, limit),
+)
+
+
+def open_storage():
+    """Открыть хранилище данных пользователей по настройкам STORAGE_*"""
+    if STORAGE_BACKEND == "sqlite":
+        return create_storage(
+            STORAGE_BACKEND,
+            STORAGE_PATH,
+            batch_size=STORAGE_BATCH_SIZE,
+            flush_interval=STORAGE_FLUSH_INTERVAL,
+            cache_size=STORAGE_CACHE_SIZE,
+        )
+    if STORAGE_BACKEND == "journal":
+        return create_storage(
+            STORAGE_BACKEND,
+            STORAGE_PATH,
+            batch_size=STORAGE_BATCH_SIZE,
+            flush_interval=STORAGE_FLUSH_INTERVAL,
+            cache_size=STORAGE_CACHE_SIZE,
+            snapshot_min_bytes=STORAGE_SNAPSHOT_MIN_BYTES,
+        )
+    return create_storage(STORAGE_BACKEND)
+
+
+def validate_config():
+    """Проверить настройки до запуска: список ошибок (пустой, если все в порядке)"""
+    errors = []
+    if not BOT_TOKEN or BOT_TOKEN == "YOUR_TELEGRAM_BOT_TOKEN":
+        errors.append("не задан BOT_TOKEN")
+    if BOT_MODE not in ("polling", "webhook"):
+        errors.append(f"неизвестный режим работы бота BOT_MODE={BOT_MODE}")
+    if BOT_MODE == "webhook" and (not WEBHOOK_URL or not WEBHOOK_SECRET_TOKEN):
+        errors.append("для режима webhook нужно задать WEBHOOK_URL и WEBHOOK_SECRET_TOKEN")
+    if STORAGE_BACKEND not in ("memory", "sqlite", "journal"):
+        errors.append(f"неизвестный тип хранилища STORAGE_BACKEND={STORAGE_BACKEND}")
+    if BOT_WORKERS < 0:
+        errors.append("BOT_WORKERS не может быть отрицательным")
+    if not 0 <= INTENT_CONFIDENCE <= 1:
+        errors.append("INTENT_CONFIDENCE должен быть от 0 до 1")
+
+    positive = {
+        "STORAGE_BATCH_SIZE": STORAGE_BATCH_SIZE,
+        "STORAGE_FLUSH_INTERVAL": STORAGE_FLUSH_INTERVAL,
+        "STORAGE_SNAPSHOT_INTERVAL": STORAGE_SNAPSHOT_INTERVAL,
+        "OPENAI_MAX_CONCURRENT": OPENAI_MAX_CONCURRENT,
+        "OPENAI_RPM": OPENAI_RPM,
+        "OPENAI_TPM": OPENAI_TPM,
+        "MAX_CONCURRENT_UPDATES": MAX_CONCURRENT_UPDATES,
+        "REMINDER_CHECK_INTERVAL": REMINDER_CHECK_INTERVAL,
+        "DIGEST_WINDOW": DIGEST_WINDOW,
+        "DIGEST_CHECK_INTERVAL": DIGEST_CHECK_INTERVAL,
+        "DIGEST_MAX_CONCURRENT": DIGEST_MAX_CONCURRENT,
+        "TASKS_PAGE_SIZE": TASKS_PAGE_SIZE,
+        "PROJECTS_PAGE_SIZE": PROJECTS_PAGE_SIZE,
+        "METRICS_INTERVAL": METRICS_INTERVAL,
+        "SEND_GLOBAL_RATE": SEND_GLOBAL_RATE,
+        "SEND_CHAT_RATE": SEND_CHAT_RATE,
+        "SEND_CHAT_BURST": SEND_CHAT_BURST,
+        "INTENT_MAX_WORDS": INTENT_MAX_WORDS,
+    }
+    errors.extend(f"{name} должен быть больше 0" for name, value in positive.items() if value <= 0)
+
+    ports = {"WEBHOOK_PORT": WEBHOOK_PORT, "WEBAPP_API_PORT": WEBAPP_API_PORT, "METRICS_PORT": METRICS_PORT}
+    errors.extend(f"{name} должен быть от 0 до 65535" for name, value in ports.items() if not 0 <= value <= 65535)
+    if not 0 <= REMINDER_HOUR <= 23:
+        errors.append("REMINDER_HOUR должен быть от 0 до 23")
+    if not 0 <= DIGEST_HOUR <= 23:
+        errors.append("DIGEST_HOUR должен быть от 0 до 23")
+    if parse_utc_offset(DIGEST_UTC_OFFSET) is None:
+        errors.append("DIGEST_UTC_OFFSET должен быть смещением от UTC, например +3 или +5:30")
+
+    if OPENAI_API_KEY == "YOUR_OPENAI_API_KEY":
+        logger.warning("Не задан OPENAI_API_KEY: ответы ИИ работать не будут")
+    return errors
 
 
 class ProjectManager:
     """Класс для управления проектами и задачами"""
 
     @staticmethod
-    async def generate_ai_response(user_id, message):
-        """Генерирует ответ от ИИ на основе сообщения пользователя и контекста"""
-        user_context = user_data.get(user_id, {}).get("context", [])
-
-        # Создаем контекст с историей взаимодействия
-        messages = [
-            {"role": "system", "content": "Ты — ИИ-ассистент, который помогает вести проекты. "
-                                         "Твоя задача — помогать с организацией задач, роадмапов и напоминать о статусах. "
-                                         "Старайся задавать проактивные вопросы и быть инициативным. "
-                                         "Отвечай кратко и по делу."}
-        ]
+    def get_user(user_id):
+        """Получить данные пользователя или None"""
+        return storage.get_user(user_id)
 
-        # Добавляем предыдущий контекст разговора
-        for item in user_context[-5:]:  # Ограничиваем историю последними 5 сообщениями
-            messages.append(item)
+    @staticmethod
+    def get_or_create_user(user_id):
+        """Получить данные пользователя, создав их при первом обращении"""
+        user = storage.get_user(user_id)
+        if user is None:
+            user = storage.create_user(user_id)
+        return user
 
-        # Добавляем текущее сообщение пользователя
-        messages.append({"role": "user", "content": message})
+    @staticmethod
+    async def generate_ai_response(user_id, message, on_delta=None):
+        """Генерирует ответ от ИИ на основе сообщения пользователя и контекста.
+
+        Если передан on_delta, ответ запрашивается в потоковом режиме и
+        каждый новый фрагмент текста передается в await on_delta(fragment).
+        """
+        user = ProjectManager.get_user(user_id)
+
+        # Повторяющиеся запросы при том же состоянии отвечаем из кеша
+        cache_digest = ProjectManager.context_digest(user)
+        ai_response = response_cache.get(user_id, message, cache_digest)
+        if ai_response is not None:
+            if on_delta is not None:
+                await on_delta(ai_response)
+            ProjectManager.remember_exchange(user_id, message, ai_response)
+            return ai_response
+
+        # Создаем контекст с историей взаимодействия: резюме старого разговора
+        # и последние сообщения в пределах бюджета токенов
+        messages = conversation_memory.build_messages(
+            user,
+            "Ты — ИИ-ассистент, который помогает вести проекты. "
+            "Твоя задача — помогать с организацией задач, роадмапов и напоминать о статусах. "
+            "Старайся задавать проактивные вопросы и быть инициативным. "
+            "Отвечай кратко и по делу.",
+            message
+        )
+
+        payload = {
+            "model": "gpt-3.5-turbo",
+            "messages": messages,
+            "max_tokens": 500,
+            "temperature": 0.7,
+        }
 
         try:
-            # Создаем HTTP клиент для работы с OpenAI API
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    "https://api.openai.com/v1/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {OPENAI_API_KEY}",
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "model": "gpt-3.5-turbo",
-                        "messages": messages,
-                        "max_tokens": 500,
-                        "temperature": 0.7,
-                    },
-                    timeout=30.0
-                )
+            # Запрос ждет своей очереди в планировщике и идет через общий пул соединений
+            if on_delta is None:
+                data = await openai_scheduler.chat(payload)
+                ai_response = data["choices"][0]["message"]["content"]
+            else:
+                parts = []
+                async for delta in openai_scheduler.stream_chat(payload):
+                    parts.append(delta)
+                    await on_delta(delta)
+                ai_response = "".join(parts)
+
+            response_cache.put(user_id, message, cache_digest, ai_response)
+            ProjectManager.remember_exchange(user_id, message, ai_response)
+            return ai_response
+        except OpenAIError as e:
+            logger.error(f"Ошибка OpenAI API: {e.text}")
+            if e.status_code == 429:
+                return "Сейчас слишком много запросов к ИИ. Попробуйте через минуту."
+            return "Извините, произошла ошибка при обработке запроса. Попробуйте позже."
+        except Exception as e:
+            logger.error(f"Ошибка при обращении к OpenAI API: {e}")
+            return "Извините, произошла ошибка при обработке запроса. Попробуйте позже."
 
-                if response.status_code == 200:
-                    result = response.json()
-                    ai_response = result["choices"][0]["message"]["content"]
+    @staticmethod
+    def context_digest(user):
+        """Хеш части разговора, от которой зависит ответ из кеша"""
+        if not user:
+            return ""
+        recent = user["context"][-AI_CACHE_CONTEXT_MESSAGES:] if AI_CACHE_CONTEXT_MESSAGES else []
+        return context_digest(user["summary"], *(item["content"] for item in recent))
 
-                    # Обновляем контекст
-                    user_context.append({"role": "user", "content": message})
-                    user_context.append({"role": "assistant", "content": ai_response})
+    @staticmethod
+    def remember_exchange(user_id, message, ai_response):
+        """Сохраняет сообщение пользователя и ответ ИИ в памяти разговора"""
+        # Обновляем контекст
+        user = ProjectManager.get_or_create_user(user_id)
+        conversation_memory.remember(user, "user", message)
+        conversation_memory.remember(user, "assistant", ai_response)
+
+        # Сохраняем обновленный контекст
+        storage.save_user(user_id, user)
+
+        # Сворачиваем вытесненные сообщения в резюме, не задерживая ответ
+        if conversation_memory.needs_summary(user) and user_id not in summary_tasks:
+            task = asyncio.create_task(ProjectManager.refresh_summary(user_id))
+            summary_tasks[user_id] = task
+            task.add_done_callback(lambda _: summary_tasks.pop(user_id, None))
 
-                    # Сохраняем обновленный контекст
-                    if user_id not in user_data:
-                        user_data[user_id] = {}
-                    user_data[user_id]["context"] = user_context
+    @staticmethod
+    async def refresh_summary(user_id):
+        """Сворачивает вытесненные из памяти сообщения в резюме разговора"""
+        user = ProjectManager.get_user(user_id)
+        if not user:
+            return
 
-                    return ai_response
-                else:
-                    logger.error(f"Ошибка OpenAI API: {response.text}")
-                    return "Извините, произошла ошибка при обработке запроса. Попробуйте позже."
+        messages, folded = conversation_memory.summary_request(user)
+
+        try:
+            data = await openai_scheduler.chat({
+                "model": "gpt-3.5-turbo",
+                "messages": messages,
+                "max_tokens": 200,
+                "temperature": 0.3,
+            }, priority=PRIORITY_BACKGROUND)
+            summary = data["choices"][0]["message"]["content"]
         except Exception as e:
-            logger.error(f"Ошибка при обращении к OpenAI API: {e}")
-            return "Извините, произошла ошибка при обработке запроса. Попробуйте позже."
+            # Сообщения остаются в очереди и будут свернуты при следующей попытке
+            logger.error(f"Не удалось обновить резюме разговора: {e}")
+            return
+
+        conversation_memory.apply_summary(user, summary, folded)
+        storage.save_user(user_id, user)
 
     @staticmethod
     def get_projects(user_id):
         """Получить список проектов пользователя"""
-        return user_data.get(user_id, {}).get("projects", [])
+        user = ProjectManager.get_user(user_id)
+        return list(user["projects"].values()) if user else []
 
     @staticmethod
     def add_project(user_id, project_name, description=""):
         """Добавить новый проект"""
-        if user_id not in user_data:
-            user_data[user_id] = {"projects": [], "context": []}
-
-        project_id = len(user_data[user_id]["projects"]) + 1
-
-        new_project = {
-            "id": project_id,
-            "name": project_name,
-            "description": description,
-            "created_at": datetime.now().isoformat(),
-            "tasks": [],
-            "status": "В процессе"
-        }
+        user = ProjectManager.get_or_create_user(user_id)
+
+        # Счетчик только растет, поэтому ID не повторяются даже после удаления проектов
+        project_id = user["next_project_id"]
+        user["next_project_id"] += 1
 
-        user_data[user_id]["projects"].append(new_project)
+        new_project = Project(
+            project_id, project_name, description, timestamp(), ProjectStatus.IN_PROGRESS, 1, next_version()
+        )
+
+        user["projects"][project_id] = new_project
+        storage.save_project(user_id, user, new_project)
+        storage.save_user(user_id, user)
+        ProjectManager.mark_changed(user_id, new_project)
         return new_project
 
     @staticmethod
     def get_project(user_id, project_id):
         """Получить проект по ID"""
-        projects = ProjectManager.get_projects(user_id)
-        for project in projects:
-            if project["id"] == project_id:
-                return project
-        return None
+        user = ProjectManager.get_user(user_id)
+        if not user:
+            return None
+        return user["projects"].get(project_id)
 
     @staticmethod
-    def add_task(user_id, project_id, task_name, description="", deadline=None):
-        """Добавить новую задачу в проект"""
+    def get_task(user_id, project_id, task_id):
+        """Получить задачу по ID проекта и ID задачи"""
         project = ProjectManager.get_project(user_id, project_id)
         if not project:
             return None
+        return project.tasks.get(task_id)
+
+    @staticmethod
+    def apply_batch(user_id, actions, base_version=None):
+        """Атомарно применить пакет изменений из мини-приложения.
+
+        Сначала проверяются все действия: если хотя бы одно некорректно или
+        затронутая задача изменилась после base_version, не применяется ни одно.
+        Возвращает (число примененных действий по типам, None) или (None, причина отказа).
+        """
+        user = ProjectManager.get_user(user_id)
+        if base_version is not None and user:
+            # После загрузки данных (перезапуск, вытеснение из кеша, перенос
+            # между процессами) у всех задач новые версии: изменения до
+            # загрузки не видны, а более поздние по-прежнему считаются конфликтом
+            base_version = max(base_version, user["loaded_version"])
+        prepared = []
+
+        for action in actions:
+            kind = action.get("action")
+            try:
+                project_id = int(action["projectId"])
+            except (KeyError, TypeError, ValueError):
+                return None, "некорректный ID проекта"
+
+            project = ProjectManager.get_project(user_id, project_id)
+            if not project:
+                return None, f"проект с ID {project_id} не найден"
+
+            status = None
+            if action.get("status"):
+                status = TaskStatus.parse(action["status"])
+                if status is None:
+                    return None, f"неизвестный статус задачи '{action['status']}'"
+            deadline = None
+            if action.get("deadline"):
+                day = parse_deadline(action["deadline"])
+                if day is None:
+                    return None, f"дедлайн '{action['deadline']}' должен быть в формате ДД.ММ.ГГГГ"
+                deadline = day.toordinal()
+
+            if kind == "createTask":
+                if not action.get("name"):
+                    return None, "у новой задачи нет названия"
+                prepared.append((kind, project_id, None, action, status, deadline))
+                continue
+
+            if kind not in ("statusUpdate", "updateTask"):
+                return None, f"неизвестное действие '{kind}'"
+
+            try:
+                task_id = int(action["id"])
+            except (KeyError, TypeError, ValueError):
+                return None, "некорректный ID задачи"
+
+            task = project.tasks.get(task_id)
+            if not task:
+                return None, f"задача с ID {task_id} не найдена"
+            if base_version is not None and task.version > base_version:
+                return None, f"задача '{task.name}' изменилась после открытия доски"
+            if kind == "statusUpdate" and not status:
+                return None, "не указан новый статус задачи"
+            if kind == "updateTask" and not action.get("name"):
+                return None, "у задачи нет названия"
+            prepared.append((kind, project_id, task_id, action, status, deadline))
+
+        counts = {"createTask": 0, "statusUpdate": 0, "updateTask": 0}
+        for kind, project_id, task_id, action, status, deadline in prepared:
+            if kind == "createTask":
+                new_task = ProjectManager.add_task(
+                    user_id,
+                    project_id,
+                    action["name"],
+                    action.get("description", ""),
+                    deadline
+                )
+                if status and status != new_task.status:
+                    ProjectManager.update_task_status(user_id, project_id, new_task.id, status)
+            elif kind == "statusUpdate":
+                ProjectManager.update_task_status(user_id, project_id, task_id, status)
+            else:
+                ProjectManager.update_task(user_id, project_id, task_id, {
+                    "name": action["name"],
+                    "description": action.get("description", ""),
+                    "status": status or TaskStatus.IN_PROGRESS,
+                    "deadline": deadline
+                })
+            counts[kind] += 1
 
-        task_id = len(project["tasks"]) + 1
+        return counts, None
 
-        new_task = {
-            "id": task_id,
-            "name": task_name,
-            "description": description,
-            "created_at": datetime.now().isoformat(),
-            "deadline": deadline,
-            "status": "Создана"
-        }
+    @staticmethod
+    def import_records(user_id, records, dry_run=False, as_new=False):
+        """Импортировать проекты и задачи из записей файла (номер строки, запись).
+
+        Сначала проверяются все записи: если хотя бы одна некорректна, не
+        импортируется ничего. Задачи группируются в проекты по project_id из
+        файла, а если его нет — по названию. Группа с project_id попадает в
+        проект пользователя с тем же ID и названием (файл /export этого же
+        пользователя), и задачи с уже существующими в нем ID пропускаются;
+        иначе создается новый проект. Группа без ID попадает в проект с тем же
+        названием, если он есть. С as_new всегда создаются новые проекты, с
+        dry_run только проверка. Возвращает ({"projects": новых проектов,
+        "tasks": задач, "skipped": пропущено задач}, None) или (None, причина отказа).
+        """
+        prepared = {}
+        task_count = 0
+        try:
+            for line_number, record in records:
+                project_id, name, description, task = parse_record(line_number, record)
+                key = ("name", name) if project_id is None else ("id", project_id)
+                entry = prepared.setdefault(key, (name, description, []))
+                if task is None:
+                    continue
+                task_count += 1
+                if task_count > IMPORT_MAX_TASKS:
+                    return None, f"в файле больше {IMPORT_MAX_TASKS} задач"
+                entry[2].append(task)
+        except TransferError as e:
+            return None, str(e)
+
+        if not prepared:
+            return None, "в файле нет ни одного проекта"
+
+        user = ProjectManager.get_user(user_id)
+        projects = user["projects"] if user else {}
+        by_name = {}
+        for project in projects.values():
+            by_name.setdefault(project.name, project)
+
+        # Проект пользователя для каждой группы (None — создать новый) и задачи для импорта
+        plan = []
+        counts = {"projects": 0, "tasks": 0, "skipped": 0}
+        for (kind, value), (name, description, imported_tasks) in prepared.items():
+            if as_new:
+                project = None
+            elif kind == "id":
+                project = projects.get(value)
+                if project is not None and project.name != name:
+                    project = None
+            else:
+                project = by_name.get(name)
+
+            if project is not None:
+                fresh = [task for task in imported_tasks if task["id"] not in project.tasks]
+                counts["skipped"] += len(imported_tasks) - len(fresh)
+                imported_tasks = fresh
+            else:
+                counts["projects"] += 1
+            counts["tasks"] += len(imported_tasks)
+            plan.append((project, name, description, imported_tasks))
+        if dry_run:
+            return counts, None
+
+        user = ProjectManager.get_or_create_user(user_id)
+        for project, name, description, imported_tasks in plan:
+            if project is None:
+                project = ProjectManager.add_project(user_id, name, description)
+
+            # Все задачи проекта добавляются одним проходом: проект сохраняется
+            # и получает новую версию один раз, а не после каждой задачи
+            now = timestamp()
+            for imported in imported_tasks:
+                ProjectManager.insert_task(
+                    user_id, user, project, imported["name"], imported["description"],
+                    imported["created_at"] or now, imported["deadline"], imported["status"]
+                )
+            if imported_tasks:
+                storage.save_project(user_id, user, project)
+                ProjectManager.mark_changed(user_id, project)
+
+        return counts, None
+
+    @staticmethod
+    def mark_changed(user_id, project, task=None):
+        """Отметить изменение проекта (и задачи): новые версии и сброс кеша ответов ИИ"""
+        if task is not None:
+            task.version = next_version()
+        project.version = next_version()
+        ProjectManager.get_user(user_id)["version"] = next_version()
+        response_cache.invalidate_user(user_id)
+
+    @staticmethod
+    def count_status(project, old_status, new_status):
+        """Обновить счетчики задач проекта по статусам при смене статуса задачи"""
+        counts = project.status_counts
+        if old_status is not None:
+            counts[old_status] -= 1
+        counts[new_status] = counts.get(new_status, 0) + 1
+
+    @staticmethod
+    def completed_tasks(project):
+        """Число завершенных задач проекта"""
+        return project.status_counts.get(TaskStatus.DONE, 0)
+
+    @staticmethod
+    def add_task(user_id, project_id, task_name, description="", deadline=None):
+        """Добавить новую задачу в проект (deadline — номер дня, см. date.toordinal)"""
+        user = ProjectManager.get_user(user_id)
+        project = user["projects"].get(project_id) if user else None
+        if not project:
+            return None
 
-        project["tasks"].append(new_task)
+        new_task = ProjectManager.insert_task(
+            user_id, user, project, task_name, description, timestamp(), deadline, TaskStatus.CREATED
+        )
+        storage.save_project(user_id, user, project)
+        ProjectManager.mark_changed(user_id, project)
         return new_task
 
+    @staticmethod
+    def insert_task(user_id, user, project, task_name, description, created_at, deadline, status):
+        """Создать задачу в проекте: ID, счетчики по статусам, напоминание и поисковый индекс.
+
+        Проект не сохраняется и не получает новую версию — это делает
+        вызывающий код (один раз на несколько задач при импорте).
+        """
+        task_id = project.next_task_id
+        project.next_task_id += 1
+
+        task = Task(task_id, task_name, description, created_at, deadline, status, next_version())
+        project.tasks[task_id] = task
+        ProjectManager.count_status(project, None, status)
+        storage.save_task(user_id, user, project.id, task)
+        deadline_scheduler.schedule(user_id, project.id, task_id, deadline, status)
+        search_index.update_task(user_id, project.id, task)
+        return task
+
     @staticmethod
     def update_task_status(user_id, project_id, task_id, new_status):
-        """Обновить статус задачи"""
-        project = ProjectManager.get_project(user_id, project_id)
-        if not project:
+        """Обновить статус задачи (new_status — TaskStatus)"""
+        user = ProjectManager.get_user(user_id)
+        project = user["projects"].get(project_id) if user else None
+        task = project.tasks.get(task_id) if project else None
+        if not task:
             return False
 
-        for task in project["tasks"]:
-            if task["id"] == task_id:
-                task["status"] = new_status
-                return True
-
-        return False
+        ProjectManager.count_status(project, task.status, new_status)
+        task.status = new_status
+        storage.save_task(user_id, user, project_id, task)
+        ProjectManager.mark_changed(user_id, project, task)
+        deadline_scheduler.schedule(user_id, project_id, task_id, task.deadline, new_status)
+        search_index.update_task(user_id, project_id, task)
+        return True
 
     @staticmethod
     def update_task(user_id, project_id, task_id, task_data):
-        """Обновить данные задачи"""
-        project = ProjectManager.get_project(user_id, project_id)
-        if not project:
+        """Обновить данные задачи: name, description, status (TaskStatus), deadline (номер дня или None)"""
+        user = ProjectManager.get_user(user_id)
+        project = user["projects"].get(project_id) if user else None
+        task = project.tasks.get(task_id) if project else None
+        if not task:
             return False
 
-        for task in project["tasks"]:
-            if task["id"] == task_id:
-                # Обновляем поля задачи
-                if "name" in task_data:
-                    task["name"] = task_data["name"]
-                if "description" in task_data:
-                    task["description"] = task_data["description"]
-                if "status" in task_data:
-                    task["status"] = task_data["status"]
-                if "deadline" in task_data:
-                    task["deadline"] = task_data["deadline"]
-                return True
+        # Обновляем поля задачи
+        if "name" in task_data:
+            task.name = task_data["name"]
+        if "description" in task_data:
+            task.description = task_data["description"]
+        if "status" in task_data:
+            ProjectManager.count_status(project, task.status, task_data["status"])
+            task.status = task_data["status"]
+        if "deadline" in task_data:
+            task.deadline = task_data["deadline"]
+        storage.save_task(user_id, user, project_id, task)
+        ProjectManager.mark_changed(user_id, project, task)
+        deadline_scheduler.schedule(user_id, project_id, task_id, task.deadline, task.status)
+        search_index.update_task(user_id, project_id, task)
+        return True
 
-        return False
+    @staticmethod
+    def search_tasks(user_id, query, limit=SEARCH_RESULTS_LIMIT):
+        """Найти задачи пользователя по запросу SearchQuery: список (проект, задача)"""
+        user = ProjectManager.get_user(user_id)
+        if not user:
+            return []
+
+        results = []
+        for project_id, task_id in search_index.search(user_id, user, query, limit):
+            project = user["projects"][project_id]
+            results.append((project, project.tasks[task_id]))
+        return results
+
+    @staticmethod
+    def export_user(user_id):
+        """Данные пользователя для передачи другому процессу или None"""
+        user = storage.get_user(user_id)
+        if user is None:
+            return None
+        project_rows, task_rows = user_rows(user)
+        return (user["next_project_id"], user["context"], user["summary"], user["summary_pending"],
+                project_rows, task_rows, user["settings"])
+
+    @staticmethod
+    def import_user(user_id, data):
+        """Сохранить данные пользователя, полученные от export_user, вместо текущих.
+
+        Пустые данные не заменяют непустые: пустого пользователя мог создать
+        процесс, получивший обновление после неудачной передачи.
+        """
+        imported = build_user(*data)
+        existing = storage.get_user(user_id)
+        if existing is not None:
+            if ProjectManager.is_empty_user(imported) and not ProjectManager.is_empty_user(existing):
+                logger.warning(f"Пустые данные пользователя {user_id} не заменяют сохраненные")
+                return existing
+            ProjectManager.drop_user(user_id)
+
+        user = storage.create_user(user_id)
+        user.update(imported)
+        storage.save_user(user_id, user)
+        for project in user["projects"].values():
+            storage.save_project(user_id, user, project)
+            for task in project.tasks.values():
+                storage.save_task(user_id, user, project.id, task)
+                # Наступившие напоминания уже отправил прежний процесс
+                deadline_scheduler.schedule(
+                    user_id, project.id, task.id, task.deadline, task.status, skip_due=True
+                )
+        ProjectManager.schedule_digest(user_id, user["settings"])
+        return user
+
+    @staticmethod
+    def is_empty_user(user):
+        """Нет ни проектов, ни разговора, ни настроек"""
+        return not (user["projects"] or user["context"] or user["summary"] or user["summary_pending"]
+                    or user["settings"])
+
+    @staticmethod
+    def drop_user(user_id):
+        """Удалить пользователя из этого процесса (после передачи его данных другому)"""
+        user = storage.get_user(user_id)
+        if user is None:
+            return
+        for project in user["projects"].values():
+            for task_id in project.tasks:
+                deadline_scheduler.unschedule(user_id, project.id, task_id)
+        storage.delete_user(user_id)
+        search_index.drop_user(user_id)
+        response_cache.invalidate_user(user_id)
+        digest_scheduler.unsubscribe(user_id)
+
+    @staticmethod
+    def set_digest(user_id, hour, utc_offset=None):
+        """Включить ежедневную сводку в hour часов (None — выключить); utc_offset — минуты от UTC"""
+        user = ProjectManager.get_or_create_user(user_id)
+        settings = user["settings"]
+        if hour is None:
+            settings.pop("digest_hour", None)
+        else:
+            settings["digest_hour"] = hour
+            settings["utc_offset"] = utc_offset
+        storage.save_user(user_id, user)
+        ProjectManager.schedule_digest(user_id, settings)
+        return settings
+
+    @staticmethod
+    def schedule_digest(user_id, settings):
+        """Обновить расписание сводок по настройкам пользователя"""
+        if "digest_hour" not in settings:
+            digest_scheduler.unsubscribe(user_id)
+            return
+        digest_scheduler.subscribe(user_id, settings["digest_hour"], settings["utc_offset"],
+                                   settings.get("digest_date"))
+
+    @staticmethod
+    async def send_digest(bot, user_id, today):
+        """Отправить сводку по проектам; False, если с прошлой сводки ничего не изменилось"""
+        user = ProjectManager.get_user(user_id)
+        if not user or not user["projects"]:
+            return False
+
+        status, state = digest_scheduler.summarize(user_id, user, today)
+        settings = user["settings"]
+        settings["digest_date"] = today.isoformat()
+        if settings.get("digest_hash") == state:
+            storage.save_user(user_id, user)
+            return False
+
+        # Совет ИИ зависит только от состояния проектов, поэтому одинаковые
+        # состояния (в том числе у разных пользователей) не запрашиваются повторно
+        advice = digest_cache.get(state)
+        if advice is None:
+            try:
+                data = await openai_scheduler.chat({
+                    "model": "gpt-3.5-turbo",
+                    "messages": [
+                        {"role": "system", "content": DIGEST_PROMPT},
+                        {"role": "user", "content": status},
+                    ],
+                    "max_tokens": 150,
+                    "temperature": 0.3,
+                }, priority=PRIORITY_BACKGROUND)
+                advice = data["choices"][0]["message"]["content"]
+                digest_cache.put(state, advice)
+            except Exception as e:
+                # Сводка уходит и без совета ИИ
+                logger.warning(f"Не удалось получить совет ИИ для сводки пользователя {user_id}: {e}")
+
+        # Пока ждали ИИ, пользователя могли передать другому рабочему процессу
+        if storage.get_user(user_id) is not user:
+            return False
+
+        text = f"📋 Сводка по проектам на {today.strftime('%d.%m.%Y')}:\n\n{status}"
+        if advice:
+            text += f"\n\n{advice}"
+        await bot.send_message(chat_id=user_id, text=text[:TELEGRAM_MESSAGE_LIMIT])
+
+        settings["digest_hash"] = state
+        storage.save_user(user_id, user)
+        return True
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -192,8 +963,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_first_name = update.effective_user.first_name
 
     # Инициализация данных пользователя
-    if user_id not in user_data:
-        user_data[user_id] = {"projects": [], "context": []}
+    ProjectManager.get_or_create_user(user_id)
 
     welcome_message = (
         f"Привет, {user_first_name}! Я ИИ-ассистент для управления проектами.\n\n"
@@ -226,10 +996,16 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/kanban - Открыть канбан-доску\n\n"
         "Управление задачами:\n"
         "/add_task {project_id} {название} - Добавить задачу\n"
-        "/tasks {project_id} - Показать задачи проекта\n"
-        "/move_task {project_id} {task_id} {статус} - Изменить статус задачи\n\n"
+        "/tasks {project_id} [страница] - Показать задачи проекта\n"
+        "/move_task {project_id} {task_id} {статус} - Изменить статус задачи\n"
+        "/search {запрос} - Найти задачи во всех проектах\n\n"
+        "Импорт и экспорт:\n"
+        "/export [ndjson|csv] - Выгрузить проекты и задачи в файл\n"
+        "/import [новые] - Загрузить проекты и задачи из файла\n"
+        "/digest [час] [часовой пояс] - Ежедневная сводка по проектам\n\n"
         "Вы также можете просто написать мне, что вам нужно, "
-        "и я постараюсь помочь!"
+        "и я постараюсь помочь! Простые просьбы вроде «покажи задачи проекта 1» "
+        "или «создай проект Сайт» я выполню сразу."
     )
 
     await update.message.reply_text(help_text)
@@ -252,63 +1028,171 @@ async def new_project(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Создаем проект
     new_project = ProjectManager.add_project(user_id, project_name)
 
-    await update.message.reply_text(
-        f"Проект '{new_project['name']}' успешно создан!\n"
-        f"ID проекта: {new_project['id']}\n\n"
+    outbox = Outbox(context.bot, update.effective_chat.id)
+    outbox.add(
+        f"Проект '{new_project.name}' успешно создан!\n"
+        f"ID проекта: {new_project.id}\n\n"
         "Теперь вы можете добавлять задачи в этот проект с помощью команды:\n"
-        f"/add_task {new_project['id']} Название задачи"
+        f"/add_task {new_project.id} Название задачи"
     )
 
     # Создаем кнопки для быстрого доступа к функциям
     keyboard = [
         [
-            InlineKeyboardButton("Добавить задачу", callback_data=f"add_task_{new_project['id']}"),
-            InlineKeyboardButton("Открыть канбан", callback_data=f"open_kanban_{new_project['id']}")
+            InlineKeyboardButton("Добавить задачу", callback_data=f"add_task_{new_project.id}"),
+            InlineKeyboardButton("Открыть канбан", callback_data=f"open_kanban_{new_project.id}")
         ]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    # Проактивное предложение
-    await update.message.reply_text(
-        "Что хотите сделать дальше?",
-        reply_markup=reply_markup
-    )
+    # Проактивное предложение уходит тем же сообщением
+    outbox.add("Что хотите сделать дальше?", reply_markup=reply_markup)
+    await outbox.flush()
 
 
-async def my_projects(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /my_projects"""
-    user_id = update.effective_user.id
-    projects = ProjectManager.get_projects(user_id)
+def split_pages(blocks, max_blocks):
+    """Разбивает блоки текста на страницы не больше max_blocks блоков и PAGE_BODY_LIMIT символов"""
+    pages = []
+    current = []
+    size = 0
 
-    if not projects:
-        await update.message.reply_text(
-            "У вас еще нет проектов. Создайте первый проект с помощью команды:\n"
-            "/new_project Название проекта"
+    for block in blocks:
+        if current and (len(current) >= max_blocks or size + len(block) > PAGE_BODY_LIMIT):
+            pages.append(current)
+            current = []
+            size = 0
+        current.append(block)
+        size += len(block) + 1
+
+    if current:
+        pages.append(current)
+    return pages
+
+
+def page_keyboard(callback_prefix, page, total_pages, extra_rows):
+    """Клавиатура с кнопками перехода между страницами"""
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("◀️ Назад", callback_data=f"{callback_prefix}_{page - 1}"))
+    if page < total_pages - 1:
+        navigation.append(InlineKeyboardButton("Вперед ▶️", callback_data=f"{callback_prefix}_{page + 1}"))
+
+    keyboard = [navigation] if navigation else []
+    return InlineKeyboardMarkup(keyboard + extra_rows)
+
+
+def build_tasks_pages(project):
+    """Отрисовать все страницы /tasks проекта: задачи идут колонками по статусам"""
+    project_id = project.id
+
+    # Группируем задачи по статусам (простая канбан-доска)
+    tasks_by_status = {}
+
+    for task in project.tasks.values():
+        deadline_text = ""
+        if task.deadline is not None:
+            deadline_text = f" (до {format_deadline(task.deadline)})"
+
+        tasks_by_status.setdefault(task.status, []).append(
+            f"• {task.name} (ID: {task.id}){deadline_text}"
         )
-        return
 
-    projects_text = "Ваши проекты:\n\n"
+    # Каждая страница содержит часть одной колонки
+    bodies = []
+    for status, lines in tasks_by_status.items():
+        for index, chunk in enumerate(split_pages(lines, TASKS_PAGE_SIZE)):
+            title = f"== {status} ==" if index == 0 else f"== {status} (продолжение) =="
+            bodies.append(title + "\n" + "\n".join(chunk))
+
+    pages = []
+    for index, body in enumerate(bodies):
+        page_title = f" (стр. {index + 1}/{len(bodies)})" if len(bodies) > 1 else ""
+        tasks_text = (
+            f"📋 Задачи проекта '{project.name}'{page_title}:\n\n"
+            f"{body}\n\n"
+            "Для изменения статуса задачи используйте команду:\n"
+            f"/move_task {project_id} [task_id] [новый статус]"
+        )
+        pages.append(tasks_text[:TELEGRAM_MESSAGE_LIMIT])
+    return pages
+
+
+def render_tasks_page(user_id, project, page):
+    """Текст и клавиатура страницы /tasks (страницы кешируются по версии проекта)"""
+    project_id = project.id
+    cache_key = ("tasks", user_id, project_id, project.version)
+    pages = page_cache.get(cache_key)
+    if pages is None:
+        pages = build_tasks_pages(project)
+        page_cache.put(cache_key, pages)
+
+    page = max(0, min(page, len(pages) - 1))
+
+    # Создаем кнопку для открытия канбан-доски
+    keyboard = [
+        [InlineKeyboardButton("Открыть канбан-доску", web_app=WebAppInfo(url=f"{WEBAPP_URL}?project_id={project_id}"))]
+    ]
+    return pages[page], page_keyboard(f"tasks_page_{project_id}", page, len(pages), keyboard)
+
 
+def build_projects_pages(projects):
+    """Отрисовать все страницы /my_projects"""
+    blocks = []
     for project in projects:
-        total_tasks = len(project["tasks"])
-        completed_tasks = sum(1 for task in project["tasks"] if task["status"] == "Завершена")
+        total_tasks = len(project.tasks)
+        completed_tasks = ProjectManager.completed_tasks(project)
 
-        projects_text += (
-            f"📁 {project['name']} (ID: {project['id']})\n"
-            f"Статус: {project['status']}\n"
-            f"Задачи: {completed_tasks}/{total_tasks} завершено\n\n"
+        blocks.append(
+            f"📁 {project.name} (ID: {project.id})\n"
+            f"Статус: {project.status}\n"
+            f"Задачи: {completed_tasks}/{total_tasks} завершено\n"
         )
 
-    projects_text += (
-        "Для просмотра задач проекта используйте команду:\n"
-        "/tasks {project_id}"
-    )
+    chunks = split_pages(blocks, PROJECTS_PAGE_SIZE)
+    pages = []
+    for index, chunk in enumerate(chunks):
+        page_title = f" (стр. {index + 1}/{len(chunks)})" if len(chunks) > 1 else ""
+        projects_text = (
+            f"Ваши проекты{page_title}:\n\n"
+            + "\n".join(chunk)
+            + "\nДля просмотра задач проекта используйте команду:\n"
+            "/tasks {project_id}"
+        )
+        pages.append(projects_text[:TELEGRAM_MESSAGE_LIMIT])
+    return pages
+
+
+def render_projects_page(user_id, page):
+    """Текст и клавиатура страницы /my_projects (страницы кешируются по версии данных пользователя)"""
+    user = ProjectManager.get_user(user_id)
+    cache_key = ("projects", user_id, user["version"])
+    pages = page_cache.get(cache_key)
+    if pages is None:
+        pages = build_projects_pages(ProjectManager.get_projects(user_id))
+        page_cache.put(cache_key, pages)
+
+    page = max(0, min(page, len(pages) - 1))
 
     # Создаем кнопки для быстрого доступа к канбан-доске
     keyboard = [
         [InlineKeyboardButton("Открыть канбан-доску", web_app=WebAppInfo(url=WEBAPP_URL))]
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    return pages[page], page_keyboard("projects_page", page, len(pages), keyboard)
+
+
+async def my_projects(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /my_projects"""
+    user_id = update.effective_user.id
+    projects = ProjectManager.get_projects(user_id)
+
+    if not projects:
+        await update.message.reply_text(
+            "У вас еще нет проектов. Создайте первый проект с помощью команды:\n"
+            "/new_project Название проекта"
+        )
+        return
+
+    projects_text, reply_markup = render_projects_page(user_id, 0)
 
     await update.message.reply_text(
         projects_text,
@@ -344,25 +1228,21 @@ async def project_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    total_tasks = len(project["tasks"])
-    tasks_by_status = {}
-
-    for task in project["tasks"]:
-        status = task["status"]
-        if status not in tasks_by_status:
-            tasks_by_status[status] = 0
-        tasks_by_status[status] += 1
+    total_tasks = len(project.tasks)
 
-    status_text = "\n".join(f"- {status}: {count}" for status, count in tasks_by_status.items())
+    # Счетчики по статусам поддерживаются ProjectManager при изменении задач
+    status_text = "\n".join(
+        f"- {status}: {count}" for status, count in project.status_counts.items() if count
+    )
 
     if not status_text:
         status_text = "- Нет задач"
 
     # Формируем информацию о проекте
     project_text = (
-        f"📁 Проект: {project['name']} (ID: {project['id']})\n"
-        f"Статус: {project['status']}\n"
-        f"Создан: {datetime.fromisoformat(project['created_at']).strftime('%d.%m.%Y')}\n\n"
+        f"📁 Проект: {project.name} (ID: {project.id})\n"
+        f"Статус: {project.status}\n"
+        f"Создан: {datetime.fromtimestamp(project.created_at).strftime('%d.%m.%Y')}\n\n"
         f"Всего задач: {total_tasks}\n"
         f"Статусы задач:\n{status_text}\n\n"
         "Команды для управления проектом:\n"
@@ -421,8 +1301,8 @@ async def add_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Создаем клавиатуру для быстрого изменения статуса
     keyboard = [
         [
-            InlineKeyboardButton("В работе", callback_data=f"task_{project_id}_{new_task['id']}_В работе"),
-            InlineKeyboardButton("Завершена", callback_data=f"task_{project_id}_{new_task['id']}_Завершена")
+            InlineKeyboardButton("В работе", callback_data=f"task_{project_id}_{new_task.id}_В работе"),
+            InlineKeyboardButton("Завершена", callback_data=f"task_{project_id}_{new_task.id}_Завершена")
         ],
         [
             InlineKeyboardButton("Открыть канбан", web_app=WebAppInfo(url=f"{WEBAPP_URL}?project_id={project_id}"))
@@ -430,23 +1310,25 @@ async def add_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await update.message.reply_text(
-        f"Задача '{new_task['name']}' успешно добавлена в проект '{project['name']}'!\n"
-        f"ID задачи: {new_task['id']}\n"
-        f"Статус: {new_task['status']}\n\n"
+    outbox = Outbox(context.bot, update.effective_chat.id)
+    outbox.add(
+        f"Задача '{new_task.name}' успешно добавлена в проект '{project.name}'!\n"
+        f"ID задачи: {new_task.id}\n"
+        f"Статус: {new_task.status}\n\n"
         "Вы можете изменить статус задачи:",
         reply_markup=reply_markup
     )
 
     # Проактивное предложение
-    await update.message.reply_text(
+    outbox.add(
         "Хотите установить дедлайн для этой задачи? Если да, используйте команду:\n"
-        f"/set_deadline {project_id} {new_task['id']} ДД.ММ.ГГГГ"
+        f"/set_deadline {project_id} {new_task.id} ДД.ММ.ГГГГ"
     )
+    await outbox.flush()
 
 
 async def tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик команды /tasks {project_id}"""
+    """Обработчик команды /tasks {project_id} [страница]"""
     user_id = update.effective_user.id
 
     # Проверяем аргументы команды
@@ -459,8 +1341,9 @@ async def tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         project_id = int(context.args[0])
+        page = int(context.args[1]) - 1 if len(context.args) > 1 else 0
     except ValueError:
-        await update.message.reply_text("ID проекта должен быть числом.")
+        await update.message.reply_text("ID проекта и номер страницы должны быть числами.")
         return
 
     project = ProjectManager.get_project(user_id, project_id)
@@ -473,46 +1356,15 @@ async def tasks(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    if not project["tasks"]:
+    if not project.tasks:
         await update.message.reply_text(
-            f"В проекте '{project['name']}' еще нет задач. "
+            f"В проекте '{project.name}' еще нет задач. "
             "Добавьте первую задачу с помощью команды:\n"
             f"/add_task {project_id} Название задачи"
         )
         return
 
-    # Группируем задачи по статусам (простая канбан-доска)
-    tasks_by_status = {}
-
-    for task in project["tasks"]:
-        status = task["status"]
-        if status not in tasks_by_status:
-            tasks_by_status[status] = []
-        tasks_by_status[status].append(task)
-
-    # Формируем текст с канбан-доской
-    tasks_text = f"📋 Задачи проекта '{project['name']}':\n\n"
-
-    for status, tasks_list in tasks_by_status.items():
-        tasks_text += f"== {status} ==\n"
-        for task in tasks_list:
-            deadline_text = ""
-            if task.get("deadline"):
-                deadline_text = f" (до {task['deadline']})"
-
-            tasks_text += f"• {task['name']} (ID: {task['id']}){deadline_text}\n"
-        tasks_text += "\n"
-
-    tasks_text += (
-        "Для изменения статуса задачи используйте команду:\n"
-        f"/move_task {project_id} [task_id] [новый статус]"
-    )
-
-    # Создаем кнопку для открытия канбан-доски
-    keyboard = [
-        [InlineKeyboardButton("Открыть канбан-доску", web_app=WebAppInfo(url=f"{WEBAPP_URL}?project_id={project_id}"))]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    tasks_text, reply_markup = render_tasks_page(user_id, project, page)
 
     await update.message.reply_text(
         tasks_text,
@@ -539,7 +1391,13 @@ async def move_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("ID проекта и ID задачи должны быть числами.")
         return
 
-    new_status = " ".join(context.args[2:])
+    new_status = TaskStatus.parse(" ".join(context.args[2:]))
+    if new_status is None:
+        await update.message.reply_text(
+            "Неизвестный статус. Возможные статусы: "
+            + ", ".join(status.value for status in TaskStatus)
+        )
+        return
 
     # Обновляем статус задачи
     success = ProjectManager.update_task_status(user_id, project_id, task_id, new_status)
@@ -551,30 +1409,30 @@ async def move_task(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    await update.message.reply_text(
-        f"Статус задачи успешно изменен на '{new_status}'."
-    )
+    outbox = Outbox(context.bot, update.effective_chat.id)
+    outbox.add(f"Статус задачи успешно изменен на '{new_status}'.")
 
     # Проактивное напоминание
     project = ProjectManager.get_project(user_id, project_id)
-    if new_status == "Завершена" and project:
-        remaining_tasks = sum(1 for task in project["tasks"] if task["status"] != "Завершена")
+    if new_status == TaskStatus.DONE and project:
+        remaining_tasks = len(project.tasks) - ProjectManager.completed_tasks(project)
         if remaining_tasks > 0:
             keyboard = [
                 [InlineKeyboardButton("Открыть канбан-доску", web_app=WebAppInfo(url=f"{WEBAPP_URL}?project_id={project_id}"))]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
 
-            await update.message.reply_text(
-                f"Отлично! В проекте '{project['name']}' осталось еще {remaining_tasks} незавершенных задач. "
+            outbox.add(
+                f"Отлично! В проекте '{project.name}' осталось еще {remaining_tasks} незавершенных задач. "
                 "Хотите просмотреть их на канбан-доске?",
                 reply_markup=reply_markup
             )
         else:
-            await update.message.reply_text(
-                f"Поздравляю! Все задачи в проекте '{project['name']}' завершены! "
+            outbox.add(
+                f"Поздравляю! Все задачи в проекте '{project.name}' завершены! "
                 "Хотите обновить статус проекта на 'Завершен'?"
             )
+    await outbox.flush()
 
 
 async def set_deadline(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -597,6 +1455,14 @@ async def set_deadline(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     deadline = context.args[2]
+    day = parse_deadline(deadline)
+
+    if day is None:
+        await update.message.reply_text(
+            "Дата дедлайна должна быть в формате ДД.ММ.ГГГГ. Например:\n"
+            "/set_deadline 1 2 31.12.2025"
+        )
+        return
 
     project = ProjectManager.get_project(user_id, project_id)
 
@@ -607,14 +1473,7 @@ async def set_deadline(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Ищем задачу и устанавливаем дедлайн
-    task_found = False
-    for task in project["tasks"]:
-        if task["id"] == task_id:
-            task["deadline"] = deadline
-            task_found = True
-            break
-
-    if not task_found:
+    if not ProjectManager.update_task(user_id, project_id, task_id, {"deadline": day.toordinal()}):
         await update.message.reply_text(
             f"Задача с ID {task_id} не найдена в проекте."
         )
@@ -632,6 +1491,193 @@ async def set_deadline(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /search {запрос}"""
+    user_id = update.effective_user.id
+
+    if not context.args:
+        await update.message.reply_text(
+            "Пожалуйста, укажите, что искать. Например:\n"
+            "/search дизайн\n"
+            "/search макет* статус:в_работе до:31.12.2025\n\n"
+            "Слово со звездочкой ищется по началу, статус и сроки задаются "
+            "фильтрами статус:, до: и после:."
+        )
+        return
+
+    query, error = SearchQuery.parse(" ".join(context.args))
+    if error:
+        await update.message.reply_text(f"Не удалось разобрать запрос: {error}.")
+        return
+
+    results = ProjectManager.search_tasks(user_id, query)
+    if not results:
+        await update.message.reply_text("Ничего не найдено.")
+        return
+
+    lines = [f"Найдено задач: {len(results)}" + (" (показаны первые)" if len(results) == SEARCH_RESULTS_LIMIT else ""), ""]
+    for project, task in results:
+        deadline = f", до {format_deadline(task.deadline)}" if task.deadline is not None else ""
+        lines.append(f"• {task.name} (ID: {task.id}) — {task.status}{deadline}\n"
+                     f"  Проект: {project.name} (ID: {project.id})")
+
+    await update.message.reply_text("\n".join(lines)[:TELEGRAM_MESSAGE_LIMIT])
+
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /export [ndjson|csv]"""
+    user_id = update.effective_user.id
+
+    fmt = context.args[0].lower() if context.args else "ndjson"
+    if fmt not in FORMATS:
+        await update.message.reply_text(
+            "Поддерживаются форматы ndjson и csv. Например:\n"
+            "/export csv"
+        )
+        return
+
+    user = ProjectManager.get_user(user_id)
+    if not user or not user["projects"]:
+        await update.message.reply_text("У вас пока нет проектов для выгрузки.")
+        return
+
+    # Выгрузка пишется кусками во временный файл, а между кусками обработчик
+    # отдает управление, чтобы большая выгрузка не задерживала других пользователей
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE) as file:
+        for chunk in export_chunks(user, fmt):
+            file.write(chunk)
+            await asyncio.sleep(0)
+        file.seek(0)
+        await update.message.reply_document(
+            document=file,
+            filename=f"projects-{datetime.now():%Y-%m-%d}.{fmt}",
+            caption=(
+                "Ваши проекты и задачи. Файл можно загрузить обратно командой /import: "
+                "задачи, которые уже есть, пропускаются, а «/import новые» создаст копии проектов."
+            )
+        )
+
+
+def import_options(args):
+    """Режимы импорта из аргументов /import: (только проверка, все проекты как новые)"""
+    options = {arg.lower() for arg in args}
+    return bool(options & {"dry", "проверка"}), bool(options & {"new", "новые"})
+
+
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /import [проверка] [новые]: импортирует файл из сообщения, на которое дан ответ"""
+    message = update.message
+    if message.reply_to_message and message.reply_to_message.document:
+        await import_document(update, message.reply_to_message.document, *import_options(context.args or []))
+        return
+
+    await message.reply_text(
+        "Отправьте файл NDJSON или CSV (как его выгружает /export) с подписью /import. "
+        "Обязательна колонка project_name; задачи без task_name не создаются, "
+        "дедлайн — в формате ДД.ММ.ГГГГ.\n\n"
+        "Задачи, которые уже есть в ваших проектах (по project_id и task_id из файла), "
+        "пропускаются. С подписью «/import новые» все проекты файла создаются заново, "
+        "с «/import проверка» файл только проверяется, без изменений."
+    )
+
+
+async def import_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик файла с подписью /import [проверка] [новые]"""
+    args = update.message.caption.split()[1:]
+    await import_document(update, update.message.document, *import_options(args))
+
+
+async def import_document(update: Update, document, dry_run, as_new=False):
+    """Загрузить файл импорта и применить его одной пакетной операцией"""
+    user_id = update.effective_user.id
+
+    if document.file_size and document.file_size > IMPORT_MAX_BYTES:
+        await update.message.reply_text(
+            f"Файл слишком большой: не больше {IMPORT_MAX_BYTES // (1024 * 1024)} МБ."
+        )
+        return
+
+    with tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE) as file:
+        telegram_file = await document.get_file()
+        await telegram_file.download_to_memory(out=file)
+        file.seek(0)
+        fmt = detect_format(document.file_name, file.read(64).decode("utf-8", "ignore"))
+        file.seek(0)
+
+        text = io.TextIOWrapper(file, encoding="utf-8-sig", newline="")
+        try:
+            counts, error = ProjectManager.import_records(user_id, read_records(text, fmt), dry_run, as_new)
+        except UnicodeDecodeError:
+            counts, error = None, "файл должен быть в кодировке UTF-8"
+        finally:
+            text.detach()
+
+    if error:
+        await update.message.reply_text(f"Файл не импортирован: {error}.")
+        return
+
+    summary = f"новых проектов: {counts['projects']}, задач: {counts['tasks']}"
+    if counts["skipped"]:
+        summary += f" (уже есть и пропущено задач: {counts['skipped']})"
+    if dry_run:
+        await update.message.reply_text(
+            f"Проверка пройдена, будет импортировано {summary}. "
+            "Чтобы импортировать, отправьте файл с подписью /import"
+            + (" новые." if as_new else ".")
+        )
+        return
+
+    await update.message.reply_text(
+        f"Импорт завершен: {summary}.\n"
+        "Посмотреть проекты можно командой /my_projects"
+    )
+
+
+async def digest_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /digest [час|off] [смещение от UTC]"""
+    user_id = update.effective_user.id
+
+    if not context.args:
+        user = ProjectManager.get_user(user_id)
+        settings = user["settings"] if user else {}
+        if "digest_hour" in settings:
+            await update.message.reply_text(
+                f"Сводка по проектам приходит каждый день в {settings['digest_hour']}:00 "
+                f"({format_utc_offset(settings['utc_offset'])}).\n"
+                "Изменить время: /digest 8 +5\n"
+                "Выключить: /digest off"
+            )
+        else:
+            await update.message.reply_text(
+                "Ежедневная сводка по проектам выключена. Включить:\n"
+                f"/digest {DIGEST_HOUR} {DIGEST_UTC_OFFSET} — в {DIGEST_HOUR}:00 по времени UTC{DIGEST_UTC_OFFSET}"
+            )
+        return
+
+    if context.args[0].lower() in ("off", "выкл"):
+        ProjectManager.set_digest(user_id, None)
+        await update.message.reply_text("Ежедневная сводка выключена.")
+        return
+
+    try:
+        hour = int(context.args[0])
+    except ValueError:
+        hour = -1
+    utc_offset = parse_utc_offset(context.args[1] if len(context.args) > 1 else DIGEST_UTC_OFFSET)
+    if not 0 <= hour <= 23 or utc_offset is None:
+        await update.message.reply_text(
+            "Укажите час от 0 до 23 и, если нужно, смещение часового пояса от UTC. Например:\n"
+            "/digest 9 +3"
+        )
+        return
+
+    ProjectManager.set_digest(user_id, hour, utc_offset)
+    await update.message.reply_text(
+        f"Готово! Сводка по проектам будет приходить каждый день в {hour}:00 "
+        f"({format_utc_offset(utc_offset)}), если в проектах что-то изменилось."
+    )
+
+
 async def kanban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /kanban - открывает канбан-доску"""
     user_id = update.effective_user.id
@@ -646,7 +1692,7 @@ async def kanban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Если есть только один проект, открываем его канбан-доску
     if len(projects) == 1:
-        project_id = projects[0]["id"]
+        project_id = projects[0].id
         kanban_button = InlineKeyboardButton(
             text="Открыть канбан-доску",
             web_app=WebAppInfo(url=f"{WEBAPP_URL}?project_id={project_id}")
@@ -654,7 +1700,7 @@ async def kanban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         keyboard = InlineKeyboardMarkup([[kanban_button]])
 
         await update.message.reply_text(
-            f"Нажмите на кнопку ниже, чтобы открыть канбан-доску для проекта '{projects[0]['name']}':",
+            f"Нажмите на кнопку ниже, чтобы открыть канбан-доску для проекта '{projects[0].name}':",
             reply_markup=keyboard
         )
     else:
@@ -664,8 +1710,8 @@ async def kanban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         for project in projects:
             keyboard.append([
                 InlineKeyboardButton(
-                    text=f"{project['name']}",
-                    web_app=WebAppInfo(url=f"{WEBAPP_URL}?project_id={project['id']}")
+                    text=f"{project.name}",
+                    web_app=WebAppInfo(url=f"{WEBAPP_URL}?project_id={project.id}")
                 )
             ])
 
@@ -689,37 +1735,36 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         try:
             project_id = int(data[1])
             task_id = int(data[2])
-            new_status = "_".join(data[3:])
+            new_status = TaskStatus.parse("_".join(data[3:]))
 
             user_id = update.effective_user.id
 
-            success = ProjectManager.update_task_status(user_id, project_id, task_id, new_status)
+            success = new_status is not None and ProjectManager.update_task_status(
+                user_id, project_id, task_id, new_status
+            )
 
             if success:
-                await query.edit_message_text(
-                    text=f"Статус задачи успешно изменен на '{new_status}'."
-                )
+                # Подтверждение заменяет сообщение с кнопкой, а проактивное
+                # сообщение дописывается в него же
+                outbox = Outbox(context.bot, update.effective_chat.id, query=query)
+                outbox.add(f"Статус задачи успешно изменен на '{new_status}'.")
 
-                # Отправляем проактивное сообщение
                 project = ProjectManager.get_project(user_id, project_id)
-                if new_status == "Завершена" and project:
-                    remaining_tasks = sum(1 for task in project["tasks"] if task["status"] != "Завершена")
+                if new_status == TaskStatus.DONE and project:
+                    remaining_tasks = len(project.tasks) - ProjectManager.completed_tasks(project)
                     if remaining_tasks > 0:
                         keyboard = [
                             [InlineKeyboardButton("Открыть канбан-доску", web_app=WebAppInfo(url=f"{WEBAPP_URL}?project_id={project_id}"))]
                         ]
                         reply_markup = InlineKeyboardMarkup(keyboard)
 
-                        await context.bot.send_message(
-                            chat_id=update.effective_chat.id,
-                            text=f"Отлично! В проекте '{project['name']}' осталось еще {remaining_tasks} незавершенных задач.",
+                        outbox.add(
+                            f"Отлично! В проекте '{project.name}' осталось еще {remaining_tasks} незавершенных задач.",
                             reply_markup=reply_markup
                         )
                     else:
-                        await context.bot.send_message(
-                            chat_id=update.effective_chat.id,
-                            text=f"Поздравляю! Все задачи в проекте '{project['name']}' завершены!"
-                        )
+                        outbox.add(f"Поздравляю! Все задачи в проекте '{project.name}' завершены!")
+                await outbox.flush()
             else:
                 await context.bot.send_message(
                     chat_id=update.effective_chat.id,
@@ -730,6 +1775,34 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 chat_id=update.effective_chat.id,
                 text="Произошла ошибка при обработке запроса."
             )
+    elif len(data) >= 4 and data[0] == "tasks" and data[1] == "page":
+        # Переход между страницами /tasks
+        try:
+            project_id = int(data[2])
+            page = int(data[3])
+
+            project = ProjectManager.get_project(update.effective_user.id, project_id)
+            if project and project.tasks:
+                tasks_text, reply_markup = render_tasks_page(update.effective_user.id, project, page)
+                await query.edit_message_text(text=tasks_text, reply_markup=reply_markup)
+        except ValueError:
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text="Произошла ошибка при обработке запроса."
+            )
+    elif len(data) >= 3 and data[0] == "projects" and data[1] == "page":
+        # Переход между страницами /my_projects
+        try:
+            page = int(data[2])
+
+            if ProjectManager.get_projects(update.effective_user.id):
+                projects_text, reply_markup = render_projects_page(update.effective_user.id, page)
+                await query.edit_message_text(text=projects_text, reply_markup=reply_markup)
+        except ValueError:
+            await context.bot.send_message(
+                chat_id=update.effective_chat.id,
+                text="Произошла ошибка при обработке запроса."
+            )
     elif len(data) >= 2 and data[0] == "add_task":
         # Обработка нажатия на кнопку добавления задачи
         try:
@@ -768,14 +1841,57 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
 
 
-async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработчик обычных сообщений"""
-    user_id = update.effective_user.id
-    message_text = update.message.text
+class StreamingReply:
+    """Сообщение, которое постепенно дописывается по мере генерации ответа ИИ.
 
-    # Генерируем ответ от ИИ
-    ai_response = await ProjectManager.generate_ai_response(user_id, message_text)
+    Правки отправляются не чаще одной за interval секунд и только если текст
+    изменился; при RetryAfter следующая правка откладывается на указанное
+    Telegram время.
+    """
 
+    def __init__(self, message, interval):
+        self.message = message
+        self.interval = interval
+        self._parts = []
+        self._shown = message.text
+        self._next_edit = time.monotonic()
+
+    async def add(self, delta):
+        """Добавить фрагмент ответа и при необходимости обновить сообщение"""
+        self._parts.append(delta)
+        if time.monotonic() >= self._next_edit:
+            await self._edit("".join(self._parts) + " ▌")
+
+    async def finish(self, text):
+        """Показать окончательный текст ответа"""
+        while not await self._edit(text):
+            await asyncio.sleep(max(self._next_edit - time.monotonic(), 0))
+
+    async def _edit(self, text):
+        """Отредактировать сообщение; возвращает False, если нужно повторить позже"""
+        text = text[:TELEGRAM_MESSAGE_LIMIT]
+        if not text.strip() or text == self._shown:
+            return True
+
+        try:
+            await self.message.edit_text(text)
+            self._shown = text
+        except RetryAfter as e:
+            retry_after = e.retry_after
+            if hasattr(retry_after, "total_seconds"):
+                retry_after = retry_after.total_seconds()
+            self._next_edit = time.monotonic() + retry_after
+            return False
+        except BadRequest as e:
+            # "Message is not modified" и подобные ошибки не мешают ответу
+            logger.warning(f"Не удалось обновить сообщение с ответом ИИ: {e}")
+
+        self._next_edit = time.monotonic() + self.interval
+        return True
+
+
+def add_action_hints(user_id, ai_response):
+    """Добавляет к ответу ИИ подсказки с командами бота"""
     # Анализируем ответ ИИ для выявления потенциальных действий
     if "создать проект" in ai_response.lower():
         # Добавляем подсказку о команде создания проекта
@@ -785,7 +1901,7 @@ async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Добавляем подсказку о команде создания задачи
         projects = ProjectManager.get_projects(user_id)
         if projects:
-            project_id = projects[0]["id"]
+            project_id = projects[0].id
             ai_response += f"\n\nВы можете добавить задачу с помощью команды:\n/add_task {project_id} Название задачи"
         else:
             ai_response += "\n\nСначала создайте проект с помощью команды:\n/new_project Название проекта"
@@ -794,7 +1910,85 @@ async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Добавляем подсказку о канбан-доске
         ai_response += "\n\nВы можете открыть канбан-доску с помощью команды:\n/kanban"
 
-    await update.message.reply_text(ai_response)
+    return ai_response
+
+
+async def route_intent(update: Update, context: ContextTypes.DEFAULT_TYPE, message_text):
+    """Выполняет команду, распознанную в тексте сообщения; False, если команды нет"""
+    intent = intent_router.classify(message_text)
+    if intent is None:
+        return False
+
+    handlers = {
+        "new_project": new_project,
+        "my_projects": my_projects,
+        "tasks": tasks,
+        "add_task": add_task,
+        "move_task": move_task,
+        "search": search,
+        "kanban": kanban_command,
+        "help": help_command,
+    }
+    logger.info(f"Сообщение обработано как /{intent.name} (уверенность {intent.confidence:.2f})")
+    context.args = intent.args
+    await handlers[intent.name](update, context)
+    return True
+
+
+async def process_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик обычных сообщений"""
+    user_id = update.effective_user.id
+    message_text = update.message.text
+
+    # Сообщения, в которых распознана команда, обрабатываем без запроса к ИИ
+    if INTENT_ROUTING and await route_intent(update, context, message_text):
+        return
+
+    if not AI_STREAMING:
+        # Генерируем ответ от ИИ
+        ai_response = await ProjectManager.generate_ai_response(user_id, message_text)
+        await update.message.reply_text(add_action_hints(user_id, ai_response))
+        return
+
+    # Сразу отвечаем заглушкой и дописываем ее по мере генерации ответа
+    placeholder = await update.message.reply_text("Думаю…")
+    reply = StreamingReply(placeholder, AI_STREAM_EDIT_INTERVAL)
+
+    ai_response = await ProjectManager.generate_ai_response(user_id, message_text, on_delta=reply.add)
+    await reply.finish(add_action_hints(user_id, ai_response))
+
+
+async def apply_web_app_batch(update: Update, data):
+    """Применяет пакет изменений из мини-приложения и отправляет итоговое сообщение"""
+    user_id = update.effective_user.id
+
+    if data.get("version") != WEBAPP_BATCH_VERSION or not isinstance(data["actions"], list):
+        await update.message.reply_text(
+            "Канбан-доска отправила данные в неподдерживаемом формате. Обновите доску и попробуйте еще раз."
+        )
+        return
+
+    base_version = data.get("baseVersion") or None
+    counts, error = ProjectManager.apply_batch(user_id, data["actions"], base_version)
+
+    if error:
+        await update.message.reply_text(
+            f"Изменения с канбан-доски не применены: {error}.\n"
+            "Откройте доску заново и повторите изменения."
+        )
+        return
+
+    summary_lines = []
+    if counts["createTask"]:
+        summary_lines.append(f"• Создано задач: {counts['createTask']}")
+    if counts["statusUpdate"]:
+        summary_lines.append(f"• Изменен статус задач: {counts['statusUpdate']}")
+    if counts["updateTask"]:
+        summary_lines.append(f"• Обновлено задач: {counts['updateTask']}")
+
+    await update.message.reply_text(
+        f"Изменения с канбан-доски сохранены ({sum(counts.values())}):\n" + "\n".join(summary_lines)
+    )
 
 
 async def web_app_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -813,13 +2007,17 @@ async def web_app_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.info(f"Получены данные из веб-приложения: {data}")
 
         # Обрабатываем различные типы данных из приложения
-        if data.get("action") == "statusUpdate":
+        if "actions" in data:
+            # Пакет изменений с доски: применяем целиком и отвечаем одним сообщением
+            await apply_web_app_batch(update, data)
+        elif data.get("action") == "statusUpdate":
             # Обновляем статус задачи в базе данных
-            if ProjectManager.update_task_status(
+            new_status = TaskStatus.parse(data["status"])
+            if new_status is not None and ProjectManager.update_task_status(
                 user_id,
                 int(data["projectId"]),
                 int(data["id"]),
-                data["status"]
+                new_status
             ):
                 await update.message.reply_text(
                     f"Статус задачи обновлен на '{data['status']}'."
@@ -837,8 +2035,8 @@ async def web_app_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 {
                     "name": data["name"],
                     "description": data.get("description", ""),
-                    "status": data.get("status", "В работе"),
-                    "deadline": data.get("deadline")
+                    "status": TaskStatus.parse(data.get("status")) or TaskStatus.IN_PROGRESS,
+                    "deadline": deadline_ordinal(data.get("deadline") or None)
                 }
             ):
                 await update.message.reply_text(
@@ -855,7 +2053,7 @@ async def web_app_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 int(data["projectId"]),
                 data["name"],
                 data.get("description", ""),
-                data.get("deadline")
+                deadline_ordinal(data.get("deadline") or None)
             )
 
             if new_task:
@@ -873,34 +2071,405 @@ async def web_app_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
 
-def main():
-    """Запуск бота"""
-    # Создаем приложение
-    application = Application.builder().token(BOT_TOKEN).build()
-
-    # Добавляем обработчики команд
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("new_project", new_project))
-    application.add_handler(CommandHandler("my_projects", my_projects))
-    application.add_handler(CommandHandler("project", project_info))
-    application.add_handler(CommandHandler("add_task", add_task))
-    application.add_handler(CommandHandler("tasks", tasks))
-    application.add_handler(CommandHandler("move_task", move_task))
-    application.add_handler(CommandHandler("set_deadline", set_deadline))
-    application.add_handler(CommandHandler("kanban", kanban_command))
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Параллельная обработка обновлений с сохранением порядка для каждого пользователя.
+
+    Обновления разных пользователей обрабатываются параллельно (не больше
+    max_concurrent_updates одновременно). Если у пользователя уже идет
+    обработка, новое обновление ставится в его очередь и выполняется после
+    предыдущих, не занимая отдельного слота.
+    """
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._queues = {}
+
+    async def do_process_update(self, update, coroutine):
+        startup.mark("first_update", "Получено первое обновление")
+        key = self._ordering_key(update)
+        if key is None:
+            with metrics.update_in_flight():
+                await coroutine
+            return
+
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(coroutine)
+            metrics.update_queued(1)
+            return
+
+        queue = self._queues[key] = deque([coroutine])
+        try:
+            first = True
+            while queue:
+                if not first:
+                    metrics.update_queued(-1)
+                first = False
+                try:
+                    with metrics.update_in_flight():
+                        await queue.popleft()
+                except Exception as e:
+                    logger.error(f"Ошибка при обработке обновления: {e}")
+        finally:
+            del self._queues[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def is_busy(self, key):
+        """Есть ли у пользователя (или чата) необработанные обновления"""
+        return key in self._queues
+
+    @staticmethod
+    def _ordering_key(update):
+        """Ключ очереди: пользователь, а если его нет — чат"""
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
+
+
+async def send_deadline_reminders(context: ContextTypes.DEFAULT_TYPE):
+    """Рассылает наступившие напоминания о дедлайнах, по одному сообщению на пользователя"""
+    reminders_by_user = {}
+    for user_id, project_id, task_id, due_date in deadline_scheduler.pop_due():
+        reminders_by_user.setdefault(user_id, []).append((project_id, task_id, due_date))
+
+    for user_id, reminders in reminders_by_user.items():
+        lines = []
+        for project_id, task_id, due_date in sorted(reminders, key=lambda item: item[2]):
+            project = ProjectManager.get_project(user_id, project_id)
+            task = ProjectManager.get_task(user_id, project_id, task_id)
+            if not task:
+                continue
+            lines.append(
+                f"• {task.name} (проект '{project.name}', ID задачи: {task_id}) "
+                f"— до {format_deadline(due_date)}"
+            )
+
+        if not lines:
+            continue
+
+        reminder_text = "⏰ Приближаются дедлайны:\n\n" + "\n".join(lines)
+        try:
+            await context.bot.send_message(chat_id=user_id, text=reminder_text[:TELEGRAM_MESSAGE_LIMIT])
+        except Exception as e:
+            logger.error(f"Не удалось отправить напоминание пользователю {user_id}: {e}")
+
+
+async def send_digests(context: ContextTypes.DEFAULT_TYPE):
+    """Ставит в очередь наступившие сводки и запускает их отправку, если она не идет"""
+    digest_backlog.extend(digest_scheduler.pop_due(datetime.now(timezone.utc)))
+    if not digest_backlog or digest_tasks:
+        return
+
+    # Фоновая задача, а не ожидание в задаче JobQueue: рассылка десятков тысяч
+    # сводок длится дольше интервала проверки
+    task = asyncio.create_task(run_digests(context.bot))
+    digest_tasks.add(task)
+    task.add_done_callback(digest_tasks.discard)
+
+
+async def run_digests(bot):
+    """Отправляет сводки из очереди не больше чем DIGEST_MAX_CONCURRENT одновременно"""
+    sent = skipped = 0
+
+    async def worker():
+        nonlocal sent, skipped
+        while digest_backlog:
+            # Пока ответов ИИ ждут пользователи, новые сводки не запрашиваются
+            while openai_scheduler.waiting(PRIORITY_INTERACTIVE):
+                await asyncio.sleep(0.5)
+            user_id, today = digest_backlog.popleft()
+            try:
+                if await ProjectManager.send_digest(bot, user_id, today):
+                    sent += 1
+                else:
+                    skipped += 1
+            except Exception as e:
+                logger.error(f"Не удалось отправить сводку пользователю {user_id}: {e}")
+
+    started = time.monotonic()
+    await asyncio.gather(*(worker() for _ in range(DIGEST_MAX_CONCURRENT)))
+    logger.info(f"Сводки отправлены за {time.monotonic() - started:.1f} с: "
+                f"отправлено {sent}, без изменений {skipped}")
+
+
+async def flush_storage(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически записывает накопленные изменения в хранилище"""
+    storage.flush()
+
+
+async def compact_storage(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически сжимает данные хранилища на диске (снимок журнала)"""
+    await storage.compact()
+
+
+async def collect_metrics(context: ContextTypes.DEFAULT_TYPE):
+    """Периодически обновляет метрики, для которых нужен доступ к хранилищу"""
+    metrics.set_entities(storage.count_entities())
+
+
+def metric_sources():
+    """Счетчики ограничителя сообщений, планировщика OpenAI и кешей для /metrics"""
+    scheduler_stats = openai_scheduler.stats()
+    cache_stats = response_cache.stats()
+    return [
+        ("bot_outbound_retries", "counter", "Повторы исходящих запросов к Bot API после 429",
+         rate_limiter.retries),
+        ("bot_outbound_failures", "counter", "Неудачные исходящие запросы к Bot API",
+         rate_limiter.failures),
+        ("bot_openai_retries", "counter", "Повторы запросов к OpenAI", scheduler_stats["retries"]),
+        ("bot_openai_hedges", "counter", "Дублирующие запросы к OpenAI", scheduler_stats["hedges"]),
+        ("bot_openai_failures", "counter", "Запросы к OpenAI, завершившиеся ошибкой",
+         scheduler_stats["failures"]),
+        ("bot_openai_queue_waiting", "gauge", "Запросы к OpenAI в очереди планировщика",
+         {lane: stats["waiting"] for lane, stats in scheduler_stats["wait"].items()}),
+        ("bot_openai_queue_wait_p95_seconds", "gauge", "95-й перцентиль ожидания в очереди OpenAI",
+         {lane: stats["p95"] for lane, stats in scheduler_stats["wait"].items()}),
+        ("bot_intent_routed", "counter", "Сообщения, обработанные без ИИ, по командам",
+         dict(intent_router.routed)),
+        ("bot_intent_fallbacks", "counter", "Сообщения, отданные ИИ", intent_router.fallbacks),
+        ("bot_ai_cache", "gauge", "Кеш ответов ИИ",
+         {key: cache_stats[key] for key in ("size", "hits", "misses", "evictions")}),
+        ("bot_startup_seconds", "gauge", "Время этапов запуска от старта процесса",
+         startup.stages()),
+    ]
+
+
+async def deferred_init(context: ContextTypes.DEFAULT_TYPE):
+    """Инициализация, которая не нужна для первого ответа пользователю.
+
+    Выполняется первой задачей JobQueue, а не в post_init, чтобы не
+    задерживать начало обработки обновлений: HTTP-клиент OpenAI (создание
+    TLS-контекста), восстановление напоминаний о дедлайнах обходом всех
+    задач хранилища (напоминания все равно проверяются раз в
+    REMINDER_CHECK_INTERVAL секунд) и подписок на сводки.
+    """
+    openai_client.start()
+
+    # Наступившие напоминания уже отправлены до перезапуска
+    for user_id, project_id, task_id, deadline, status in storage.iter_deadlines():
+        deadline_scheduler.schedule(user_id, project_id, task_id, deadline, status, skip_due=True)
+    logger.info(f"Запланировано напоминаний о дедлайнах: {len(deadline_scheduler)}")
+
+    for user_id, settings in storage.iter_settings():
+        ProjectManager.schedule_digest(user_id, settings)
+    logger.info(f"Подписчиков на ежедневные сводки: {len(digest_scheduler)}")
+
+
+async def post_init(application: Application):
+    """Инициализация после запуска приложения"""
+    if WEBAPP_API_PORT:
+        await webapp_api.start()
+
+    if METRICS_PORT and metrics.start(METRICS_HOST, METRICS_PORT):
+        metrics.add_source(metric_sources)
+
+    if application.job_queue:
+        application.job_queue.run_once(deferred_init, 0)
+        application.job_queue.run_repeating(flush_storage, interval=STORAGE_FLUSH_INTERVAL)
+        application.job_queue.run_repeating(compact_storage, interval=STORAGE_SNAPSHOT_INTERVAL)
+        application.job_queue.run_repeating(send_deadline_reminders, interval=REMINDER_CHECK_INTERVAL)
+        application.job_queue.run_repeating(send_digests, interval=DIGEST_CHECK_INTERVAL)
+        if metrics.enabled:
+            # Первый подсчет сущностей — сразу после запуска, но не в post_init
+            application.job_queue.run_repeating(collect_metrics, interval=METRICS_INTERVAL, first=0)
+    else:
+        logger.warning("JobQueue недоступна (нужен python-telegram-bot[job-queue]), "
+                       "напоминания о дедлайнах отключены")
+
+    startup.mark("ready", "Бот готов к работе")
+
+
+async def post_shutdown(application: Application):
+    """Освобождение ресурсов при остановке приложения"""
+    logger.info(f"Пул соединений OpenAI при остановке: {openai_client.pool_stats()}")
+    logger.info(f"Кеш ответов ИИ при остановке: {response_cache.stats()}")
+    logger.info(f"Планировщик запросов OpenAI при остановке: {openai_scheduler.stats()}")
+    logger.info(f"Исходящие сообщения: повторов после 429 — {rate_limiter.retries}, "
+                f"ошибок — {rate_limiter.failures}")
+    # Неотправленные сводки уйдут после перезапуска, пока не закончилось их окно
+    for task in list(digest_tasks):
+        task.cancel()
+    await openai_client.close()
+    await webapp_api.stop()
+    storage.close()
+
+
+def build_application(request=None):
+    """Создает приложение со всеми обработчиками.
+
+    request позволяет подменить транспорт Bot API (например, в benchmark.py).
+    Здесь же открывается хранилище, если оно еще не открыто.
+    """
+    global storage
+    if storage is None:
+        storage = open_storage()
+
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .rate_limiter(rate_limiter)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if request is not None:
+        builder = builder.request(request)
+    application = builder.build()
+
+    # Добавляем обработчики команд; время работы каждого обработчика попадает в метрики
+    commands = [
+        ("start", start),
+        ("help", help_command),
+        ("new_project", new_project),
+        ("my_projects", my_projects),
+        ("project", project_info),
+        ("add_task", add_task),
+        ("tasks", tasks),
+        ("move_task", move_task),
+        ("set_deadline", set_deadline),
+        ("search", search),
+        ("kanban", kanban_command),
+        ("export", export_command),
+        ("import", import_command),
+        ("digest", digest_command),
+    ]
+    for command, callback in commands:
+        application.add_handler(CommandHandler(command, metrics.instrument(command, callback)))
 
     # Обработчик нажатий на кнопки
-    application.add_handler(CallbackQueryHandler(button_handler))
+    application.add_handler(CallbackQueryHandler(metrics.instrument("button_handler", button_handler)))
 
     # Обработчик данных из веб-приложения
-    application.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, web_app_data))
+    application.add_handler(MessageHandler(
+        filters.StatusUpdate.WEB_APP_DATA, metrics.instrument("web_app_data", web_app_data)
+    ))
+
+    # Файл импорта приходит документом с подписью /import
+    application.add_handler(MessageHandler(
+        filters.Document.ALL & filters.CaptionRegex(r"^/import\b"), metrics.instrument("import_file", import_file)
+    ))
 
     # Обработчик обычных сообщений
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, process_message))
+    application.add_handler(MessageHandler(
+        filters.TEXT & ~filters.COMMAND, metrics.instrument("process_message", process_message)
+    ))
+
+    return application
+
+
+def run_application(application):
+    """Получение обновлений в режиме BOT_MODE до остановки бота"""
+    if BOT_MODE == "webhook":
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
+
+
+def worker_environ(worker_id, worker_count):
+    """Переменные окружения рабочего процесса кластера"""
+    return {
+        "STORAGE_PATH": f"{STORAGE_PATH}.worker{worker_id}",
+        # API канбан-доски обслуживает фронт-процесс
+        "WEBAPP_API_PORT": "0",
+        "METRICS_PORT": str(METRICS_PORT + 1 + worker_id) if METRICS_PORT else "0",
+        "SEND_GLOBAL_RATE": str(SEND_GLOBAL_RATE / worker_count),
+        "OPENAI_MAX_CONCURRENT": str(max(1, OPENAI_MAX_CONCURRENT // worker_count)),
+        "OPENAI_RPM": str(max(1, OPENAI_RPM // worker_count)),
+        "OPENAI_TPM": str(max(1, OPENAI_TPM // worker_count)),
+    }
+
+
+def run_worker():
+    """Запуск рабочего процесса кластера: обновления приходят от фронт-процесса"""
+    from cluster import serve_worker
+
+    application = build_application()
+    methods = {
+        "get_user": ProjectManager.get_user,
+        # Проект передается без задач: для результатов поиска нужен только его ID
+        "search_tasks": lambda user_id, query, limit: [
+            (project.without_tasks(), task)
+            for project, task in ProjectManager.search_tasks(user_id, query, limit)
+        ],
+        "count_entities": storage.count_entities,
+        "user_ids": lambda: list(storage.user_ids()),
+        "export_user": ProjectManager.export_user,
+        "import_user": ProjectManager.import_user,
+        "drop_user": ProjectManager.drop_user,
+        "is_busy": lambda user_id: application.update_processor.is_busy(user_id) or user_id in summary_tasks,
+        "flush": storage.flush,
+    }
+    asyncio.run(serve_worker(
+        int(BOT_WORKER_ID), BOT_FRONT_SOCKET, application, post_init, post_shutdown, methods,
+    ))
+
+
+def run_cluster():
+    """Запуск фронт-процесса, раздающего обновления BOT_WORKERS рабочим процессам"""
+    from cluster import Cluster, find_worker_ids
+
+    cluster = Cluster([sys.executable, os.path.abspath(__file__)], BOT_WORKERS, worker_environ)
+    webapp_api.get_user = cluster.get_user
+    webapp_api.search_tasks = cluster.search_tasks
+
+    async def forward(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        await cluster.dispatch(update)
+
+    async def start_cluster(application: Application):
+        # Хранилища процессов, которых больше нет в конфигурации, тоже
+        # открываются: их пользователи передаются оставшимся процессам
+        stored = find_worker_ids(STORAGE_PATH) if STORAGE_BACKEND != "memory" else ()
+        await cluster.start(stored)
+        cluster.install_signal_handlers()
+        if WEBAPP_API_PORT:
+            await webapp_api.start()
+
+    async def stop_cluster(application: Application):
+        logger.info(f"Кластер при остановке: {cluster.stats()}")
+        await webapp_api.stop()
+        await cluster.stop()
+
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .post_init(start_cluster)
+        .post_shutdown(stop_cluster)
+        .build()
+    )
+    application.add_handler(TypeHandler(Update, forward))
+    run_application(application)
+
 
-    # Запускаем бота
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+def main():
+    """Запуск бота"""
+    errors = validate_config()
+    if errors:
+        for error in errors:
+            logger.error(f"Ошибка настройки: {error}")
+        sys.exit(1)
+
+    if BOT_WORKER_ID is not None:
+        run_worker()
+    elif CLUSTER_FRONT:
+        run_cluster()
+    else:
+        run_application(build_application())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,117 @@
+import hashlib
+import re
+import time
+from collections import OrderedDict
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s]+")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_prompt(text):
+    """Нормализует текст запроса: регистр, ё, пунктуация и пробелы не влияют на ключ"""
+    text = text.lower().replace("ё", "е")
+    text = _PUNCTUATION_RE.sub(" ", text)
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def context_digest(*parts):
+    """Короткий хеш от частей контекста, влияющих на ответ"""
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """Кеш ответов ИИ с вытеснением по LRU и сроком жизни записей.
+
+    Записи привязаны к пользователю, чтобы их можно было разом сбросить
+    при изменении его проектов (invalidate_user).
+    """
+
+    def __init__(self, max_size=10000, ttl=600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._keys_by_user = {}
+
+    def get(self, user_id, prompt, digest):
+        """Получить ответ из кеша или None"""
+        key = (user_id, normalize_prompt(prompt), digest)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, response = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return response
+
+    def put(self, user_id, prompt, digest, response):
+        """Сохранить ответ в кеше"""
+        if self.max_size <= 0:
+            return
+
+        key = (user_id, normalize_prompt(prompt), digest)
+        self._entries[key] = (time.monotonic() + self.ttl, response)
+        self._entries.move_to_end(key)
+        self._keys_by_user.setdefault(user_id, set()).add(key)
+
+        while len(self._entries) > self.max_size:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def invalidate_user(self, user_id):
+        """Удалить все ответы пользователя (например, после изменения его проектов)"""
+        for key in self._keys_by_user.pop(user_id, ()):
+            self._entries.pop(key, None)
+
+    def stats(self):
+        """Счетчики попаданий и промахов"""
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        keys = self._keys_by_user.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_user[key[0]]
+
+
+class LRUCache:
+    """Простой кеш с вытеснением давно не использованных записей"""
+
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """Получить значение или None"""
+        value = self._entries.get(key)
+        if value is not None:
+            self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        """Сохранить значение, вытеснив самые старые записи сверх max_size"""
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
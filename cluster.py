@@ -0,0 +1,507 @@
+import asyncio
+import hashlib
+import inspect
+import itertools
+import logging
+import os
+import pickle
+import re
+import shutil
+import signal
+import struct
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# Сообщение между процессами: длина и кортеж, упакованный pickle. Сокет
+# лежит в каталоге, доступном только владельцу, поэтому чужих данных в нем нет
+FRAME_HEADER = struct.Struct("<I")
+
+# Сколько пользователей передается между процессами за один вызов
+HANDOFF_BATCH = 500
+
+# Сколько ждать, пока рабочий процесс запустится или остановится, секунды
+WORKER_START_TIMEOUT = 60.0
+WORKER_STOP_TIMEOUT = 30.0
+
+
+async def send_message(writer, message):
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    writer.write(FRAME_HEADER.pack(len(data)) + data)
+    await writer.drain()
+
+
+async def read_message(reader):
+    (length,) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+    return pickle.loads(await reader.readexactly(length))
+
+
+async def _invoke(function, args):
+    result = function(*args)
+    if inspect.isawaitable(result):
+        result = await result
+    return result
+
+
+def _score(worker_id, key):
+    digest = hashlib.blake2b(f"{worker_id}:{key}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+class ShardMap:
+    """Распределение пользователей по рабочим процессам (rendezvous hashing).
+
+    Пользователь достается процессу с наибольшим хешем пары (процесс,
+    пользователь). При добавлении процесса к нему переходит примерно 1/N
+    пользователей, при удалении переезжают только пользователи удаленного
+    процесса — остальные остаются на месте.
+    """
+
+    def __init__(self, worker_ids):
+        self.worker_ids = tuple(sorted(worker_ids))
+        if not self.worker_ids:
+            raise ValueError("Нужен хотя бы один рабочий процесс")
+
+    def owner(self, key):
+        return max(self.worker_ids, key=lambda worker_id: _score(worker_id, key))
+
+
+def find_worker_ids(storage_path):
+    """Номера рабочих процессов, от которых остались хранилища (STORAGE_PATH.workerN)"""
+    directory, name = os.path.split(os.path.abspath(storage_path))
+    pattern = re.compile(rf"{re.escape(name)}\.worker(\d+)$")
+    ids = set()
+    for entry in os.listdir(directory):
+        match = pattern.match(entry)
+        if match:
+            ids.add(int(match.group(1)))
+    return ids
+
+
+class _WorkerEndpoint:
+    """Обновления и вызовы фронт-процесса в рабочем процессе.
+
+    methods — функции бота, доступные по имени: get_user, export_user,
+    import_user, drop_user, user_ids, is_busy, flush и любые другие. Сверху
+    добавляются операции передачи пользователей между процессами.
+    """
+
+    def __init__(self, worker_id, application, methods):
+        self.worker_id = worker_id
+        self.application = application
+        # Обновления, еще не дошедшие до очереди пользователя: ключ -> число
+        self._pending = {}
+        self._tasks = set()
+        self.methods = {
+            **methods,
+            "misplaced": self.misplaced,
+            "export_users": self.export_users,
+            "import_users": self.import_users,
+            "drop_users": self.drop_users,
+        }
+
+    def handle_update(self, update):
+        """Передать обновление обработчикам бота.
+
+        Обновление идет в update_processor напрямую, минуя update_queue,
+        чтобы точно знать, когда у пользователя не остается необработанных
+        обновлений (это нужно перед передачей его данных).
+        """
+        key = Cluster.update_key(update)
+        self._pending[key] = self._pending.get(key, 0) + 1
+        task = asyncio.create_task(self.application.update_processor.process_update(
+            update, self.application.process_update(update),
+        ))
+        self._tasks.add(task)
+        task.add_done_callback(lambda _: self._done(key, task))
+
+    def is_busy(self, key):
+        return key in self._pending or self.methods["is_busy"](key)
+
+    def _done(self, key, task):
+        self._tasks.discard(task)
+        self._pending[key] -= 1
+        if not self._pending[key]:
+            del self._pending[key]
+
+    def misplaced(self, worker_ids):
+        """Пользователи, которые при таком наборе процессов принадлежат другим"""
+        shards = ShardMap(worker_ids)
+        return [user_id for user_id in self.methods["user_ids"]() if shards.owner(user_id) != self.worker_id]
+
+    async def export_users(self, user_ids):
+        """Данные пользователей после того, как обработаны все их обновления"""
+        while any(self.is_busy(user_id) for user_id in user_ids):
+            await asyncio.sleep(0.05)
+        export_user = self.methods["export_user"]
+        return {user_id: export_user(user_id) for user_id in user_ids}
+
+    def import_users(self, users):
+        import_user = self.methods["import_user"]
+        for user_id, data in users.items():
+            import_user(user_id, data)
+        # Старый владелец удалит данные только после того, как они на диске у нового
+        self.methods["flush"]()
+
+    def drop_users(self, user_ids):
+        drop_user = self.methods["drop_user"]
+        for user_id in user_ids:
+            drop_user(user_id)
+        self.methods["flush"]()
+
+
+async def serve_worker(worker_id, front_socket, application, post_init, post_shutdown, methods):
+    """Рабочий процесс: обрабатывает обновления и вызовы, присланные фронт-процессом.
+
+    Приложение запускается без получения обновлений (Updater): обновления
+    приходят по Unix-сокету. Процесс завершается, когда фронт закрывает
+    соединение или по SIGTERM.
+    """
+    from telegram import Update
+
+    await application.initialize()
+    await post_init(application)
+    await application.start()
+
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    # Ctrl+C получает вся группа процессов; рабочие останавливает фронт
+    loop.add_signal_handler(signal.SIGINT, lambda: None)
+    loop.add_signal_handler(signal.SIGTERM, stopped.set)
+
+    endpoint = _WorkerEndpoint(worker_id, application, methods)
+    reader, writer = await asyncio.open_unix_connection(front_socket)
+    await send_message(writer, ("hello", worker_id))
+    calls = set()
+
+    async def call(call_id, name, args):
+        try:
+            result = (None, await _invoke(endpoint.methods[name], args))
+        except Exception as e:
+            logger.error(f"Ошибка вызова {name} в рабочем процессе {worker_id}: {e}")
+            result = (f"{type(e).__name__}: {e}", None)
+        await send_message(writer, ("result", call_id, *result))
+
+    async def read_loop():
+        try:
+            while True:
+                message = await read_message(reader)
+                if message[0] == "update":
+                    endpoint.handle_update(Update.de_json(message[1], application.bot))
+                elif message[0] == "call":
+                    task = asyncio.create_task(call(*message[1:]))
+                    calls.add(task)
+                    task.add_done_callback(calls.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            stopped.set()
+
+    read_task = asyncio.create_task(read_loop())
+    logger.info(f"Рабочий процесс {worker_id} запущен")
+    await stopped.wait()
+
+    read_task.cancel()
+    writer.close()
+    await application.stop()
+    await application.shutdown()
+    await post_shutdown(application)
+    logger.info(f"Рабочий процесс {worker_id} остановлен")
+
+
+class _Worker:
+    """Рабочий процесс на стороне фронта: процесс, соединение и ожидающие вызовы"""
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.process = None
+        self.writer = None
+        self.connected = asyncio.get_running_loop().create_future()
+        self.retiring = False
+        self._calls = {}
+        self._call_ids = itertools.count()
+
+    async def send_update(self, data):
+        await send_message(self.writer, ("update", data))
+
+    async def call(self, name, *args, timeout=None):
+        call_id = next(self._call_ids)
+        future = self._calls[call_id] = asyncio.get_running_loop().create_future()
+        try:
+            await send_message(self.writer, ("call", call_id, name, args))
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._calls.pop(call_id, None)
+
+    async def read_results(self, reader):
+        try:
+            while True:
+                _, call_id, error, value = await read_message(reader)
+                future = self._calls.get(call_id)
+                if future is None or future.done():
+                    continue
+                if error:
+                    future.set_exception(RuntimeError(f"Рабочий процесс {self.worker_id}: {error}"))
+                else:
+                    future.set_result(value)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.fail_calls()
+
+    def fail_calls(self):
+        for future in self._calls.values():
+            if not future.done():
+                future.set_exception(ConnectionError(f"Рабочий процесс {self.worker_id} недоступен"))
+
+
+class Cluster:
+    """Фронт-процесс: раздает обновления рабочим процессам по user_id.
+
+    Рабочий процесс — тот же бот (command), запущенный с BOT_WORKER_ID и
+    своим хранилищем (окружение задает worker_environ(worker_id, число
+    процессов) при его запуске). Все обновления пользователя обрабатывает один процесс
+    (ShardMap), поэтому данные пользователя не нужно синхронизировать между
+    процессами. Запросы, которым нужны данные чужого процесса (API
+    канбан-доски, счетчики), выполняются через call() и broadcast().
+
+    add_worker() и remove_worker() меняют число процессов на ходу. Пользователи,
+    у которых меняется владелец, передаются новому процессу (handoff), а их
+    обновления на это время придерживаются и отправляются после передачи.
+    Переданные пользователи запоминаются в _moved: если передача прервалась,
+    их обновления и вызовы идут новому владельцу, хотя карта еще старая.
+    """
+
+    def __init__(self, command, worker_count, worker_environ, call_timeout=30.0):
+        self.command = command
+        self.worker_count = worker_count
+        self.worker_environ = worker_environ
+        self.call_timeout = call_timeout
+        self.shards = None
+        self.handoffs = 0
+        self.restarts = 0
+
+        self._workers = {}
+        self._next_shards = None
+        self._moved = {}
+        self._held = []
+        self._lock = asyncio.Lock()
+        self._directory = None
+        self._server = None
+        self._tasks = set()
+        self._stopping = False
+
+    async def start(self, stored_worker_ids=()):
+        """Запустить рабочие процессы и распределить между ними пользователей.
+
+        stored_worker_ids — процессы, от которых остались хранилища: они
+        запускаются, чтобы передать своих пользователей, и затем
+        останавливаются, если лишние.
+        """
+        self._directory = tempfile.mkdtemp(prefix="flowento-")
+        self._server = await asyncio.start_unix_server(
+            self._handle_connection, path=os.path.join(self._directory, "front.sock"),
+        )
+
+        worker_ids = set(range(self.worker_count)) | set(stored_worker_ids)
+        await asyncio.gather(*(self._spawn(worker_id, self.worker_count) for worker_id in sorted(worker_ids)))
+        self.shards = ShardMap(worker_ids)
+        await self._rebalance(range(self.worker_count))
+        logger.info(f"Запущено рабочих процессов: {len(self._workers)}")
+
+    async def stop(self):
+        """Остановить рабочие процессы"""
+        self._stopping = True
+        await asyncio.gather(*(self._retire(worker) for worker in list(self._workers.values())))
+        if self._server is not None:
+            self._server.close()
+        if self._directory is not None:
+            shutil.rmtree(self._directory, ignore_errors=True)
+
+    async def dispatch(self, update):
+        """Отправить обновление Telegram процессу, которому принадлежит его пользователь"""
+        key = self.update_key(update)
+        data = update.to_dict()
+        if self._next_shards is not None and self._next_shards.owner(key) != self.shards.owner(key):
+            # Пользователь переезжает в другой процесс: отправим после передачи
+            self._held.append((key, data))
+            return
+        await self._send_update(key, data)
+
+    async def call(self, key, name, *args):
+        """Вызвать функцию в процессе, которому принадлежит пользователь key"""
+        return await self._workers[self._owner(key)].call(name, *args, timeout=self.call_timeout)
+
+    async def broadcast(self, name, *args):
+        """Вызвать функцию во всех процессах: список результатов"""
+        return await asyncio.gather(*(
+            worker.call(name, *args, timeout=self.call_timeout) for worker in self._workers.values()
+        ))
+
+    async def get_user(self, user_id):
+        return await self.call(user_id, "get_user", user_id)
+
+    async def search_tasks(self, user_id, query, limit):
+        return await self.call(user_id, "search_tasks", user_id, query, limit)
+
+    async def count_entities(self):
+        totals = {}
+        for counts in await self.broadcast("count_entities"):
+            for kind, value in counts.items():
+                totals[kind] = totals.get(kind, 0) + value
+        return totals
+
+    async def add_worker(self):
+        """Добавить рабочий процесс и передать ему его долю пользователей"""
+        worker_id = next(i for i in itertools.count() if i not in self._workers)
+        await self._rebalance((*self.shards.worker_ids, worker_id))
+
+    async def remove_worker(self, worker_id=None):
+        """Остановить рабочий процесс (по умолчанию последний), передав его пользователей остальным"""
+        worker_ids = self.shards.worker_ids
+        if len(worker_ids) <= 1:
+            logger.warning("Нельзя остановить последний рабочий процесс")
+            return
+        if worker_id is None:
+            worker_id = worker_ids[-1]
+        await self._rebalance([i for i in worker_ids if i != worker_id])
+
+    def install_signal_handlers(self):
+        """SIGTTIN добавляет рабочий процесс, SIGTTOU — убирает (как в gunicorn)"""
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTTIN, lambda: self._background(self.add_worker()))
+        loop.add_signal_handler(signal.SIGTTOU, lambda: self._background(self.remove_worker()))
+
+    def stats(self):
+        return {
+            "workers": len(self.shards.worker_ids) if self.shards else 0,
+            "handoffs": self.handoffs,
+            "restarts": self.restarts,
+            "held": len(self._held),
+        }
+
+    @staticmethod
+    def update_key(update):
+        """Ключ распределения: пользователь, а если его нет — чат"""
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return 0
+
+    def _owner(self, key):
+        """Процесс, у которого сейчас данные пользователя key"""
+        owner = self._moved.get(key)
+        return self.shards.owner(key) if owner is None else owner
+
+    async def _send_update(self, key, data):
+        worker = self._workers[self._owner(key)]
+        try:
+            await worker.send_update(data)
+        except (ConnectionError, AttributeError) as e:
+            logger.error(f"Обновление для {key} потеряно: рабочий процесс {worker.worker_id} недоступен ({e})")
+
+    async def _rebalance(self, worker_ids):
+        """Перейти на новый набор рабочих процессов с передачей пользователей"""
+        async with self._lock:
+            new_shards = ShardMap(worker_ids)
+            await asyncio.gather(*(
+                self._spawn(worker_id, len(new_shards.worker_ids))
+                for worker_id in new_shards.worker_ids if worker_id not in self._workers
+            ))
+
+            self._next_shards = new_shards
+            moved = 0
+            try:
+                for worker in list(self._workers.values()):
+                    user_ids = await worker.call("misplaced", new_shards.worker_ids)
+                    for start in range(0, len(user_ids), HANDOFF_BATCH):
+                        batch = user_ids[start:start + HANDOFF_BATCH]
+                        parts = {}
+                        for user_id, data in (await worker.call("export_users", batch)).items():
+                            if data is not None:
+                                parts.setdefault(new_shards.owner(user_id), {})[user_id] = data
+                        for owner, users in parts.items():
+                            await self._workers[owner].call("import_users", users)
+                            self._moved.update(dict.fromkeys(users, owner))
+                        await worker.call("drop_users", batch)
+                        moved += len(batch)
+                self.shards = new_shards
+                self._moved.clear()
+            except Exception as e:
+                # Уже переданные пользователи остаются в _moved, и их обновления
+                # идут новому владельцу; следующая перебалансировка найдет их там
+                logger.error(f"Не удалось передать пользователей между процессами: {e}")
+                raise
+            finally:
+                self._next_shards = None
+                held, self._held = self._held, []
+                for key, data in held:
+                    await self._send_update(key, data)
+
+            self.handoffs += moved
+            retired = [worker for worker_id, worker in self._workers.items() if worker_id not in new_shards.worker_ids]
+            await asyncio.gather(*(self._retire(worker) for worker in retired))
+            logger.info(f"Рабочие процессы: {list(new_shards.worker_ids)}, передано пользователей: {moved}")
+
+    async def _spawn(self, worker_id, worker_count):
+        worker = self._workers.get(worker_id)
+        if worker is None:
+            worker = self._workers[worker_id] = _Worker(worker_id)
+        environ = {
+            **os.environ,
+            **self.worker_environ(worker_id, worker_count),
+            "BOT_WORKER_ID": str(worker_id),
+            "BOT_FRONT_SOCKET": os.path.join(self._directory, "front.sock"),
+        }
+        process = worker.process = await asyncio.create_subprocess_exec(*self.command, env=environ)
+        exited = asyncio.create_task(process.wait())
+        await asyncio.wait((worker.connected, exited), timeout=WORKER_START_TIMEOUT,
+                           return_when=asyncio.FIRST_COMPLETED)
+        if not worker.connected.done():
+            if not exited.done():
+                process.kill()
+            await exited
+            self._workers.pop(worker_id, None)
+            raise RuntimeError(f"Рабочий процесс {worker_id} не запустился (код {process.returncode})")
+        self._background(self._watch(worker, process, exited))
+
+    async def _retire(self, worker):
+        worker.retiring = True
+        if worker.writer is not None:
+            worker.writer.close()
+        try:
+            await asyncio.wait_for(worker.process.wait(), WORKER_STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Рабочий процесс {worker.worker_id} не остановился, завершаем принудительно")
+            worker.process.kill()
+            await worker.process.wait()
+        self._workers.pop(worker.worker_id, None)
+
+    async def _watch(self, worker, process, exited):
+        """Перезапустить рабочий процесс, если он завершился сам"""
+        code = await exited
+        if worker.retiring or self._stopping or worker.process is not process:
+            return
+        logger.error(f"Рабочий процесс {worker.worker_id} завершился с кодом {code}, перезапускаем")
+        self.restarts += 1
+        worker.writer = None
+        worker.fail_calls()
+        worker.connected = asyncio.get_running_loop().create_future()
+        await self._spawn(worker.worker_id, len(self.shards.worker_ids))
+
+    async def _handle_connection(self, reader, writer):
+        _, worker_id = await read_message(reader)
+        worker = self._workers.get(worker_id)
+        if worker is None:
+            writer.close()
+            return
+        worker.writer = writer
+        if not worker.connected.done():
+            worker.connected.set_result(True)
+        await worker.read_results(reader)
+
+    def _background(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
@@ -0,0 +1,140 @@
+import re
+from datetime import date, datetime, timedelta, timezone
+
+from cache import LRUCache, context_digest
+from models import TaskStatus, format_deadline
+
+MINUTES_PER_DAY = 24 * 60
+
+# Системный промпт сводки один для всех пользователей: в запросе меняется
+# только описание состояния проектов, поэтому одинаковые состояния дают
+# одинаковые запросы и ответ берется из кеша
+DIGEST_PROMPT = (
+    "Ты — ИИ-ассистент, который помогает вести проекты. Тебе дано состояние "
+    "проектов пользователя. Напиши 1–3 коротких предложения: на что обратить "
+    "внимание сегодня (просроченные задачи, ближайшие дедлайны, застрявшие "
+    "задачи). Не пересказывай цифры целиком и не здоровайся."
+)
+
+_OFFSET_RE = re.compile(r"^(?:UTC|GMT)?([+-])(\d{1,2})(?::?(\d{2}))?$", re.IGNORECASE)
+
+
+def parse_utc_offset(text):
+    """Разобрать смещение от UTC вида +3, -5, +5:30 или UTC+3 в минуты; None, если формат не распознан"""
+    match = _OFFSET_RE.match(text.strip())
+    if not match:
+        return None
+    sign, hours, minutes = match.groups()
+    offset = int(hours) * 60 + int(minutes or 0)
+    if offset > 14 * 60:
+        return None
+    return -offset if sign == "-" else offset
+
+
+def format_utc_offset(offset):
+    """Смещение от UTC в минутах в виде UTC+3 или UTC+5:30"""
+    sign = "-" if offset < 0 else "+"
+    hours, minutes = divmod(abs(offset), 60)
+    return f"UTC{sign}{hours}" + (f":{minutes:02d}" if minutes else "")
+
+
+class DigestScheduler:
+    """Расписание ежедневных сводок по проектам.
+
+    Подписчики разложены по минуте суток UTC, в которую им положена сводка
+    (час сводки в часовом поясе пользователя), поэтому пользователи одного
+    часового пояса и часа попадают в одну группу, а проверка перебирает
+    группы, а не всех пользователей. Группа остается в рассылке window минут:
+    сводки, не отправленные вовремя (перезапуск, длинная очередь), уходят с
+    опозданием, а не пропадают. Дата последней сводки каждого подписчика
+    хранится здесь же, так что повторные проверки не загружают пользователей.
+
+    Строки состояния проектов кешируются по версии проекта и дате, а хеш
+    состояния всех проектов позволяет не отправлять сводку, если с прошлой
+    ничего не изменилось.
+    """
+
+    def __init__(self, window=60, cache_size=100000):
+        self.window = window
+        self._groups = {}
+        self._subscribers = {}
+        self._status_cache = LRUCache(max_size=cache_size)
+
+    def __len__(self):
+        return len(self._subscribers)
+
+    def subscribe(self, user_id, hour, utc_offset, last_date=None):
+        """Подписать пользователя на сводку в hour часов по его времени.
+
+        utc_offset — смещение часового пояса в минутах, last_date — дата
+        последней отправленной сводки в формате ISO (из настроек пользователя).
+        """
+        self.unsubscribe(user_id)
+        if isinstance(last_date, str):
+            last_date = date.fromisoformat(last_date)
+        minute = (hour * 60 - utc_offset) % MINUTES_PER_DAY
+        self._groups.setdefault(minute, set()).add(user_id)
+        self._subscribers[user_id] = [minute, utc_offset, last_date]
+
+    def unsubscribe(self, user_id):
+        """Отписать пользователя от сводок"""
+        subscriber = self._subscribers.pop(user_id, None)
+        if subscriber is None:
+            return
+        group = self._groups[subscriber[0]]
+        group.discard(user_id)
+        if not group:
+            del self._groups[subscriber[0]]
+
+    def pop_due(self, now=None):
+        """Подписчики, которым пора отправить сводку: список (user_id, дата по их времени).
+
+        Возвращенные подписчики считаются получившими сводку за эту дату.
+        """
+        now = now or datetime.now(timezone.utc)
+        current = now.hour * 60 + now.minute
+        due = []
+        for minute, group in self._groups.items():
+            if (current - minute) % MINUTES_PER_DAY >= self.window:
+                continue
+            for user_id in group:
+                subscriber = self._subscribers[user_id]
+                today = (now + timedelta(minutes=subscriber[1])).date()
+                if subscriber[2] != today:
+                    subscriber[2] = today
+                    due.append((user_id, today))
+        return due
+
+    def summarize(self, user_id, user, today):
+        """Краткое состояние проектов пользователя: (текст, хеш состояния)"""
+        lines = []
+        for project in user["projects"].values():
+            key = (user_id, project.id)
+            cached = self._status_cache.get(key)
+            if cached is None or cached[0] != project.version or cached[1] != today:
+                cached = (project.version, today, self.project_status(project, today))
+                self._status_cache.put(key, cached)
+            lines.append(cached[2])
+        return "\n".join(lines), context_digest(*lines)
+
+    @staticmethod
+    def project_status(project, today):
+        """Строка о состоянии проекта: задачи по статусам, просроченные и ближайший дедлайн"""
+        overdue = 0
+        nearest = None
+        day = today.toordinal()
+        for task in project.tasks.values():
+            if task.deadline is None or task.status == TaskStatus.DONE:
+                continue
+            if task.deadline < day:
+                overdue += 1
+            elif nearest is None or task.deadline < nearest:
+                nearest = task.deadline
+
+        counts = ", ".join(f"{status}: {count}" for status, count in project.status_counts.items() if count)
+        parts = [f"• {project.name} — {counts or 'нет задач'}"]
+        if overdue:
+            parts.append(f"просрочено: {overdue}")
+        if nearest is not None:
+            parts.append(f"ближайший дедлайн {format_deadline(nearest)}")
+        return "; ".join(parts)
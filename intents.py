@@ -0,0 +1,228 @@
+import math
+import re
+from collections import Counter, namedtuple
+
+from cache import normalize_prompt
+
+# Распознанное намерение: имя команды бота, ее аргументы и уверенность (0..1)
+Intent = namedtuple("Intent", "name args confidence")
+
+# Шаблоны однозначных формулировок. Группы шаблона превращаются в аргументы
+# команды в функциях из INTENT_ARGS
+INTENT_PATTERNS = [
+    ("add_task", r"(?:добавь|добавить|создай|создать|заведи)\s+(?:новую\s+)?задачу\s+"
+                 r"(?:в\s+)?(?:проект[еау]?\s*)?[№#]?\s*(?P<project_id>\d+)\s*[:\-—,]?\s*(?P<name>[^?\n]{1,80})"),
+    ("complete_task", r"(?:заверши|завершить|закрой|закрыть|отметь\s+выполненной)\s+задачу\s+[№#]?\s*"
+                      r"(?P<task_id>\d+)\s+(?:в\s+|из\s+)?проект[еау]?\s*[№#]?\s*(?P<project_id>\d+)"),
+    ("new_project", r"(?:создай|создать|заведи|завести|добавь|добавить|начни|начать)\s+(?:новый\s+)?"
+                    r"проект\s*[:\-—]?\s*(?P<name>[^?\n]{1,40})"),
+    ("search", r"(?:найди|найти|поищи|ищи|поиск)\s+задач[уиа]?\s+(?P<query>[^\n]{1,100})"),
+    ("tasks", r"(?:покажи|показать|выведи|открой|список|какие)\s+(?:все\s+|мои\s+)?задач[иау]?\s+"
+              r"(?:в\s+|по\s+|для\s+|из\s+)?(?:проект[аеу]?\s*)?[№#]?\s*(?P<project_id>\d+)\s*\??"),
+    ("my_projects", r"(?:покажи|показать|выведи|список|мои|какие\s+у\s+меня)\s+(?:мои\s+|все\s+)?"
+                    r"проект(?:ы|ов)?\s*\??"),
+    ("kanban", r"(?:открой|открыть|покажи|показать|запусти)\s+(?:мою\s+)?(?:канбан(?:-доску)?|доску)"
+               r"(?:\s+задач)?\s*"),
+    ("help", r"(?:помощь|справка|что\s+ты\s+умеешь|какие\s+(?:у\s+тебя\s+)?(?:есть\s+)?команды)\s*\??"),
+]
+
+# Команды, которые меняют данные: выполняются только по шаблону с проверенным
+# названием и никогда — по догадке модели
+CHANGING_INTENTS = {"new_project", "add_task", "complete_task"}
+
+# Проверка названия из шаблона: не больше NAME_MAX_WORDS слов, без союзов и
+# глаголов-просьб (значит, в сообщении есть что-то кроме команды) и не с
+# предлога цели («создай проект для запуска сайта» — вопрос к ИИ, а не название)
+NAME_MAX_WORDS = {"new_project": 5, "add_task": 8}
+_NAME_STOP_WORDS = {
+    "и", "а", "но", "или", "затем", "потом", "также", "чтобы", "если",
+    "который", "которая", "которое", "которые",
+    "распиши", "напиши", "составь", "придумай", "помоги", "подскажи", "объясни",
+    "расскажи", "посоветуй", "предложи", "разбей", "оцени", "сделай", "добавь", "создай",
+}
+_NAME_PREFIXES = {"для", "по", "про", "о", "об", "чтобы"}
+
+# Превращение групп шаблона в (команда, аргументы)
+INTENT_ARGS = {
+    "add_task": lambda groups: ("add_task", [groups["project_id"], *groups["name"].split()]),
+    "complete_task": lambda groups: ("move_task", [groups["project_id"], groups["task_id"], "Завершена"]),
+    "new_project": lambda groups: ("new_project", groups["name"].split()),
+    "search": lambda groups: ("search", groups["query"].split()),
+    "tasks": lambda groups: ("tasks", [groups["project_id"]]),
+    "my_projects": lambda groups: ("my_projects", []),
+    "kanban": lambda groups: ("kanban", []),
+    "help": lambda groups: ("help", []),
+}
+
+# Примеры для модели, которая распознает свободные формулировки без
+# аргументов. Класс "other" — сообщения, на которые должен отвечать ИИ
+INTENT_EXAMPLES = {
+    "my_projects": [
+        "какие у меня есть проекты", "мои проекты", "список проектов",
+        "что у меня по проектам", "покажи проекты пожалуйста", "сколько у меня проектов",
+        "выведи все мои проекты", "над какими проектами я работаю",
+    ],
+    "kanban": [
+        "открой канбан", "хочу посмотреть доску", "покажи канбан доску",
+        "доска задач", "открой доску", "где моя канбан доска",
+        "запусти канбан", "хочу канбан",
+    ],
+    "help": [
+        "что ты умеешь", "помощь", "какие есть команды", "как тобой пользоваться",
+        "справка по командам", "что можно сделать", "помоги разобраться с ботом",
+        "какие команды ты понимаешь",
+    ],
+    "tasks": [
+        "покажи задачи проекта 2", "какие задачи в проекте 1", "задачи по проекту 3",
+        "что осталось сделать в проекте 2", "список задач проекта 4",
+        "какие задачи висят в проекте 5", "покажи что в проекте 1", "открой задачи 2",
+    ],
+    "other": [
+        "как лучше спланировать релиз", "помоги составить роадмап", "что такое скрам",
+        "как оценить сроки задачи", "привет как дела", "посоветуй как мотивировать команду",
+        "напиши план запуска сайта", "какие риски у проекта с жестким дедлайном",
+        "как разбить большую задачу на части", "спасибо", "расскажи про канбан метод",
+        "как приоритизировать задачи в проекте", "почему проект отстает от графика",
+    ],
+}
+
+_NUMBER_RE = re.compile(r"\d+")
+
+
+def valid_name(intent, name):
+    """Похоже ли название из шаблона на название, а не на продолжение просьбы"""
+    if any(char in name for char in ",;"):
+        return False
+    words = normalize_prompt(name).split()
+    if not words or len(words) > NAME_MAX_WORDS[intent]:
+        return False
+    return words[0] not in _NAME_PREFIXES and not _NAME_STOP_WORDS.intersection(words)
+
+
+def features(text):
+    """Признаки сообщения для модели: начала слов (грубая замена стемминга)"""
+    return [word[:5] for word in normalize_prompt(text).split() if not word.isdigit()]
+
+
+class IntentModel:
+    """Мультиномиальный наивный байесовский классификатор по началам слов.
+
+    Обучается при создании на INTENT_EXAMPLES, не требует сети и внешних
+    пакетов. predict() возвращает (класс, вероятность).
+    """
+
+    def __init__(self, examples):
+        self.classes = list(examples)
+        self._counts = {}
+        self._totals = {}
+        vocabulary = set()
+        for intent, phrases in examples.items():
+            counts = Counter(feature for phrase in phrases for feature in features(phrase))
+            self._counts[intent] = counts
+            self._totals[intent] = sum(counts.values())
+            vocabulary.update(counts)
+        self._vocabulary = vocabulary
+
+    def covers(self, text, max_words):
+        """Все ли слова сообщения знакомы модели и их не больше max_words.
+
+        Незнакомые слова значат, что в сообщении есть что-то кроме команды
+        («сколько у меня проектов и какие риски»), и уверенность модели по
+        знакомым словам тогда ничего не говорит.
+        """
+        words = features(text)
+        return 0 < len(words) <= max_words and all(word in self._vocabulary for word in words)
+
+    def predict(self, text):
+        words = [word for word in features(text) if word in self._vocabulary]
+        if not words:
+            return "other", 1.0
+
+        vocabulary_size = len(self._vocabulary)
+        scores = {}
+        for intent in self.classes:
+            counts = self._counts[intent]
+            denominator = self._totals[intent] + vocabulary_size
+            scores[intent] = sum(math.log((counts[word] + 1) / denominator) for word in words)
+
+        best = max(scores, key=scores.get)
+        total = sum(math.exp(score - scores[best]) for score in scores.values())
+        return best, 1 / total
+
+
+class IntentRouter:
+    """Локальное распознавание команд в свободном тексте.
+
+    Сначала проверяются шаблоны INTENT_PATTERNS (уверенность 1.0), затем
+    модель IntentModel. Результат модели используется, только если все
+    слова сообщения (не больше model_max_words) знакомы модели, ее
+    уверенность не ниже threshold и из текста удается достать аргументы
+    команды; иначе classify() возвращает None и сообщение уходит в ИИ.
+    Команды из CHANGING_INTENTS выполняются только по шаблону.
+    Шаблоны и модель готовятся при первом сообщении, а не при запуске.
+    """
+
+    def __init__(self, threshold=0.75, max_length=200, model_max_words=6):
+        self.threshold = threshold
+        self.max_length = max_length
+        self.model_max_words = model_max_words
+        self.routed = Counter()
+        self.fallbacks = 0
+        self._model = None
+        self._patterns = None
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = IntentModel(INTENT_EXAMPLES)
+        return self._model
+
+    @property
+    def patterns(self):
+        if self._patterns is None:
+            self._patterns = [
+                (intent, re.compile(pattern, re.IGNORECASE)) for intent, pattern in INTENT_PATTERNS
+            ]
+        return self._patterns
+
+    def classify(self, text):
+        """Распознать команду в сообщении; None, если ее должен обработать ИИ"""
+        intent = self._classify(text.strip())
+        if intent is None:
+            self.fallbacks += 1
+        else:
+            self.routed[intent.name] += 1
+        return intent
+
+    def _classify(self, text):
+        # Длинные сообщения — почти всегда вопросы к ИИ, а не команды
+        if not text or len(text) > self.max_length:
+            return None
+
+        stripped = text.rstrip(".!")
+        for intent, pattern in self.patterns:
+            match = pattern.fullmatch(stripped)
+            if match:
+                groups = match.groupdict()
+                if intent in NAME_MAX_WORDS and not valid_name(intent, groups["name"]):
+                    return None
+                name, args = INTENT_ARGS[intent](groups)
+                return Intent(name, args, 1.0)
+
+        if not self.model.covers(text, self.model_max_words):
+            return None
+        intent, confidence = self.model.predict(text)
+        if intent == "other" or intent in CHANGING_INTENTS or confidence < self.threshold:
+            return None
+
+        if intent == "tasks":
+            # ID проекта берем из текста, только если число в нем одно
+            numbers = _NUMBER_RE.findall(text)
+            if len(numbers) != 1:
+                return None
+            return Intent("tasks", numbers, confidence)
+        return Intent(intent, [], confidence)
+
+    def stats(self):
+        """Сколько сообщений обработано локально (по командам) и отдано ИИ"""
+        return {"routed": dict(self.routed), "fallbacks": self.fallbacks}
@@ -0,0 +1,598 @@
+import asyncio
+import bisect
+import logging
+import marshal
+import mmap
+import os
+import re
+import struct
+import time
+import zlib
+from array import array
+from collections import OrderedDict
+
+from models import Project, ProjectStatus, Task, TaskStatus, deadline_ordinal, timestamp
+from storage import Storage, build_user, new_user, next_version, project_row, task_row, user_rows
+
+logger = logging.getLogger(__name__)
+
+# Запись журнала: длина и CRC32 полезной нагрузки, затем marshal((вид, строка))
+RECORD_HEADER = struct.Struct("<II")
+RECORD_USER = 0
+RECORD_PROJECT = 1
+RECORD_TASK = 2
+RECORD_DELETE = 3
+
+# Заголовок снимка: сигнатура, число пользователей, проектов и задач,
+# смещение индекса, смещение и длина раздела дедлайнов, смещение и длина
+# раздела настроек
+SNAPSHOT_MAGIC = b"FLWSNAP2"
+SNAPSHOT_HEADER = struct.Struct("<8sQQQQQQQQ")
+# Снимки первой версии: без раздела настроек
+SNAPSHOT_MAGIC_V1 = b"FLWSNAP1"
+SNAPSHOT_HEADER_V1 = struct.Struct("<8sQQQQQQ")
+
+_JOURNAL_RE = re.compile(r"journal\.(\d+)\.log$")
+_SNAPSHOT_RE = re.compile(r"snapshot\.(\d+)\.bin$")
+
+
+def encode_user(user):
+    """Блок снимка с данными пользователя и число его проектов и задач"""
+    projects, tasks = user_rows(user)
+    fields = (user["next_project_id"], user["context"], user["summary"], user["summary_pending"],
+              user["settings"])
+    return marshal.dumps((fields, projects, tasks)), len(projects), len(tasks)
+
+
+def user_deadlines(user_id, user):
+    """Задачи пользователя с дедлайном: (user_id, project_id, task_id, номер дня дедлайна, статус)"""
+    for project in user["projects"].values():
+        for task in project.tasks.values():
+            if task.deadline is not None:
+                yield user_id, project.id, task.id, task.deadline, task.status.value
+
+
+class Snapshot:
+    """Снимок данных, открытый через mmap.
+
+    Файл состоит из заголовка, блоков пользователей (marshal), индекса,
+    раздела дедлайнов и раздела настроек. Индекс — массивы, упорядоченные по user_id: ID,
+    смещения и длины блоков, число проектов и задач. Массивы читаются прямо
+    из mmap без копирования, а блок пользователя разбирается только при
+    обращении к нему, поэтому открытие снимка не зависит от объема данных.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic = self._mmap[:len(SNAPSHOT_MAGIC)]
+        if magic == SNAPSHOT_MAGIC:
+            (_, self.users, self.projects, self.tasks, index_offset,
+             self._deadlines_offset, self._deadlines_length,
+             self._settings_offset, self._settings_length) = SNAPSHOT_HEADER.unpack_from(self._mmap)
+            self.has_settings = True
+        elif magic == SNAPSHOT_MAGIC_V1:
+            (_, self.users, self.projects, self.tasks, index_offset,
+             self._deadlines_offset, self._deadlines_length) = SNAPSHOT_HEADER_V1.unpack_from(self._mmap)
+            self.has_settings = False
+        else:
+            raise ValueError(f"{path} не является снимком данных")
+
+        count = self.users
+        view = memoryview(self._mmap)
+        self._views = [view]
+        position = index_offset
+        arrays = []
+        for code, size in (("q", 8), ("Q", 8), ("I", 4), ("I", 4), ("I", 4)):
+            arrays.append(view[position:position + count * size].cast(code))
+            position += count * size
+        self._views.extend(arrays)
+        self.ids, self._offsets, self._lengths, self.project_counts, self.task_counts = arrays
+
+    def find(self, user_id):
+        """Позиция пользователя в индексе или -1"""
+        index = bisect.bisect_left(self.ids, user_id)
+        if index < self.users and self.ids[index] == user_id:
+            return index
+        return -1
+
+    def block(self, index):
+        """Закодированный блок пользователя (bytes)"""
+        offset = self._offsets[index]
+        return self._mmap[offset:offset + self._lengths[index]]
+
+    def load_user(self, user_id):
+        """Данные пользователя или None, если его нет в снимке"""
+        index = self.find(user_id)
+        if index < 0:
+            return None
+        # Настройки добавлены в снимок позже: в старых снимках их нет
+        (next_project_id, context, summary, summary_pending, *settings), projects, tasks = \
+            marshal.loads(self.block(index))
+        return build_user(next_project_id, context, summary, summary_pending, projects, tasks, *settings)
+
+    def deadlines(self):
+        """Все задачи снимка с дедлайном: список (user_id, project_id, task_id, дедлайн, статус)"""
+        if not self._deadlines_length:
+            return []
+        end = self._deadlines_offset + self._deadlines_length
+        return marshal.loads(self._mmap[self._deadlines_offset:end])
+
+    def settings(self):
+        """Непустые настройки пользователей снимка: список (user_id, настройки)"""
+        if self.has_settings:
+            end = self._settings_offset + self._settings_length
+            return marshal.loads(self._mmap[self._settings_offset:end])
+
+        # В снимках первой версии настройки есть только в блоках пользователей
+        settings = []
+        for index in range(self.users):
+            fields = marshal.loads(self.block(index))[0]
+            if len(fields) > 4 and fields[4]:
+                settings.append((self.ids[index], fields[4]))
+        return settings
+
+    def close(self):
+        for view in reversed(self._views):
+            view.release()
+        self._mmap.close()
+        self._file.close()
+
+
+def write_snapshot(path, old, blocks, live_deadlines, live_settings, deleted=()):
+    """Записать новый снимок: блоки из blocks, остальные пользователи — из старого снимка.
+
+    blocks — {user_id: (блок, число проектов, число задач)}, live_deadlines
+    и live_settings — дедлайны и непустые настройки пользователей из blocks,
+    пользователи из deleted в снимок не попадают. Выполняется в отдельном потоке: читает
+    только неизменяемые данные старого снимка.
+    """
+    user_ids = set(blocks)
+    if old is not None:
+        user_ids.update(user_id for user_id in old.ids if user_id not in deleted)
+    user_ids = sorted(user_ids)
+
+    offsets = array("Q")
+    lengths = array("I")
+    project_counts = array("I")
+    task_counts = array("I")
+
+    temporary = path + ".tmp"
+    with open(temporary, "wb") as f:
+        f.write(b"\0" * SNAPSHOT_HEADER.size)
+        position = SNAPSHOT_HEADER.size
+        for user_id in user_ids:
+            if user_id in blocks:
+                data, projects, tasks = blocks[user_id]
+            else:
+                index = old.find(user_id)
+                data = old.block(index)
+                projects, tasks = old.project_counts[index], old.task_counts[index]
+            f.write(data)
+            offsets.append(position)
+            lengths.append(len(data))
+            project_counts.append(projects)
+            task_counts.append(tasks)
+            position += len(data)
+
+        # Выравниваем индекс, чтобы массивы в mmap начинались с кратного 8 смещения
+        padding = -position % 8
+        f.write(b"\0" * padding)
+        index_offset = position + padding
+        for values in (array("q", user_ids), offsets, lengths, project_counts, task_counts):
+            f.write(values.tobytes())
+
+        deadlines = [
+            row for row in (old.deadlines() if old is not None else ())
+            if row[0] not in blocks and row[0] not in deleted
+        ]
+        deadlines.extend(live_deadlines)
+        deadlines_data = marshal.dumps(deadlines)
+        deadlines_offset = f.tell()
+        f.write(deadlines_data)
+
+        settings = [
+            row for row in (old.settings() if old is not None else ())
+            if row[0] not in blocks and row[0] not in deleted
+        ]
+        settings.extend(live_settings)
+        settings_data = marshal.dumps(settings)
+        settings_offset = f.tell()
+        f.write(settings_data)
+
+        f.seek(0)
+        f.write(SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC, len(user_ids), sum(project_counts), sum(task_counts),
+            index_offset, deadlines_offset, len(deadlines_data), settings_offset, len(settings_data),
+        ))
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(temporary, path)
+    _fsync_directory(os.path.dirname(path))
+
+
+def _fsync_directory(path):
+    # Переименование файла надежно только после fsync каталога
+    fd = os.open(path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class JournalStorage(Storage):
+    """Хранилище из журнала изменений и снимков в каталоге path.
+
+    Каждый вызов save_* дописывает запись в журнал journal.N.log. Записи
+    копятся в буфере и сбрасываются на диск одной записью с fsync (group
+    commit), когда набирается batch_size записей или проходит
+    flush_interval секунд, так что при сбое теряется не больше одного окна.
+
+    compact() переключает запись на новый журнал и в фоновом потоке пишет
+    снимок snapshot.N.bin: измененные пользователи кодируются заново,
+    остальные копируются из предыдущего снимка как есть. При запуске
+    открывается последний снимок (через mmap, без разбора данных) и
+    проигрываются только журналы после него.
+
+    Измененные после последнего снимка пользователи держатся в памяти, из
+    остальных — не более cache_size последних (LRU).
+    """
+
+    def __init__(self, path, batch_size=1000, flush_interval=1.0, cache_size=1000,
+                 snapshot_min_bytes=16 * 1024 * 1024):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self.snapshot_min_bytes = snapshot_min_bytes
+
+        self._cache = OrderedDict()
+        self._dirty = {}
+        self._compacting = None
+        # Удаленные пользователи, которые еще есть в снимке
+        self._deleted = set()
+        self._buffer = []
+        self._last_flush = time.monotonic()
+
+        os.makedirs(path, exist_ok=True)
+        started = time.monotonic()
+
+        snapshots = self._files(_SNAPSHOT_RE)
+        self._snapshot = None
+        if snapshots:
+            generation, snapshot_path = snapshots[-1]
+            self._snapshot = Snapshot(snapshot_path)
+        else:
+            generation = 0
+
+        # Журналы до последнего снимка уже учтены в нем
+        journals = [(number, journal) for number, journal in self._files(_JOURNAL_RE) if number >= generation]
+        records = 0
+        for index, (number, journal) in enumerate(journals):
+            records += self._replay(journal, truncate=index == len(journals) - 1)
+        self._finish_replay()
+        self._remove_stale(generation)
+
+        self._generation = journals[-1][0] if journals else generation
+        self._open_journal(self._generation)
+
+        logger.info(f"Хранилище-журнал загружено за {time.monotonic() - started:.3f} с: "
+                    f"пользователей в снимке {self._snapshot.users if self._snapshot else 0}, "
+                    f"проиграно записей журнала {records}")
+
+    def get_user(self, user_id):
+        if user_id in self._deleted:
+            return None
+        user = self._live_user(user_id)
+        if user is not None:
+            return user
+
+        user = self._cache.get(user_id)
+        if user is not None:
+            self._cache.move_to_end(user_id)
+            return user
+
+        user = self._snapshot.load_user(user_id) if self._snapshot else None
+        if user is not None:
+            self._remember(user_id, user)
+        return user
+
+    def create_user(self, user_id):
+        user = new_user()
+        self._deleted.discard(user_id)
+        self._dirty[user_id] = user
+        self.save_user(user_id, user)
+        return user
+
+    def save_project(self, user_id, user, project):
+        self._append(RECORD_PROJECT, (user_id, *project_row(project)))
+        self._touch(user_id, user)
+
+    def save_task(self, user_id, user, project_id, task):
+        self._append(RECORD_TASK, (user_id, *task_row(project_id, task)))
+        self._touch(user_id, user)
+
+    def save_user(self, user_id, user):
+        self._append(RECORD_USER, (
+            user_id, user["next_project_id"], user["context"], user["summary"], user["summary_pending"],
+            user["settings"],
+        ))
+        self._touch(user_id, user)
+
+    def user_ids(self):
+        live = self._live_users()
+        if self._snapshot is not None:
+            for user_id in self._snapshot.ids:
+                if user_id not in live and user_id not in self._deleted:
+                    yield user_id
+        yield from live
+
+    def delete_user(self, user_id):
+        self._append(RECORD_DELETE, (user_id,))
+        self._dirty.pop(user_id, None)
+        self._cache.pop(user_id, None)
+        self._deleted.add(user_id)
+
+    def iter_deadlines(self):
+        live = self._live_users()
+        if self._snapshot is not None:
+            for user_id, project_id, task_id, deadline, status in self._snapshot.deadlines():
+                if user_id not in live and user_id not in self._deleted:
+                    # В снимках старых версий дедлайны записаны строками
+                    yield user_id, project_id, task_id, deadline_ordinal(deadline), status
+        for user_id, user in live.items():
+            yield from user_deadlines(user_id, user)
+
+    def iter_settings(self):
+        live = self._live_users()
+        if self._snapshot is not None:
+            for user_id, settings in self._snapshot.settings():
+                if user_id not in live and user_id not in self._deleted:
+                    yield user_id, settings
+        for user_id, user in list(live.items()):
+            if user["settings"]:
+                yield user_id, user["settings"]
+
+    def count_entities(self):
+        snapshot = self._snapshot
+        counts = {
+            "users": snapshot.users if snapshot else 0,
+            "projects": snapshot.projects if snapshot else 0,
+            "tasks": snapshot.tasks if snapshot else 0,
+        }
+        live = self._live_users()
+        for user_id in (*live, *self._deleted):
+            index = snapshot.find(user_id) if snapshot else -1
+            if index >= 0:
+                counts["users"] -= 1
+                counts["projects"] -= snapshot.project_counts[index]
+                counts["tasks"] -= snapshot.task_counts[index]
+        for user in live.values():
+            counts["users"] += 1
+            counts["projects"] += len(user["projects"])
+            counts["tasks"] += sum(len(project.tasks) for project in user["projects"].values())
+        return counts
+
+    def flush(self):
+        if self._buffer:
+            data = b"".join(self._buffer)
+            self._buffer.clear()
+            self._journal.write(data)
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._journal_size += len(data)
+        self._last_flush = time.monotonic()
+
+    async def compact(self, force=False):
+        if self._compacting is not None:
+            return False
+        # Снимок первой версии переписывается при первой проверке: без раздела
+        # настроек их поиск при запуске разбирает блоки всех пользователей
+        outdated = self._snapshot is not None and not self._snapshot.has_settings
+        if not force and not outdated and (not self._dirty
+                          or self._journal_size + sum(map(len, self._buffer)) < self.snapshot_min_bytes):
+            return False
+
+        # Дальнейшие изменения пишутся в новый журнал: он проигрывается поверх
+        # нового снимка, а повторное применение записей ничего не меняет
+        self.flush()
+        generation = self._generation + 1
+        self._journal.close()
+        self._open_journal(generation)
+        self._generation = generation
+
+        self._compacting, self._dirty = self._dirty, {}
+        deleted = set(self._deleted)
+        blocks = {}
+        live_deadlines = []
+        live_settings = []
+        for user_id, user in self._compacting.items():
+            blocks[user_id] = encode_user(user)
+            live_deadlines.extend(user_deadlines(user_id, user))
+            if user["settings"]:
+                live_settings.append((user_id, dict(user["settings"])))
+
+        path = os.path.join(self.path, f"snapshot.{generation}.bin")
+        started = time.monotonic()
+        try:
+            await asyncio.to_thread(
+                write_snapshot, path, self._snapshot, blocks, live_deadlines, live_settings, deleted
+            )
+        except Exception as e:
+            logger.error(f"Не удалось записать снимок {path}: {e}")
+            # Пользователи остаются измененными, их записи есть в журналах
+            self._dirty = {**self._compacting, **self._dirty}
+            self._compacting = None
+            return False
+
+        old_snapshot, self._snapshot = self._snapshot, Snapshot(path)
+        if old_snapshot is not None:
+            old_snapshot.close()
+        self._remove_stale(generation)
+        # Удаленные во время записи снимка пользователи в нем остались
+        self._deleted = {user_id for user_id in self._deleted if self._snapshot.find(user_id) >= 0}
+
+        compacted, self._compacting = self._compacting, None
+        for user_id, user in compacted.items():
+            if user_id not in self._dirty and user_id not in self._deleted:
+                self._remember(user_id, user)
+
+        logger.info(f"Записан снимок {path} за {time.monotonic() - started:.3f} с "
+                    f"(пользователей: {self._snapshot.users}, изменено: {len(blocks)})")
+        return True
+
+    def close(self):
+        self.flush()
+        self._journal.close()
+        if self._snapshot is not None:
+            self._snapshot.close()
+            self._snapshot = None
+
+    def _files(self, pattern):
+        """Файлы каталога, подходящие под шаблон: список (номер, путь) по возрастанию номера"""
+        files = []
+        for name in os.listdir(self.path):
+            match = pattern.match(name)
+            if match:
+                files.append((int(match.group(1)), os.path.join(self.path, name)))
+        return sorted(files)
+
+    def _remove_stale(self, generation):
+        """Удалить снимки и журналы, полностью учтенные в снимке generation"""
+        for pattern in (_SNAPSHOT_RE, _JOURNAL_RE):
+            for number, path in self._files(pattern):
+                if number < generation:
+                    os.remove(path)
+
+    def _open_journal(self, generation):
+        path = os.path.join(self.path, f"journal.{generation}.log")
+        self._journal = open(path, "ab")
+        self._journal_size = self._journal.tell()
+
+    def _append(self, kind, row):
+        payload = marshal.dumps((kind, row))
+        self._buffer.append(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+        if (len(self._buffer) >= self.batch_size
+                or time.monotonic() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def _replay(self, path, truncate):
+        """Применить записи журнала; возвращает их число.
+
+        Запись, оборванная сбоем, и все после нее отбрасываются, а последний
+        журнал (truncate) обрезается до последней целой записи.
+        """
+        with open(path, "rb") as f:
+            data = f.read()
+
+        view = memoryview(data)
+        position = 0
+        records = 0
+        while position + RECORD_HEADER.size <= len(data):
+            length, checksum = RECORD_HEADER.unpack_from(data, position)
+            start = position + RECORD_HEADER.size
+            payload = view[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                break
+            kind, row = marshal.loads(payload)
+            self._apply(kind, row)
+            position = start + length
+            records += 1
+
+        if position < len(data):
+            logger.warning(f"Журнал {path} оборван на позиции {position}, хвост отброшен")
+            if truncate:
+                os.truncate(path, position)
+        return records
+
+    def _apply(self, kind, row):
+        """Применить запись журнала к данным пользователя"""
+        user_id = row[0]
+        if kind == RECORD_DELETE:
+            self._dirty.pop(user_id, None)
+            self._deleted.add(user_id)
+            return
+
+        user = self._dirty.get(user_id)
+        if user is None:
+            if user_id in self._deleted:
+                # Пользователь создан заново после удаления
+                self._deleted.discard(user_id)
+                user = new_user()
+            else:
+                user = (self._snapshot.load_user(user_id) if self._snapshot else None) or new_user()
+            self._dirty[user_id] = user
+
+        if kind == RECORD_USER:
+            _, user["next_project_id"], user["context"], user["summary"], user["summary_pending"], *settings = row
+            # В записях старых версий журнала настроек нет
+            user["settings"] = settings[0] if settings else {}
+        elif kind == RECORD_PROJECT:
+            # Записи старых версий журнала хранят время и дедлайны строками
+            _, project_id, name, description, created_at, status, next_task_id = row
+            project = user["projects"].get(project_id)
+            if project is None:
+                user["projects"][project_id] = Project(
+                    project_id, name, description, timestamp(created_at), ProjectStatus.parse(status),
+                    next_task_id, next_version(),
+                )
+            else:
+                project.name = name
+                project.description = description
+                project.status = ProjectStatus.parse(status)
+                project.next_task_id = next_task_id
+        elif kind == RECORD_TASK:
+            _, project_id, task_id, name, description, created_at, deadline, status = row
+            project = user["projects"].get(project_id)
+            if project is None:
+                return
+            project.tasks[task_id] = Task(
+                task_id, name, description, timestamp(created_at), deadline_ordinal(deadline),
+                TaskStatus.parse(status) or TaskStatus.CREATED, next_version(),
+            )
+
+    def _finish_replay(self):
+        """Пересчитать счетчики по статусам и отметить загрузку у пользователей, восстановленных из журнала"""
+        for user in self._dirty.values():
+            # Проекты и задачи получили версии при проигрывании записей
+            user["version"] = user["loaded_version"] = next_version()
+            for project in user["projects"].values():
+                counts = {}
+                for task in project.tasks.values():
+                    counts[task.status] = counts.get(task.status, 0) + 1
+                project.status_counts = counts
+
+    def _live_user(self, user_id):
+        user = self._dirty.get(user_id)
+        if user is None and self._compacting is not None:
+            user = self._compacting.get(user_id)
+        return user
+
+    def _live_users(self):
+        """Пользователи, чьи данные новее снимка"""
+        if self._compacting is None:
+            return self._dirty
+        live = {**self._compacting, **self._dirty}
+        for user_id in self._deleted:
+            live.pop(user_id, None)
+        return live
+
+    def _touch(self, user_id, user):
+        # Измененный пользователь закрепляется в памяти до следующего снимка.
+        # Искать его в кеше нельзя: пока вызывающий ждал ответа, пользователь
+        # мог уйти из кеша, и тогда его изменения не попали бы в снимок
+        dirty = self._dirty.get(user_id)
+        if dirty is None:
+            self._cache.pop(user_id, None)
+            self._dirty[user_id] = user
+        elif dirty is not user:
+            # Пользователя загрузили заново, пока вызывающий держал старую копию
+            logger.warning(f"Изменена устаревшая копия данных пользователя {user_id}")
+
+    def _remember(self, user_id, user):
+        self._cache[user_id] = user
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
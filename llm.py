@@ -0,0 +1,416 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import json
+import logging
+import random
+import time
+from collections import deque
+
+import httpx
+
+from memory import message_tokens
+from outbound import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Очереди запросов к OpenAI: интерактивные ответы пользователям обслуживаются
+# раньше фоновых задач (резюме разговора и т. п.)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BACKGROUND: "background"}
+
+
+class OpenAIError(Exception):
+    """Ошибка ответа OpenAI API"""
+
+    def __init__(self, status_code, text, retry_after=None):
+        super().__init__(f"{status_code}: {text}")
+        self.status_code = status_code
+        self.text = text
+        self.retry_after = retry_after
+
+    @classmethod
+    def from_response(cls, response, text=None):
+        """Ошибка по ответу httpx с учетом заголовка Retry-After"""
+        try:
+            retry_after = float(response.headers.get("retry-after", ""))
+        except ValueError:
+            retry_after = None
+        return cls(response.status_code, response.text if text is None else text, retry_after)
+
+
+class OpenAIClient:
+    """Клиент OpenAI Chat Completions с общим пулом HTTP-соединений.
+
+    Один httpx.AsyncClient создается на все приложение в start() и
+    закрывается в close(), поэтому соединения (и TLS-сессии) переиспользуются
+    между запросами вместо нового рукопожатия на каждое сообщение.
+    """
+
+    def __init__(self, api_key, url, http2=False, max_connections=100,
+                 max_keepalive_connections=20, keepalive_expiry=30.0,
+                 timeout=30.0, connect_timeout=5.0):
+        self.api_key = api_key
+        self.url = url
+        self.http2 = http2
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.requests_total = 0
+        self._client = None
+
+    def start(self):
+        """Создать HTTP-клиент (вызывается в post_init приложения)"""
+        if self._client is not None and not self._client.is_closed:
+            return
+
+        http2 = self.http2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("Пакет h2 не установлен, HTTP/2 для OpenAI отключен")
+                http2 = False
+
+        self._client = httpx.AsyncClient(
+            http2=http2,
+            limits=self.limits,
+            timeout=self.timeout,
+            headers={
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json"
+            },
+        )
+
+    async def close(self):
+        """Закрыть HTTP-клиент и все соединения пула"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @property
+    def client(self):
+        # Клиент создается лениво, если start() не вызывали (например, вне приложения)
+        if self._client is None or self._client.is_closed:
+            self.start()
+        return self._client
+
+    async def chat(self, payload):
+        """Отправить запрос к Chat Completions и вернуть httpx.Response"""
+        self.requests_total += 1
+        return await self.client.post(self.url, json=payload)
+
+    async def stream_chat(self, payload, on_usage=None):
+        """Потоковый запрос к Chat Completions (stream: true).
+
+        Асинхронный генератор, возвращающий фрагменты текста ответа по мере
+        их поступления. При ответе с ошибкой выбрасывает OpenAIError. Если
+        передан on_usage, в него передается статистика токенов (поле usage
+        последнего фрагмента).
+        """
+        self.requests_total += 1
+        payload = {**payload, "stream": True}
+        if on_usage is not None:
+            payload["stream_options"] = {"include_usage": True}
+        async with self.client.stream("POST", self.url, json=payload) as response:
+            if response.status_code != 200:
+                body = await response.aread()
+                raise OpenAIError.from_response(response, body.decode(errors="replace"))
+
+            # Ответ приходит в формате Server-Sent Events: строки "data: {...}"
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    break
+                chunk = json.loads(data)
+                if on_usage is not None and chunk.get("usage"):
+                    on_usage(chunk["usage"])
+                choices = chunk.get("choices")
+                if not choices:
+                    continue
+                delta = choices[0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+
+    def pool_stats(self):
+        """Статистика пула соединений"""
+        stats = {
+            "http2": False,
+            "requests": self.requests_total,
+            "connections": 0,
+            "idle": 0,
+            "active": 0,
+        }
+        if self._client is None or self._client.is_closed:
+            return stats
+
+        # httpx не предоставляет публичного API для пула, поэтому смотрим
+        # в пул httpcore транспорта, если он доступен
+        pool = getattr(self._client._transport, "_pool", None)
+        connections = getattr(pool, "connections", [])
+        stats["http2"] = getattr(pool, "_http2", False)
+        stats["connections"] = len(connections)
+        stats["idle"] = sum(1 for connection in connections if connection.is_idle())
+        stats["active"] = stats["connections"] - stats["idle"]
+        return stats
+
+
+class PrioritySemaphore:
+    """Семафор, который отдает освободившийся слот ожидающему с наименьшим priority.
+
+    При равном приоритете ожидающие обслуживаются в порядке очереди.
+    """
+
+    def __init__(self, value):
+        self._value = value
+        self._waiters = []
+        self._counter = itertools.count()
+
+    def try_acquire(self):
+        """Занять слот, только если он свободен прямо сейчас и никто не ждет"""
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+            return True
+        return False
+
+    async def acquire(self, priority):
+        """Дождаться слота"""
+        if self.try_acquire():
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Слот успели передать, но ожидание отменили — отдаем его следующему
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        """Освободить слот, передав его первому ожидающему"""
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self._value += 1
+
+
+class OpenAIScheduler:
+    """Планировщик запросов к OpenAI поверх OpenAIClient.
+
+    - не больше max_concurrent запросов одновременно, слоты выдаются по
+      приоритету (PRIORITY_INTERACTIVE раньше PRIORITY_BACKGROUND);
+    - бюджеты requests_per_minute и tokens_per_minute (ведра токенов;
+      стоимость запроса — оценка токенов сообщений плюс max_tokens);
+    - повторы при 429, 5xx и сетевых ошибках с экспоненциальной задержкой
+      со случайным разбросом (но не меньше Retry-After от OpenAI);
+    - если ответ не пришел за hedge_after секунд, параллельно отправляется
+      дубль запроса (только при свободном слоте и остатке бюджетов, дубль
+      тоже расходует бюджеты) и берется первый ответ.
+
+    Время ожидания в очереди запоминается отдельно для каждого приоритета.
+    Если передан on_request, после каждого HTTP-запроса вызывается
+    on_request(статус, длительность, usage): статус — код ответа или "error"
+    при сетевой ошибке, usage — статистика токенов из ответа или None.
+    """
+
+    def __init__(self, client, max_concurrent=10, requests_per_minute=3500,
+                 tokens_per_minute=90000, max_retries=3, backoff_base=0.5,
+                 backoff_max=20.0, hedge_after=10.0, wait_window=1000, on_request=None):
+        self.client = client
+        self.on_request = on_request
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_after = hedge_after
+        self.retries = 0
+        self.hedges = 0
+        self.failures = 0
+        self._semaphore = PrioritySemaphore(max_concurrent)
+        self._requests_bucket = TokenBucket(requests_per_minute / 60, requests_per_minute)
+        self._tokens_bucket = TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+        self._waiting = {priority: 0 for priority in PRIORITY_NAMES}
+        self._wait_times = {priority: deque(maxlen=wait_window) for priority in PRIORITY_NAMES}
+        self._wait_max = {priority: 0.0 for priority in PRIORITY_NAMES}
+
+    async def chat(self, payload, priority=PRIORITY_INTERACTIVE):
+        """Запрос к Chat Completions; возвращает разобранный JSON ответа"""
+        cost = self.estimate_cost(payload)
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self._slot(priority, cost):
+                    return await self._hedged_request(payload, cost)
+            except Exception as e:
+                if attempt == self.max_retries or not self.is_retryable(e):
+                    self.failures += 1
+                    raise
+                delay = self._backoff(attempt, e)
+                logger.warning(f"Повтор запроса к OpenAI через {delay:.1f} с: {e}")
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+    async def stream_chat(self, payload, priority=PRIORITY_INTERACTIVE):
+        """Потоковый запрос; повторяется, только пока не получен первый фрагмент"""
+        cost = self.estimate_cost(payload)
+        for attempt in range(self.max_retries + 1):
+            started = False
+            try:
+                async with self._slot(priority, cost):
+                    request_started = time.monotonic()
+                    usage = {}
+                    try:
+                        async for delta in self.client.stream_chat(payload, on_usage=usage.update):
+                            started = True
+                            yield delta
+                    except OpenAIError as e:
+                        self._observe(e.status_code, request_started, None)
+                        raise
+                    except httpx.TransportError:
+                        self._observe("error", request_started, None)
+                        raise
+                    self._observe(200, request_started, usage or None)
+                return
+            except Exception as e:
+                if started or attempt == self.max_retries or not self.is_retryable(e):
+                    self.failures += 1
+                    raise
+                delay = self._backoff(attempt, e)
+                logger.warning(f"Повтор потокового запроса к OpenAI через {delay:.1f} с: {e}")
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def estimate_cost(payload):
+        """Оценка числа токенов запроса вместе с ответом"""
+        prompt = sum(message_tokens(message) for message in payload.get("messages", []))
+        return prompt + payload.get("max_tokens", 0)
+
+    @staticmethod
+    def is_retryable(error):
+        """Имеет ли смысл повторять запрос после этой ошибки"""
+        if isinstance(error, httpx.TransportError):
+            return True
+        if isinstance(error, OpenAIError):
+            return error.status_code == 429 or error.status_code >= 500
+        return False
+
+    def waiting(self, priority):
+        """Сколько запросов с этим приоритетом ждут слота"""
+        return self._waiting[priority]
+
+    def wait_stats(self):
+        """Время ожидания в очереди по приоритетам (по последним запросам)"""
+        stats = {}
+        for priority, name in PRIORITY_NAMES.items():
+            samples = sorted(self._wait_times[priority])
+            stats[name] = {
+                "waiting": self._waiting[priority],
+                "avg": sum(samples) / len(samples) if samples else 0.0,
+                "p95": samples[int(len(samples) * 0.95)] if samples else 0.0,
+                "max": self._wait_max[priority],
+            }
+        return stats
+
+    def stats(self):
+        """Счетчики планировщика"""
+        return {
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "failures": self.failures,
+            "wait": self.wait_stats(),
+        }
+
+    @contextlib.asynccontextmanager
+    async def _slot(self, priority, cost):
+        started = time.monotonic()
+        self._waiting[priority] += 1
+        try:
+            await self._semaphore.acquire(priority)
+        finally:
+            self._waiting[priority] -= 1
+
+        try:
+            await self._requests_bucket.acquire()
+            await self._tokens_bucket.acquire(cost)
+            waited = time.monotonic() - started
+            self._wait_times[priority].append(waited)
+            self._wait_max[priority] = max(self._wait_max[priority], waited)
+            yield
+        finally:
+            self._semaphore.release()
+
+    async def _request(self, payload):
+        started = time.monotonic()
+        try:
+            response = await self.client.chat(payload)
+        except httpx.TransportError:
+            self._observe("error", started, None)
+            raise
+
+        if response.status_code != 200:
+            self._observe(response.status_code, started, None)
+            raise OpenAIError.from_response(response)
+        data = response.json()
+        self._observe(200, started, data.get("usage"))
+        return data
+
+    def _observe(self, status, started, usage):
+        if self.on_request is not None:
+            self.on_request(status, time.monotonic() - started, usage)
+
+    def _try_charge(self, cost):
+        """Списать запрос из бюджетов RPM и TPM без ожидания; False, если бюджета сейчас нет"""
+        if not self._requests_bucket.try_acquire():
+            return False
+        if not self._tokens_bucket.try_acquire(cost):
+            # Запрос не отправляется — возвращаем его в бюджет RPM
+            self._requests_bucket.tokens += 1
+            return False
+        return True
+
+    async def _hedged_request(self, payload, cost):
+        tasks = {asyncio.ensure_future(self._request(payload))}
+        hedge_slot = False
+        try:
+            if self.hedge_after:
+                done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+                # Дубль отправляется только при свободной емкости, чтобы не
+                # отнимать слоты у очереди и не превышать лимиты OpenAI
+                if not done and self._semaphore.try_acquire():
+                    if self._try_charge(cost):
+                        hedge_slot = True
+                        self.hedges += 1
+                        tasks.add(asyncio.ensure_future(self._request(payload)))
+                    else:
+                        self._semaphore.release()
+
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                succeeded = [task for task in done if task.exception() is None]
+                if succeeded:
+                    return succeeded[0].result()
+                error = next(iter(done)).exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+            if hedge_slot:
+                self._semaphore.release()
+
+    def _backoff(self, attempt, error):
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
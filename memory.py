@@ -0,0 +1,96 @@
+# Служебные токены, которые API добавляет к каждому сообщению
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text):
+    """Грубая оценка числа токенов без токенизатора (около трех символов на токен)"""
+    return len(text) // 3 + 1
+
+
+def message_tokens(message):
+    """Оценка числа токенов одного сообщения разговора"""
+    return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+class ConversationMemory:
+    """Память разговора с ИИ, ограниченная числом сообщений и бюджетом токенов.
+
+    Последние сообщения хранятся в user["context"] как кольцевой буфер: при
+    превышении max_messages или token_budget самые старые сообщения
+    вытесняются в user["summary_pending"]. Когда там набирается
+    summary_refresh сообщений, их нужно свернуть в краткое резюме
+    user["summary"] (это делает вызывающий код через LLM), которое
+    добавляется в запрос отдельным системным сообщением.
+    """
+
+    def __init__(self, max_messages=20, token_budget=1500, summary_refresh=6, max_pending=None):
+        self.max_messages = max_messages
+        self.token_budget = token_budget
+        self.summary_refresh = summary_refresh
+        # Если резюме долго не удается обновить, самые старые сообщения
+        # отбрасываются, чтобы очередь не росла бесконечно
+        self.max_pending = max_pending or summary_refresh * 4
+
+    def build_messages(self, user, system_prompt, message):
+        """Собрать сообщения для запроса: системный промпт, резюме, буфер и новое сообщение"""
+        messages = [{"role": "system", "content": system_prompt}]
+
+        if user and user.get("summary"):
+            messages.append({
+                "role": "system",
+                "content": f"Краткое содержание предыдущего разговора: {user['summary']}"
+            })
+
+        if user:
+            messages.extend(user["context"])
+
+        messages.append({"role": "user", "content": message})
+        return messages
+
+    def remember(self, user, role, content):
+        """Добавить сообщение в буфер, вытеснив старые сверх лимитов"""
+        context = user["context"]
+        context.append({"role": role, "content": content})
+
+        tokens = sum(message_tokens(item) for item in context)
+        while len(context) > 1 and (len(context) > self.max_messages or tokens > self.token_budget):
+            evicted = context.pop(0)
+            tokens -= message_tokens(evicted)
+            user["summary_pending"].append(evicted)
+
+        pending = user["summary_pending"]
+        if len(pending) > self.max_pending:
+            del pending[:len(pending) - self.max_pending]
+
+    def needs_summary(self, user):
+        """Пора ли свернуть вытесненные сообщения в резюме"""
+        return len(user["summary_pending"]) >= self.summary_refresh
+
+    def summary_request(self, user):
+        """Сообщения для запроса к LLM на обновление резюме.
+
+        Возвращает (messages, folded) — folded: сообщения очереди, которые
+        будут учтены в новом резюме.
+        """
+        pending = user["summary_pending"]
+        folded = list(pending)
+        dialog = "\n".join(f"{item['role']}: {item['content']}" for item in pending)
+
+        messages = [
+            {"role": "system", "content": "Ты сжимаешь историю разговора ИИ-ассистента по проектам. "
+                                         "Объедини прежнее резюме и новые реплики в одно краткое резюме "
+                                         "(не больше 5 предложений). Сохрани проекты, задачи, "
+                                         "договоренности и сроки, опусти приветствия и повторы."},
+            {"role": "user", "content": f"Прежнее резюме: {user.get('summary') or 'нет'}\n\n"
+                                        f"Новые реплики:\n{dialog}"}
+        ]
+        return messages, folded
+
+    def apply_summary(self, user, summary, folded):
+        """Сохранить новое резюме и убрать учтенные в нем сообщения из очереди"""
+        user["summary"] = summary.strip()
+        # Сообщения убираются по самим объектам, а не по числу: пока шел запрос,
+        # remember() мог добавить новые сообщения и обрезать начало очереди
+        folded = {id(item) for item in folded}
+        pending = user["summary_pending"]
+        pending[:] = [item for item in pending if id(item) not in folded]
@@ -0,0 +1,144 @@
+import functools
+import logging
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержек, секунды
+HANDLER_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+OPENAI_BUCKETS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+
+
+class Metrics:
+    """Метрики бота в формате Prometheus.
+
+    Метрики создаются в start(), который поднимает HTTP-сервер /metrics
+    (нужен пакет prometheus_client). До этого и без пакета все методы
+    ничего не делают, поэтому вызывать их можно безусловно.
+
+    Счетчики, которые уже ведут другие объекты (ограничитель исходящих
+    сообщений, планировщик OpenAI, кеш ответов), подключаются через
+    add_source() и читаются в момент запроса /metrics.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._sources = []
+
+    def start(self, host="127.0.0.1", port=9100):
+        """Создать метрики и запустить HTTP-сервер /metrics"""
+        try:
+            import prometheus_client
+        except ImportError:
+            logger.warning("Пакет prometheus_client не установлен, метрики отключены")
+            return False
+
+        self.handler_latency = prometheus_client.Histogram(
+            "bot_handler_latency_seconds", "Время обработки обновления обработчиком",
+            ["handler", "outcome"], buckets=HANDLER_BUCKETS,
+        )
+        self.updates_in_flight = prometheus_client.Gauge(
+            "bot_updates_in_flight", "Обновления, которые обрабатываются прямо сейчас",
+        )
+        self.updates_queued = prometheus_client.Gauge(
+            "bot_updates_queued", "Обновления, ждущие в очереди своего пользователя",
+        )
+        self.openai_latency = prometheus_client.Histogram(
+            "bot_openai_request_latency_seconds", "Длительность HTTP-запроса к OpenAI",
+            ["status"], buckets=OPENAI_BUCKETS,
+        )
+        self.openai_tokens = prometheus_client.Counter(
+            "bot_openai_tokens", "Токены, израсходованные в запросах к OpenAI", ["kind"],
+        )
+        self.entities = prometheus_client.Gauge(
+            "bot_entities", "Число сущностей в хранилище", ["kind"],
+        )
+
+        prometheus_client.REGISTRY.register(_SourcesCollector(self._sources))
+        prometheus_client.start_http_server(port, addr=host)
+        self.enabled = True
+        logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+        return True
+
+    def add_source(self, source):
+        """Подключить источник метрик: функцию, возвращающую список
+        (имя, "counter" или "gauge", описание, значение или {метка: значение})"""
+        self._sources.append(source)
+
+    def instrument(self, name, callback):
+        """Обернуть обработчик PTB, измеряя время его выполнения"""
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            if not self.enabled:
+                return await callback(update, context)
+
+            started = time.perf_counter()
+            outcome = "ok"
+            try:
+                return await callback(update, context)
+            except Exception:
+                outcome = "error"
+                raise
+            finally:
+                self.handler_latency.labels(name, outcome).observe(time.perf_counter() - started)
+
+        return wrapper
+
+    @contextmanager
+    def update_in_flight(self):
+        """Учесть обновление как обрабатываемое на время блока with"""
+        if not self.enabled:
+            yield
+            return
+        self.updates_in_flight.inc()
+        try:
+            yield
+        finally:
+            self.updates_in_flight.dec()
+
+    def update_queued(self, delta):
+        """Изменить число обновлений в очередях пользователей"""
+        if self.enabled:
+            self.updates_queued.inc(delta)
+
+    def observe_openai(self, status, seconds, usage):
+        """Учесть HTTP-запрос к OpenAI (вызывается из OpenAIScheduler)"""
+        if not self.enabled:
+            return
+        self.openai_latency.labels(str(status)).observe(seconds)
+        if usage:
+            self.openai_tokens.labels("prompt").inc(usage.get("prompt_tokens", 0))
+            self.openai_tokens.labels("completion").inc(usage.get("completion_tokens", 0))
+
+    def set_entities(self, counts):
+        """Обновить число пользователей, проектов и задач"""
+        if not self.enabled:
+            return
+        for kind, value in counts.items():
+            self.entities.labels(kind).set(value)
+
+
+class _SourcesCollector:
+    """Коллектор prometheus_client, читающий значения из источников Metrics"""
+
+    def __init__(self, sources):
+        self._sources = sources
+
+    def describe(self):
+        # Пустое описание: метрики источников не проверяются при регистрации
+        return []
+
+    def collect(self):
+        from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+        for source in self._sources:
+            for name, kind, documentation, value in source():
+                family_class = CounterMetricFamily if kind == "counter" else GaugeMetricFamily
+                if isinstance(value, dict):
+                    family = family_class(name, documentation, labels=["kind"])
+                    for label, item in value.items():
+                        family.add_metric([label], item)
+                else:
+                    family = family_class(name, documentation, value=value)
+                yield family
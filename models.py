@@ -0,0 +1,150 @@
+from datetime import date, datetime
+from enum import Enum
+
+DEADLINE_FORMAT = "%d.%m.%Y"
+
+
+class TaskStatus(str, Enum):
+    """Статус задачи (колонка канбан-доски).
+
+    Члены перечисления — строки, поэтому сравниваются с текстом статуса и
+    сериализуются в JSON как есть, а у всех задач с одним статусом в памяти
+    лежит один и тот же объект.
+    """
+
+    CREATED = "Создана"
+    IN_PROGRESS = "В работе"
+    REVIEW = "На проверке"
+    DONE = "Завершена"
+
+    def __str__(self):
+        return self.value
+
+    @classmethod
+    def parse(cls, text):
+        """Статус по тексту без учета регистра ('_' считается пробелом); None, если статус неизвестен"""
+        if isinstance(text, cls):
+            return text
+        if not isinstance(text, str):
+            return None
+        return _TASK_STATUSES.get(text.lower().replace("_", " ").strip())
+
+
+_TASK_STATUSES = {status.value.lower(): status for status in TaskStatus}
+
+
+class ProjectStatus(str, Enum):
+    """Статус проекта"""
+
+    IN_PROGRESS = "В процессе"
+
+    def __str__(self):
+        return self.value
+
+    @classmethod
+    def parse(cls, text):
+        """Статус проекта по тексту; неизвестный текст считается статусом «В процессе»"""
+        try:
+            return cls(text)
+        except ValueError:
+            return cls.IN_PROGRESS
+
+
+def parse_deadline(deadline):
+    """Разобрать дедлайн в формате ДД.ММ.ГГГГ; None, если формат не распознан"""
+    if not deadline:
+        return None
+    try:
+        return datetime.strptime(deadline.strip(), DEADLINE_FORMAT).date()
+    except ValueError:
+        return None
+
+
+def deadline_ordinal(deadline):
+    """Дедлайн как порядковый номер дня (date.toordinal) из строки ДД.ММ.ГГГГ или числа; None, если его нет"""
+    if deadline is None or isinstance(deadline, int):
+        return deadline
+    # Строки из хранилища разбираются без strptime: он заметно медленнее
+    day, _, rest = deadline.strip().partition(".")
+    month, _, year = rest.partition(".")
+    try:
+        return date(int(year), int(month), int(day)).toordinal()
+    except ValueError:
+        return None
+
+
+def format_deadline(ordinal):
+    """Дедлайн в виде строки ДД.ММ.ГГГГ или None"""
+    if ordinal is None:
+        return None
+    return date.fromordinal(ordinal).strftime(DEADLINE_FORMAT)
+
+
+def timestamp(created_at=None):
+    """Время в секундах Unix: текущее или из строки ISO (так оно хранилось раньше)"""
+    if created_at is None:
+        return int(datetime.now().timestamp())
+    if isinstance(created_at, int):
+        return created_at
+    try:
+        return int(datetime.fromisoformat(created_at).timestamp())
+    except ValueError:
+        return int(datetime.now().timestamp())
+
+
+def format_timestamp(value):
+    """Время в секундах Unix в виде строки ISO"""
+    return datetime.fromtimestamp(value).isoformat()
+
+
+class Task:
+    """Задача проекта.
+
+    created_at — секунды Unix, deadline — номер дня (date.toordinal) или None,
+    поэтому проверки сроков — сравнения целых чисел. version меняется при
+    каждом изменении задачи.
+    """
+
+    __slots__ = ("id", "name", "description", "created_at", "deadline", "status", "version")
+
+    def __init__(self, id, name, description, created_at, deadline, status, version):
+        self.id = id
+        self.name = name
+        self.description = description
+        self.created_at = created_at
+        self.deadline = deadline
+        self.status = status
+        self.version = version
+
+    def is_overdue(self, today):
+        """Просрочена ли незавершенная задача на день today (date.toordinal)"""
+        return self.deadline is not None and self.deadline < today and self.status != TaskStatus.DONE
+
+
+class Project:
+    """Проект с задачами {id: Task}.
+
+    status_counts — число задач по статусам, next_task_id — следующий ID
+    задачи; version меняется при каждом изменении проекта и его задач.
+    """
+
+    __slots__ = ("id", "name", "description", "created_at", "status", "tasks", "next_task_id",
+                 "status_counts", "version")
+
+    def __init__(self, id, name, description, created_at, status, next_task_id, version):
+        self.id = id
+        self.name = name
+        self.description = description
+        self.created_at = created_at
+        self.status = status
+        self.tasks = {}
+        self.next_task_id = next_task_id
+        self.status_counts = {}
+        self.version = version
+
+    def without_tasks(self):
+        """Копия проекта без задач (для передачи в другой процесс)"""
+        project = Project(self.id, self.name, self.description, self.created_at, self.status,
+                          self.next_task_id, self.version)
+        project.status_counts = dict(self.status_counts)
+        return project
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import time
+
+from telegram import InlineKeyboardMarkup
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина текста сообщения в Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Методы Bot API, отправляющие или меняющие сообщения: на них действуют лимиты Telegram
+LIMITED_ENDPOINT_PREFIXES = ("send", "edit", "copy", "forward")
+
+
+class TokenBucket:
+    """Ведро токенов: не больше rate операций в секунду с запасом capacity"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        """Дождаться и забрать amount токенов (не больше емкости ведра)"""
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return
+            await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def try_acquire(self, amount=1):
+        """Забрать amount токенов, только если они есть прямо сейчас"""
+        amount = min(amount, self.capacity)
+        self._refill()
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+    def is_idle(self):
+        """Ведро полное, то есть давно не использовалось"""
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class TelegramRateLimiter(BaseRateLimiter):
+    """Ограничитель запросов к Bot API для ExtBot.
+
+    Отправка и редактирование сообщений проходят через общее ведро токенов
+    (global_rate сообщений в секунду) и ведро чата (chat_rate в секунду с
+    запасом chat_burst). При ответе 429 запрос повторяется через указанное
+    Telegram время retry_after, но не больше max_retries раз.
+    """
+
+    def __init__(self, global_rate=30.0, chat_rate=1.0, chat_burst=3, max_retries=3):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.retries = 0
+        self.failures = 0
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._last_cleanup = time.monotonic()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        limited = endpoint.startswith(LIMITED_ENDPOINT_PREFIXES)
+        chat_id = data.get("chat_id")
+
+        for attempt in range(self.max_retries + 1):
+            if limited:
+                if chat_id is not None:
+                    await self._chat_bucket(chat_id).acquire()
+                await self._global_bucket.acquire()
+
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    self.failures += 1
+                    raise
+                retry_after = e.retry_after
+                if hasattr(retry_after, "total_seconds"):
+                    retry_after = retry_after.total_seconds()
+                self.retries += 1
+                logger.warning(f"Telegram просит подождать {retry_after} с перед {endpoint}")
+                await asyncio.sleep(retry_after)
+            except Exception:
+                self.failures += 1
+                raise
+
+    def _chat_bucket(self, chat_id):
+        # Ведра неактивных чатов периодически удаляются, чтобы словарь не рос
+        now = time.monotonic()
+        if now - self._last_cleanup > 60:
+            self._chat_buckets = {
+                key: bucket for key, bucket in self._chat_buckets.items() if not bucket.is_idle()
+            }
+            self._last_cleanup = now
+
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+
+class Outbox:
+    """Исходящие сообщения обработчика в один чат.
+
+    Сообщения накапливаются через add() и отправляются в flush(): подряд
+    идущие сообщения склеиваются в одно (тексты через пустую строку,
+    inline-клавиатуры — рядами друг под другом), пока текст помещается в
+    лимит Telegram. Если передан callback query, первое сообщение заменяет
+    текст сообщения с нажатой кнопкой.
+    """
+
+    def __init__(self, bot, chat_id, query=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.query = query
+        self._messages = []
+
+    def add(self, text, reply_markup=None):
+        """Добавить сообщение в очередь"""
+        if self._messages:
+            last_text, last_markup = self._messages[-1]
+            merged_markup = self._merge_markup(last_markup, reply_markup)
+            merged_text = f"{last_text}\n\n{text}"
+            if merged_markup is not False and len(merged_text) <= TELEGRAM_MESSAGE_LIMIT:
+                self._messages[-1] = (merged_text, merged_markup)
+                return
+        self._messages.append((text, reply_markup))
+
+    async def flush(self):
+        """Отправить накопленные сообщения"""
+        messages, self._messages = self._messages, []
+        for index, (text, reply_markup) in enumerate(messages):
+            if index == 0 and self.query is not None:
+                await self.query.edit_message_text(text=text, reply_markup=reply_markup)
+            else:
+                await self.bot.send_message(chat_id=self.chat_id, text=text, reply_markup=reply_markup)
+
+    @staticmethod
+    def _merge_markup(first, second):
+        """Объединить клавиатуры двух сообщений; False, если это невозможно"""
+        if first is None or second is None:
+            return first or second
+        if isinstance(first, InlineKeyboardMarkup) and isinstance(second, InlineKeyboardMarkup):
+            return InlineKeyboardMarkup(tuple(first.inline_keyboard) + tuple(second.inline_keyboard))
+        return False
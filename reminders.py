@@ -0,0 +1,99 @@
+import heapq
+import itertools
+from datetime import date, datetime, time
+
+from models import TaskStatus
+
+
+class DeadlineScheduler:
+    """Планировщик напоминаний о дедлайнах на основе min-heap.
+
+    Для каждой задачи с дедлайном в куче лежит момент напоминания: в
+    reminder_hour часов за days_before дней до дедлайна. Куча обновляется
+    при каждом изменении задачи, а pop_due() достает только наступившие
+    напоминания, поэтому проверка не перебирает все проекты.
+
+    Устаревшие записи (задачу изменили или завершили) из кучи не удаляются,
+    а пропускаются при извлечении: актуальная версия хранится в _scheduled.
+    Дедлайны, о которых уже напомнили, хранятся в _notified: изменение
+    задачи без смены дедлайна не планирует напоминание повторно.
+    """
+
+    def __init__(self, reminder_hour=10, days_before=1, done_status=TaskStatus.DONE):
+        self.reminder_hour = reminder_hour
+        self.days_before = days_before
+        self.done_status = done_status
+        self._heap = []
+        self._scheduled = {}
+        self._notified = {}
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._scheduled)
+
+    def schedule(self, user_id, project_id, task_id, deadline, status, skip_due=False):
+        """Запланировать (или перепланировать) напоминание о задаче (deadline — номер дня или None).
+
+        С skip_due напоминание, момент которого уже наступил, не планируется:
+        так восстанавливаются напоминания после перезапуска, когда неизвестно,
+        было ли оно уже отправлено.
+        """
+        key = (user_id, project_id, task_id)
+
+        if deadline is None or status == self.done_status:
+            self._scheduled.pop(key, None)
+            return
+
+        # Дедлайн уже прошел — напоминать поздно
+        if deadline < date.today().toordinal():
+            self._scheduled.pop(key, None)
+            self._notified.pop(key, None)
+            return
+
+        # О задаче с этим дедлайном уже напомнили
+        if self._notified.get(key) == deadline:
+            self._scheduled.pop(key, None)
+            return
+        self._notified.pop(key, None)
+
+        # Если момент напоминания уже наступил, а дедлайн еще нет, напоминание
+        # сработает при ближайшей проверке
+        remind_at = datetime.combine(date.fromordinal(deadline - self.days_before), time(self.reminder_hour))
+        if skip_due and remind_at <= datetime.now():
+            self._scheduled.pop(key, None)
+            return
+        entry_id = next(self._counter)
+        self._scheduled[key] = (entry_id, deadline)
+        heapq.heappush(self._heap, (remind_at, entry_id, key))
+
+    def unschedule(self, user_id, project_id, task_id):
+        """Отменить напоминание о задаче"""
+        self._scheduled.pop((user_id, project_id, task_id), None)
+        self._notified.pop((user_id, project_id, task_id), None)
+
+    def pop_due(self, now=None):
+        """Извлечь наступившие напоминания: список (user_id, project_id, task_id, номер дня дедлайна)"""
+        now = now or datetime.now()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, entry_id, key = heapq.heappop(self._heap)
+            current = self._scheduled.get(key)
+            if current is None or current[0] != entry_id:
+                continue
+            del self._scheduled[key]
+            self._notified[key] = current[1]
+            due.append((*key, current[1]))
+
+        # Если устаревших записей стало слишком много, пересобираем кучу
+        if len(self._heap) > 2 * len(self._scheduled) + 1024:
+            self._compact()
+
+        return due
+
+    def _compact(self):
+        live = {entry_id for entry_id, _ in self._scheduled.values()}
+        self._heap = [entry for entry in self._heap if entry[1] in live]
+        heapq.heapify(self._heap)
+        # Прошедшие дедлайны больше не запланируют повторно
+        today = date.today().toordinal()
+        self._notified = {key: deadline for key, deadline in self._notified.items() if deadline >= today}
@@ -0,0 +1,303 @@
+import bisect
+import functools
+import heapq
+import re
+from collections import OrderedDict
+
+from models import parse_deadline
+
+_WORD_RE = re.compile(r"\w+")
+_VOWELS = "аеиоуыэюя"
+
+# Окончания для стеммера (упрощенный алгоритм Snowball для русского языка).
+# Окончания групп "после а/я" снимаются, только если перед ними стоит а или я
+_PERFECTIVE_GERUND = re.compile(r"(?:(?<=[ая])(?:в|вши|вшись)|ив|ивши|ившись|ыв|ывши|ывшись)$")
+_REFLEXIVE = re.compile(r"(?:ся|сь)$")
+_ADJECTIVE = (r"(?:ее|ие|ые|ое|ими|ыми|ей|ий|ый|ой|ем|им|ым|ом|его|ого|ему|ому|их|ых|ую|юю|ая|яя"
+              r"|ою|ею)")
+_ADJECTIVAL = re.compile(rf"(?:(?:(?<=[ая])(?:ем|нн|вш|ющ|щ)|ивш|ывш|ующ)?{_ADJECTIVE})$")
+_VERB = re.compile(
+    r"(?:(?<=[ая])(?:ла|на|ете|йте|ли|й|л|ем|н|ло|но|ет|ют|ны|ть|ешь|нно)"
+    r"|ила|ыла|ена|ейте|уйте|ите|или|ыли|ей|уй|ил|ыл|им|ым|ен|ило|ыло|ено|ят|ует|уют|ит|ыт"
+    r"|ены|ить|ыть|ишь|ую|ю)$"
+)
+_NOUN = re.compile(
+    r"(?:иями|ями|ами|иях|иям|ием|ией|ев|ов|ие|ье|еи|ии|ей|ой|ий|ям|ем|ам|ом|ах|ях|ию|ью|ия|ья"
+    r"|а|е|и|й|о|у|ы|ь|ю|я)$"
+)
+_DERIVATIONAL = re.compile(r"ость?$")
+_SUPERLATIVE = re.compile(r"ейше?$")
+
+
+def _rv_start(word):
+    """Начало области RV: позиция после первой гласной"""
+    for index, char in enumerate(word):
+        if char in _VOWELS:
+            return index + 1
+    return len(word)
+
+
+def _r2_start(word):
+    """Начало области R2 (после второго сочетания гласная-согласная)"""
+    start = 0
+    for _ in range(2):
+        index = start
+        while index < len(word) - 1 and not (word[index] in _VOWELS and word[index + 1] not in _VOWELS):
+            index += 1
+        start = index + 2
+    return min(start, len(word))
+
+
+@functools.lru_cache(maxsize=65536)
+def stem(word):
+    """Основа русского слова: отбрасывает окончания и суффиксы словоизменения"""
+    word = word.lower().replace("ё", "е")
+    rv_start = _rv_start(word)
+    prefix, rv = word[:rv_start], word[rv_start:]
+
+    match = _PERFECTIVE_GERUND.search(rv)
+    if match:
+        rv = rv[:match.start()]
+    else:
+        rv = _REFLEXIVE.sub("", rv)
+        for pattern in (_ADJECTIVAL, _VERB, _NOUN):
+            match = pattern.search(rv)
+            if match:
+                rv = rv[:match.start()]
+                break
+
+    if rv.endswith("и"):
+        rv = rv[:-1]
+
+    # Словообразовательный суффикс -ость снимается только в области R2
+    match = _DERIVATIONAL.search(rv)
+    if match and rv_start + match.start() >= _r2_start(prefix + rv):
+        rv = rv[:match.start()]
+
+    if rv.endswith("нн"):
+        rv = rv[:-1]
+    else:
+        match = _SUPERLATIVE.search(rv)
+        if match:
+            rv = rv[:match.start()]
+            if rv.endswith("нн"):
+                rv = rv[:-1]
+        elif rv.endswith("ь"):
+            rv = rv[:-1]
+
+    return prefix + rv
+
+
+def tokenize(text):
+    """Основы слов текста"""
+    return [stem(word) for word in _WORD_RE.findall(text.lower())]
+
+
+def normalize_status(status):
+    """Статус для сравнения в фильтре: без регистра, '_' считается пробелом"""
+    return status.lower().replace("_", " ").strip()
+
+
+class SearchQuery:
+    """Разобранный поисковый запрос.
+
+    Слова запроса ищутся по основам; слово со звездочкой на конце
+    ("дизайн*") ищется как префикс. Фильтры в тексте запроса:
+    статус:новая (или status:, пробелы в статусе — через '_'),
+    до:ДД.ММ.ГГГГ и после:ДД.ММ.ГГГГ (before:/after:) — по дедлайну
+    (before и after хранятся номерами дней, как дедлайны задач).
+    """
+
+    FILTER_ALIASES = {
+        "статус": "status", "status": "status",
+        "до": "before", "before": "before",
+        "после": "after", "after": "after",
+    }
+
+    def __init__(self, terms=(), prefixes=(), status=None, before=None, after=None):
+        self.terms = list(terms)
+        self.prefixes = list(prefixes)
+        self.status = normalize_status(status) if status else None
+        self.before = before
+        self.after = after
+
+    @classmethod
+    def parse(cls, text, status=None, before=None, after=None):
+        """Разобрать текст запроса; фильтры можно передать и отдельно.
+
+        Возвращает (запрос, ошибка): ошибка — текст для пользователя или None.
+        """
+        filters = {"status": status, "before": before, "after": after}
+        words = []
+        for token in text.split():
+            key, separator, value = token.partition(":")
+            name = cls.FILTER_ALIASES.get(key.lower()) if separator else None
+            if name and value:
+                filters[name] = value
+            else:
+                words.append(token)
+
+        dates = {}
+        for name in ("before", "after"):
+            if filters[name]:
+                day = parse_deadline(filters[name])
+                if day is None:
+                    return None, f"дата '{filters[name]}' должна быть в формате ДД.ММ.ГГГГ"
+                dates[name] = day.toordinal()
+
+        terms = []
+        prefixes = []
+        for word in words:
+            if word.endswith("*"):
+                prefixes.extend(tokenize(word[:-1]))
+            else:
+                terms.extend(tokenize(word))
+
+        query = cls(terms, prefixes, filters["status"], dates.get("before"), dates.get("after"))
+        if query.is_empty():
+            return None, "пустой запрос"
+        return query, None
+
+    def is_empty(self):
+        return not (self.terms or self.prefixes or self.status or self.before or self.after)
+
+
+class _UserIndex:
+    """Инвертированный индекс задач одного пользователя"""
+
+    def __init__(self):
+        # основа -> {(project_id, task_id): вес}; совпадение в названии весит больше
+        self.postings = {}
+        # отсортированный словарь основ для префиксного поиска
+        self.vocabulary = []
+        # (project_id, task_id) -> (основы, нормализованный статус, номер дня дедлайна)
+        self.documents = {}
+
+    def add(self, key, task):
+        self.remove(key)
+        weights = {}
+        for term in tokenize(task.description or ""):
+            weights[term] = 1
+        for term in tokenize(task.name):
+            weights[term] = 2
+
+        for term, weight in weights.items():
+            postings = self.postings.get(term)
+            if postings is None:
+                postings = self.postings[term] = {}
+                bisect.insort(self.vocabulary, term)
+            postings[key] = weight
+
+        self.documents[key] = (tuple(weights), normalize_status(task.status), task.deadline)
+
+    def remove(self, key):
+        document = self.documents.pop(key, None)
+        if document is None:
+            return
+        for term in document[0]:
+            postings = self.postings[term]
+            del postings[key]
+            if not postings:
+                del self.postings[term]
+                del self.vocabulary[bisect.bisect_left(self.vocabulary, term)]
+
+    def prefix_postings(self, prefix):
+        """Объединение списков для всех основ, начинающихся с prefix"""
+        matched = []
+        index = bisect.bisect_left(self.vocabulary, prefix)
+        while index < len(self.vocabulary) and self.vocabulary[index].startswith(prefix):
+            matched.append(self.postings[self.vocabulary[index]])
+            index += 1
+        if len(matched) == 1:
+            return matched[0]
+
+        merged = {}
+        for postings in matched:
+            for key, weight in postings.items():
+                if weight > merged.get(key, 0):
+                    merged[key] = weight
+        return merged
+
+    def search(self, query, limit):
+        groups = [self.postings.get(term, {}) for term in query.terms]
+        groups += [self.prefix_postings(prefix) for prefix in query.prefixes]
+
+        if groups:
+            # Пересекаем, начиная с самого короткого списка
+            groups.sort(key=len)
+            scores = dict(groups[0])
+            for postings in groups[1:]:
+                scores = {key: score + postings[key] for key, score in scores.items() if key in postings}
+                if not scores:
+                    break
+        else:
+            # Запрос только из фильтров
+            scores = dict.fromkeys(self.documents, 0)
+
+        results = []
+        for key, score in scores.items():
+            _, status, deadline = self.documents[key]
+            if query.status and status != query.status:
+                continue
+            if query.before and (deadline is None or deadline > query.before):
+                continue
+            if query.after and (deadline is None or deadline < query.after):
+                continue
+            results.append((-score, key))
+
+        return [key for _, key in heapq.nsmallest(limit, results)]
+
+
+class TaskSearchIndex:
+    """Полнотекстовый поиск по названиям и описаниям задач.
+
+    Индекс пользователя строится при первом поиске (build_user) и дальше
+    обновляется через update_task/remove_task. Индексы хранятся для
+    max_users пользователей, давно не искавших вытесняются (LRU) и
+    строятся заново при следующем поиске.
+    """
+
+    def __init__(self, max_users=10000):
+        self.max_users = max_users
+        self._users = OrderedDict()
+
+    def is_indexed(self, user_id):
+        return user_id in self._users
+
+    def build_user(self, user_id, user):
+        """Построить индекс всех задач пользователя"""
+        index = _UserIndex()
+        for project in user["projects"].values():
+            for task in project.tasks.values():
+                index.add((project.id, task.id), task)
+
+        self._users[user_id] = index
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+        return index
+
+    def update_task(self, user_id, project_id, task):
+        """Добавить или переиндексировать задачу (если индекс пользователя уже построен)"""
+        index = self._users.get(user_id)
+        if index is not None:
+            index.add((project_id, task.id), task)
+
+    def remove_task(self, user_id, project_id, task_id):
+        """Убрать задачу из индекса"""
+        index = self._users.get(user_id)
+        if index is not None:
+            index.remove((project_id, task_id))
+
+    def drop_user(self, user_id):
+        """Забыть индекс пользователя"""
+        self._users.pop(user_id, None)
+
+    def search(self, user_id, user, query, limit=20):
+        """Найти задачи пользователя: список (project_id, task_id) по убыванию релевантности"""
+        index = self._users.get(user_id)
+        if index is None:
+            index = self.build_user(user_id, user)
+        else:
+            self._users.move_to_end(user_id)
+        return index.search(query, limit)
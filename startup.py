@@ -0,0 +1,25 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Момент запуска: bot.py импортирует этот модуль первым, поэтому сюда
+# входит импорт всех остальных модулей
+STARTED_AT = time.monotonic()
+
+# Этап запуска -> секунды от STARTED_AT
+_stages = {}
+
+
+def mark(stage, message=None):
+    """Отметить завершение этапа запуска (повторные отметки игнорируются)"""
+    if stage in _stages:
+        return
+    _stages[stage] = time.monotonic() - STARTED_AT
+    if message:
+        logger.info(f"{message}: {_stages[stage]:.3f} с от запуска")
+
+
+def stages():
+    """Время этапов запуска: {этап: секунды от запуска}"""
+    return dict(_stages)
@@ -0,0 +1,489 @@
+import itertools
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+
+from models import (
+    Project,
+    ProjectStatus,
+    Task,
+    TaskStatus,
+    deadline_ordinal,
+    format_deadline,
+    format_timestamp,
+    timestamp,
+)
+
+logger = logging.getLogger(__name__)
+
+# Версии данных растут при каждом изменении. Счетчик начинается с текущего
+# времени в микросекундах, поэтому версии не повторяются и после перезапуска
+_versions = itertools.count(time.time_ns() // 1000)
+
+
+def next_version():
+    """Следующая версия данных"""
+    return next(_versions)
+
+
+class Storage:
+    """Базовый класс хранилища данных пользователей.
+
+    Данные пользователя — словарь вида
+    {"projects": {id: Project}, "next_project_id": int, "context": [...],
+    "summary": str, "summary_pending": [...], "settings": {...}},
+    задачи проекта лежат в project.tasks как {id: Task}, а следующий
+    ID задачи — в project.next_task_id. Словари сохраняют порядок
+    добавления, поэтому списки выводятся в том же порядке, что и раньше.
+    Счетчики задач по статусам project.status_counts и версии
+    user["version"], project.version и task.version (меняются при
+    каждом изменении и используются для кеширования и синхронизации
+    мини-приложения) не сохраняются, а создаются при загрузке;
+    user["loaded_version"] — версия на момент загрузки: версии, выданные
+    до нее, нельзя сравнивать с версиями загруженных данных.
+    ProjectManager изменяет данные на месте и сообщает хранилищу об изменениях
+    через методы save_*, чтобы хранилище могло сохранить их на диск. В save_*
+    передаются сами данные пользователя: вызывающий мог держать их, пока ждал
+    ответа OpenAI или Telegram, и за это время они могли уйти из кеша.
+    """
+
+    def get_user(self, user_id):
+        """Получить данные пользователя или None, если пользователя нет"""
+        raise NotImplementedError
+
+    def create_user(self, user_id):
+        """Создать пустые данные пользователя"""
+        raise NotImplementedError
+
+    def save_project(self, user_id, user, project):
+        """Сохранить проект (без задач) пользователя user"""
+
+    def save_task(self, user_id, user, project_id, task):
+        """Сохранить задачу пользователя user"""
+
+    def save_user(self, user_id, user):
+        """Сохранить данные уровня пользователя (память разговора, счетчики ID)"""
+
+    def user_ids(self):
+        """Итератор по ID всех пользователей"""
+        raise NotImplementedError
+
+    def delete_user(self, user_id):
+        """Удалить пользователя со всеми проектами и задачами"""
+        raise NotImplementedError
+
+    def iter_deadlines(self):
+        """Перебрать все задачи с дедлайном: (user_id, project_id, task_id, номер дня дедлайна, статус)"""
+        raise NotImplementedError
+
+    def iter_settings(self):
+        """Перебрать непустые настройки пользователей: (user_id, настройки)"""
+        raise NotImplementedError
+
+    def count_entities(self):
+        """Число пользователей, проектов и задач: {"users": ..., "projects": ..., "tasks": ...}"""
+        raise NotImplementedError
+
+    def flush(self):
+        """Записать накопленные изменения"""
+
+    async def compact(self):
+        """Сжать данные на диске, если хранилищу это нужно; True, если сжатие выполнено"""
+        return False
+
+    def close(self):
+        """Закрыть хранилище"""
+        self.flush()
+
+
+def new_user():
+    """Пустые данные нового пользователя"""
+    version = next_version()
+    return {
+        "projects": {},
+        "next_project_id": 1,
+        "context": [],
+        "summary": "",
+        "summary_pending": [],
+        "settings": {},
+        "version": version,
+        "loaded_version": version,
+    }
+
+
+def build_user(next_project_id, context, summary, summary_pending, project_rows, task_rows, settings=None):
+    """Собрать данные пользователя из строк хранилища.
+
+    settings — словарь настроек пользователя (время сводки, часовой пояс и т.п.),
+    project_rows — (id, name, description, created_at, status, next_task_id),
+    task_rows — (project_id, id, name, description, created_at, deadline, status).
+    Время создания — секунды Unix или строка ISO, дедлайн — номер дня или
+    строка ДД.ММ.ГГГГ (так данные хранились раньше и хранятся в SQLite),
+    статусы — текст; неизвестный статус задачи считается статусом «Создана».
+    Счетчики по статусам и версии создаются заново.
+    """
+    projects = {}
+    for project_id, name, description, created_at, status, next_task_id in project_rows:
+        projects[project_id] = Project(
+            project_id, name, description, timestamp(created_at), ProjectStatus.parse(status),
+            next_task_id, next_version(),
+        )
+
+    for project_id, task_id, name, description, created_at, deadline, status in task_rows:
+        project = projects.get(project_id)
+        if project is None:
+            continue
+        status = TaskStatus.parse(status) or TaskStatus.CREATED
+        project.tasks[task_id] = Task(
+            task_id, name, description, timestamp(created_at), deadline_ordinal(deadline), status,
+            next_version(),
+        )
+        project.status_counts[status] = project.status_counts.get(status, 0) + 1
+
+    # Версия загрузки выдается после версий всех проектов и задач
+    version = next_version()
+    return {
+        "projects": projects,
+        "next_project_id": next_project_id,
+        "context": context,
+        "summary": summary,
+        "summary_pending": summary_pending,
+        "settings": settings or {},
+        "version": version,
+        "loaded_version": version,
+    }
+
+
+def user_rows(user):
+    """Строки проектов и задач пользователя в том виде, в каком их принимает build_user"""
+    project_rows = []
+    task_rows = []
+    for project in user["projects"].values():
+        project_rows.append(project_row(project))
+        for task in project.tasks.values():
+            task_rows.append(task_row(project.id, task))
+    return project_rows, task_rows
+
+
+def project_row(project):
+    """Строка проекта: статус — текстом, время — секундами Unix"""
+    return (
+        project.id, project.name, project.description,
+        project.created_at, project.status.value, project.next_task_id,
+    )
+
+
+def task_row(project_id, task):
+    """Строка задачи: статус — текстом, время — секундами Unix, дедлайн — номером дня"""
+    return (
+        project_id, task.id, task.name, task.description,
+        task.created_at, task.deadline, task.status.value,
+    )
+
+
+class MemoryStorage(Storage):
+    """Хранилище в памяти процесса (данные теряются при перезапуске)"""
+
+    def __init__(self):
+        self._users = {}
+
+    def get_user(self, user_id):
+        return self._users.get(user_id)
+
+    def create_user(self, user_id):
+        user = new_user()
+        self._users[user_id] = user
+        return user
+
+    def user_ids(self):
+        return iter(list(self._users))
+
+    def delete_user(self, user_id):
+        self._users.pop(user_id, None)
+
+    def iter_deadlines(self):
+        for user_id, user in self._users.items():
+            for project in user["projects"].values():
+                for task in project.tasks.values():
+                    if task.deadline is not None:
+                        yield user_id, project.id, task.id, task.deadline, task.status
+
+    def iter_settings(self):
+        for user_id, user in list(self._users.items()):
+            if user["settings"]:
+                yield user_id, user["settings"]
+
+    def count_entities(self):
+        projects = 0
+        tasks = 0
+        for user in self._users.values():
+            projects += len(user["projects"])
+            tasks += sum(len(project.tasks) for project in user["projects"].values())
+        return {"users": len(self._users), "projects": projects, "tasks": tasks}
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    next_project_id INTEGER NOT NULL DEFAULT 1,
+    context TEXT NOT NULL DEFAULT '[]',
+    summary TEXT NOT NULL DEFAULT '',
+    summary_pending TEXT NOT NULL DEFAULT '[]',
+    settings TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS projects (
+    user_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    description TEXT NOT NULL DEFAULT '',
+    created_at TEXT NOT NULL,
+    status TEXT NOT NULL,
+    next_task_id INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (user_id, id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS tasks (
+    user_id INTEGER NOT NULL,
+    project_id INTEGER NOT NULL,
+    id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    description TEXT NOT NULL DEFAULT '',
+    created_at TEXT NOT NULL,
+    deadline TEXT,
+    status TEXT NOT NULL,
+    PRIMARY KEY (user_id, project_id, id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks (user_id, project_id, status);
+CREATE INDEX IF NOT EXISTS idx_tasks_deadline ON tasks (deadline) WHERE deadline IS NOT NULL;
+"""
+
+# Колонки, добавленные после первой версии схемы:
+# (таблица, колонка, определение, запрос для заполнения существующих строк)
+SQLITE_MIGRATIONS = [
+    ("users", "next_project_id", "INTEGER NOT NULL DEFAULT 1",
+     "UPDATE users SET next_project_id = 1 + (SELECT COALESCE(MAX(id), 0) FROM projects "
+     "WHERE projects.user_id = users.user_id)"),
+    ("users", "summary", "TEXT NOT NULL DEFAULT ''", None),
+    ("users", "summary_pending", "TEXT NOT NULL DEFAULT '[]'", None),
+    ("users", "settings", "TEXT NOT NULL DEFAULT '{}'", None),
+    ("projects", "next_task_id", "INTEGER NOT NULL DEFAULT 1",
+     "UPDATE projects SET next_task_id = 1 + (SELECT COALESCE(MAX(id), 0) FROM tasks "
+     "WHERE tasks.user_id = projects.user_id AND tasks.project_id = projects.id)"),
+]
+
+# Запросы держим в константах: sqlite3 кеширует подготовленные выражения
+# по тексту запроса, поэтому текст должен быть одним и тем же
+SQL_SELECT_USER = (
+    "SELECT next_project_id, context, summary, summary_pending, settings FROM users WHERE user_id = ?"
+)
+SQL_SELECT_PROJECTS = (
+    "SELECT id, name, description, created_at, status, next_task_id "
+    "FROM projects WHERE user_id = ? ORDER BY id"
+)
+SQL_SELECT_TASKS = (
+    "SELECT project_id, id, name, description, created_at, deadline, status "
+    "FROM tasks WHERE user_id = ? ORDER BY project_id, id"
+)
+SQL_SELECT_USER_IDS = "SELECT user_id FROM users"
+SQL_SELECT_SETTINGS = "SELECT user_id, settings FROM users WHERE settings != '{}'"
+SQL_SELECT_DEADLINES = (
+    "SELECT user_id, project_id, id, deadline, status FROM tasks WHERE deadline IS NOT NULL"
+)
+SQL_UPSERT_USER = (
+    "INSERT OR REPLACE INTO users (user_id, next_project_id, context, summary, summary_pending, settings) "
+    "VALUES (?, ?, ?, ?, ?, ?)"
+)
+SQL_UPSERT_PROJECT = (
+    "INSERT OR REPLACE INTO projects "
+    "(user_id, id, name, description, created_at, status, next_task_id) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?)"
+)
+SQL_UPSERT_TASK = (
+    "INSERT OR REPLACE INTO tasks "
+    "(user_id, project_id, id, name, description, created_at, deadline, status) "
+    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+
+class SQLiteStorage(Storage):
+    """Хранилище в SQLite (режим WAL) с пакетной записью и LRU-кешем пользователей.
+
+    Изменения накапливаются в памяти и записываются одной транзакцией, когда
+    набирается batch_size строк или проходит flush_interval секунд. Повторные
+    изменения одной строки внутри пакета схлопываются в одну запись.
+    В памяти держатся данные не более cache_size пользователей.
+    """
+
+    def __init__(self, path, batch_size=100, flush_interval=1.0, cache_size=1000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+
+        self._conn = sqlite3.connect(path, cached_statements=32)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SQLITE_SCHEMA)
+        self._migrate()
+
+        self._cache = OrderedDict()
+        self._pending_users = {}
+        self._pending_projects = {}
+        self._pending_tasks = {}
+        self._last_flush = time.monotonic()
+
+    def get_user(self, user_id):
+        user = self._cache.get(user_id)
+        if user is not None:
+            self._cache.move_to_end(user_id)
+            return user
+
+        user = self._load_user(user_id)
+        if user is not None:
+            self._remember(user_id, user)
+        return user
+
+    def create_user(self, user_id):
+        user = new_user()
+        self._remember(user_id, user)
+        self.save_user(user_id, user)
+        return user
+
+    def save_project(self, user_id, user, project):
+        # В SQLite время и дедлайны хранятся строками, как в первой версии схемы
+        self._pending_projects[(user_id, project.id)] = (
+            user_id,
+            project.id,
+            project.name,
+            project.description,
+            format_timestamp(project.created_at),
+            project.status.value,
+            project.next_task_id,
+        )
+        self._maybe_flush()
+
+    def save_task(self, user_id, user, project_id, task):
+        self._pending_tasks[(user_id, project_id, task.id)] = (
+            user_id,
+            project_id,
+            task.id,
+            task.name,
+            task.description,
+            format_timestamp(task.created_at),
+            format_deadline(task.deadline),
+            task.status.value,
+        )
+        self._maybe_flush()
+
+    def save_user(self, user_id, user):
+        self._pending_users[user_id] = (
+            user_id,
+            user["next_project_id"],
+            json.dumps(user["context"], ensure_ascii=False),
+            user["summary"],
+            json.dumps(user["summary_pending"], ensure_ascii=False),
+            json.dumps(user["settings"], ensure_ascii=False),
+        )
+        self._maybe_flush()
+
+    def user_ids(self):
+        self.flush()
+        return (row[0] for row in self._conn.execute(SQL_SELECT_USER_IDS).fetchall())
+
+    def delete_user(self, user_id):
+        self.flush()
+        with self._conn:
+            for table in ("tasks", "projects", "users"):
+                self._conn.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+        self._cache.pop(user_id, None)
+
+    def iter_deadlines(self):
+        self.flush()
+        for user_id, project_id, task_id, deadline, status in self._conn.execute(SQL_SELECT_DEADLINES):
+            yield user_id, project_id, task_id, deadline_ordinal(deadline), status
+
+    def iter_settings(self):
+        self.flush()
+        for user_id, settings in self._conn.execute(SQL_SELECT_SETTINGS).fetchall():
+            yield user_id, json.loads(settings)
+
+    def count_entities(self):
+        self.flush()
+        return {
+            table: self._conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ("users", "projects", "tasks")
+        }
+
+    def flush(self):
+        if self._pending_users or self._pending_projects or self._pending_tasks:
+            with self._conn:
+                self._conn.executemany(SQL_UPSERT_USER, self._pending_users.values())
+                self._conn.executemany(SQL_UPSERT_PROJECT, self._pending_projects.values())
+                self._conn.executemany(SQL_UPSERT_TASK, self._pending_tasks.values())
+            self._pending_users.clear()
+            self._pending_projects.clear()
+            self._pending_tasks.clear()
+        self._last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+    def _migrate(self):
+        """Добавить колонки, которых нет в базе, созданной старой версией схемы"""
+        for table, column, definition, backfill in SQLITE_MIGRATIONS:
+            columns = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+            if column not in columns:
+                logger.info(f"Добавляем колонку {table}.{column}")
+                with self._conn:
+                    self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+                    if backfill:
+                        self._conn.execute(backfill)
+
+    def _pending_count(self):
+        return len(self._pending_users) + len(self._pending_projects) + len(self._pending_tasks)
+
+    def _maybe_flush(self):
+        if (self._pending_count() >= self.batch_size
+                or time.monotonic() - self._last_flush >= self.flush_interval):
+            self.flush()
+
+    def _remember(self, user_id, user):
+        self._cache[user_id] = user
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _load_user(self, user_id):
+        # Несохраненные изменения могли остаться от вытесненного из кеша пользователя
+        if self._pending_count():
+            self.flush()
+
+        row = self._conn.execute(SQL_SELECT_USER, (user_id,)).fetchone()
+        if row is None:
+            return None
+
+        next_project_id, context, summary, summary_pending, settings = row
+        return build_user(
+            next_project_id,
+            json.loads(context),
+            summary,
+            json.loads(summary_pending),
+            self._conn.execute(SQL_SELECT_PROJECTS, (user_id,)),
+            self._conn.execute(SQL_SELECT_TASKS, (user_id,)),
+            json.loads(settings),
+        )
+
+
+def create_storage(backend, path=None, **options):
+    """Создать хранилище по названию бэкенда ("memory", "sqlite" или "journal")"""
+    if backend == "memory":
+        return MemoryStorage()
+    if backend == "sqlite":
+        logger.info(f"Используется SQLite-хранилище: {path}")
+        return SQLiteStorage(path, **options)
+    if backend == "journal":
+        from journal import JournalStorage
+        logger.info(f"Используется хранилище-журнал: {path}")
+        return JournalStorage(path, **options)
+    raise ValueError(f"Неизвестный тип хранилища: {backend}")
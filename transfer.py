@@ -0,0 +1,165 @@
+import csv
+import io
+import json
+
+from models import TaskStatus, format_deadline, format_timestamp, parse_deadline, timestamp
+
+# Формат выгрузки: одна строка на задачу с полями ее проекта; проект без задач
+# выгружается одной строкой с пустыми полями задачи. Тот же набор полей
+# используется и в CSV (заголовок), и в NDJSON (ключи объекта в каждой строке)
+FIELDS = (
+    "project_id",
+    "project_name",
+    "project_description",
+    "project_status",
+    "task_id",
+    "task_name",
+    "task_description",
+    "task_status",
+    "task_deadline",
+    "task_created_at",
+)
+
+FORMATS = ("ndjson", "csv")
+
+
+class TransferError(ValueError):
+    """Файл импорта не удалось разобрать"""
+
+
+def export_records(user):
+    """Записи выгрузки пользователя по одной, без сборки всей выгрузки в памяти"""
+    # Списки вместо живых представлений: между кусками выгрузки обработчик
+    # отдает управление циклу событий, и словари могут измениться
+    for project in list(user["projects"].values()):
+        project_fields = (project.id, project.name, project.description, project.status.value)
+        if not project.tasks:
+            yield dict(zip(FIELDS, project_fields + (None,) * 6))
+            continue
+        for task in list(project.tasks.values()):
+            yield dict(zip(FIELDS, project_fields + (
+                task.id, task.name, task.description, task.status.value,
+                format_deadline(task.deadline), format_timestamp(task.created_at)
+            )))
+
+
+def export_chunks(user, fmt, chunk_rows=500):
+    """Выгрузка в формате fmt кусками по chunk_rows записей (байты в UTF-8)"""
+    buffer = io.StringIO()
+    if fmt == "csv":
+        writer = csv.DictWriter(buffer, FIELDS, lineterminator="\n")
+        writer.writeheader()
+        write = writer.writerow
+    else:
+        def write(record):
+            buffer.write(json.dumps(record, ensure_ascii=False))
+            buffer.write("\n")
+
+    rows = 0
+    for record in export_records(user):
+        write(record)
+        rows += 1
+        if rows % chunk_rows == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def detect_format(file_name, head):
+    """Формат файла импорта по расширению, а если оно незнакомо — по первому символу"""
+    name = (file_name or "").lower()
+    if name.endswith(".csv"):
+        return "csv"
+    if name.endswith((".ndjson", ".jsonl", ".json")):
+        return "ndjson"
+    return "ndjson" if head.lstrip().startswith("{") else "csv"
+
+
+def read_records(text, fmt):
+    """Записи из текстового файла импорта: словари с ключами из FIELDS.
+
+    Строки читаются по одной; при ошибке разбора выбрасывается TransferError
+    с номером строки.
+    """
+    if fmt == "csv":
+        reader = csv.DictReader(text)
+        if not reader.fieldnames or "project_name" not in reader.fieldnames:
+            raise TransferError("в заголовке CSV нет колонки project_name")
+        try:
+            for record in reader:
+                yield reader.line_num, record
+        except csv.Error as e:
+            raise TransferError(f"строка {reader.line_num}: {e}")
+        return
+
+    for line_number, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            raise TransferError(f"строка {line_number}: некорректный JSON")
+        if not isinstance(record, dict):
+            raise TransferError(f"строка {line_number}: ожидается JSON-объект")
+        yield line_number, record
+
+
+def _text(value):
+    """Значение поля как строка (пустые ячейки CSV и null в JSON — пустая строка)"""
+    return "" if value is None else str(value)
+
+
+def _id(line_number, record, field):
+    """ID из записи: целое число или None, если поле пустое"""
+    value = _text(record.get(field)).strip()
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise TransferError(f"строка {line_number}: {field} должен быть числом")
+
+
+def parse_record(line_number, record):
+    """Проверить запись импорта.
+
+    Возвращает (ID проекта в файле или None, название проекта, описание
+    проекта, задача или None); у задачи есть ID из файла ("id", может быть
+    None). При ошибке выбрасывается TransferError.
+    """
+    project_name = _text(record.get("project_name")).strip()
+    if not project_name:
+        raise TransferError(f"строка {line_number}: не указано название проекта")
+    project_id = _id(line_number, record, "project_id")
+    project_description = _text(record.get("project_description"))
+
+    task_name = _text(record.get("task_name")).strip()
+    if not task_name:
+        return project_id, project_name, project_description, None
+
+    deadline = _text(record.get("task_deadline")).strip() or None
+    if deadline is not None:
+        day = parse_deadline(deadline)
+        if day is None:
+            raise TransferError(f"строка {line_number}: дедлайн '{deadline}' не в формате ДД.ММ.ГГГГ")
+        deadline = day.toordinal()
+
+    status = _text(record.get("task_status")).strip()
+    if status:
+        status = TaskStatus.parse(status)
+        if status is None:
+            known = ", ".join(item.value for item in TaskStatus)
+            raise TransferError(f"строка {line_number}: неизвестный статус задачи (возможные: {known})")
+
+    created_at = _text(record.get("task_created_at")).strip()
+    task = {
+        "id": _id(line_number, record, "task_id"),
+        "name": task_name,
+        "description": _text(record.get("task_description")),
+        "status": status or TaskStatus.CREATED,
+        "deadline": deadline,
+        "created_at": timestamp(created_at) if created_at else None,
+    }
+    return project_id, project_name, project_description, task
@@ -0,0 +1,270 @@
+import hashlib
+import hmac
+import inspect
+import json
+import logging
+import os
+import time
+from urllib.parse import parse_qsl
+
+from models import format_deadline, format_timestamp
+
+logger = logging.getLogger(__name__)
+
+
+def validate_init_data(init_data, bot_token, max_age=86400):
+    """Проверить подпись initData мини-приложения Telegram.
+
+    Возвращает данные пользователя (словарь из поля user) или None, если
+    подпись не сходится или данные старше max_age секунд.
+    """
+    params = dict(parse_qsl(init_data, keep_blank_values=True))
+    received_hash = params.pop("hash", None)
+    if not received_hash:
+        return None
+
+    data_check_string = "\n".join(f"{key}={value}" for key, value in sorted(params.items()))
+    secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+    expected_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected_hash, received_hash):
+        return None
+
+    try:
+        auth_date = int(params.get("auth_date", "0"))
+        user = json.loads(params["user"])
+    except (KeyError, ValueError):
+        return None
+
+    if max_age and time.time() - auth_date > max_age:
+        return None
+    return user
+
+
+def serialize_task(task):
+    """Задача в формате JSON для мини-приложения (дедлайн — ДД.ММ.ГГГГ, время — ISO)"""
+    return {
+        "id": task.id,
+        "name": task.name,
+        "description": task.description,
+        "status": task.status.value,
+        "deadline": format_deadline(task.deadline),
+        "created_at": format_timestamp(task.created_at),
+    }
+
+
+def serialize_project(project, with_tasks=True):
+    """Проект в формате JSON для мини-приложения"""
+    data = {
+        "id": project.id,
+        "name": project.name,
+        "description": project.description,
+        "status": project.status.value,
+        "created_at": format_timestamp(project.created_at),
+        "version": project.version,
+    }
+    if with_tasks:
+        data["tasks"] = [serialize_task(task) for task in project.tasks.values()]
+    return data
+
+
+def cors_middleware(origin):
+    """Middleware aiohttp, разрешающее запросы мини-приложения с другого домена"""
+    from aiohttp import web
+
+    @web.middleware
+    async def middleware(request, handler):
+        if request.method == "OPTIONS":
+            response = web.Response()
+        else:
+            try:
+                response = await handler(request)
+            except web.HTTPException as e:
+                response = e
+        response.headers["Access-Control-Allow-Origin"] = origin
+        response.headers["Access-Control-Allow-Headers"] = "X-Telegram-Init-Data, If-None-Match"
+        response.headers["Access-Control-Expose-Headers"] = "ETag"
+        return response
+
+    return middleware
+
+
+async def _resolve(value):
+    """Результат обычной функции или корутины"""
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+class WebAppAPI:
+    """HTTP API канбан-доски, встроенное в процесс бота.
+
+    Запросы авторизуются по initData мини-приложения (заголовок
+    X-Telegram-Init-Data). Ответы помечаются ETag по версии данных, а
+    /api/changes?since=N возвращает только проекты и задачи, измененные после
+    версии N. /api/search ищет задачи через search_tasks(user_id, запрос,
+    limit), возвращающую список (проект, задача). get_user и search_tasks
+    могут быть корутинами (так данные берутся у рабочих процессов кластера).
+    Для работы нужен пакет aiohttp.
+    """
+
+    def __init__(self, bot_token, get_user, host="0.0.0.0", port=8080,
+                 cors_origin="*", init_data_max_age=86400, index_path=None, search_tasks=None):
+        self.bot_token = bot_token
+        self.get_user = get_user
+        self.search_tasks = search_tasks
+        self.host = host
+        self.port = port
+        self.cors_origin = cors_origin
+        self.init_data_max_age = init_data_max_age
+        self.index_path = index_path
+        self._runner = None
+
+    async def start(self):
+        """Запустить HTTP-сервер"""
+        try:
+            from aiohttp import web
+        except ImportError:
+            logger.warning("Пакет aiohttp не установлен, API канбан-доски отключено")
+            return
+
+        app = web.Application(middlewares=[cors_middleware(self.cors_origin)])
+        app.router.add_get("/api/projects", self.handle_projects)
+        app.router.add_get("/api/projects/{project_id}", self.handle_project)
+        app.router.add_get("/api/changes", self.handle_changes)
+        if self.search_tasks is not None:
+            app.router.add_get("/api/search", self.handle_search)
+        if self.index_path and os.path.exists(self.index_path):
+            app.router.add_get("/", self.handle_index)
+
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"API канбан-доски запущено на {self.host}:{self.port}")
+
+    async def stop(self):
+        """Остановить HTTP-сервер"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def handle_index(self, request):
+        from aiohttp import web
+        return web.FileResponse(self.index_path)
+
+    async def handle_projects(self, request):
+        """Все проекты пользователя вместе с задачами"""
+        user = await self._authorize(request)
+        version = user["version"] if user else 0
+
+        not_modified = self._not_modified(request, version)
+        if not_modified:
+            return not_modified
+
+        projects = user["projects"].values() if user else []
+        return self._json(request, {
+            "version": version,
+            "projects": [serialize_project(project) for project in projects],
+        }, version)
+
+    async def handle_project(self, request):
+        """Один проект с задачами"""
+        from aiohttp import web
+
+        user = await self._authorize(request)
+        try:
+            project_id = int(request.match_info["project_id"])
+        except ValueError:
+            raise web.HTTPBadRequest(text="project_id должен быть числом")
+
+        project = user["projects"].get(project_id) if user else None
+        if not project:
+            raise web.HTTPNotFound(text="Проект не найден")
+
+        not_modified = self._not_modified(request, project.version)
+        if not_modified:
+            return not_modified
+
+        return self._json(request, serialize_project(project), project.version)
+
+    async def handle_changes(self, request):
+        """Проекты и задачи, измененные после версии since"""
+        from aiohttp import web
+
+        user = await self._authorize(request)
+        try:
+            since = int(request.query.get("since", "0"))
+        except ValueError:
+            raise web.HTTPBadRequest(text="since должен быть числом")
+
+        version = user["version"] if user else 0
+        projects = []
+        tasks = []
+        if user and version > since:
+            # Версия проекта меняется при любом изменении его задач, поэтому
+            # задачи неизмененных проектов не перебираем
+            for project in user["projects"].values():
+                if project.version <= since:
+                    continue
+                projects.append(serialize_project(project, with_tasks=False))
+                for task in project.tasks.values():
+                    if task.version > since:
+                        tasks.append({"projectId": project.id, **serialize_task(task)})
+
+        return self._json(request, {"version": version, "projects": projects, "tasks": tasks}, version)
+
+    async def handle_search(self, request):
+        """Поиск задач: q, а также необязательные status, before и after (ДД.ММ.ГГГГ)"""
+        from aiohttp import web
+        from search import SearchQuery
+
+        user = await self._authorize(request)
+        params = request.query
+        query, error = SearchQuery.parse(
+            params.get("q", ""),
+            status=params.get("status"),
+            before=params.get("before"),
+            after=params.get("after"),
+        )
+        if error:
+            raise web.HTTPBadRequest(text=error)
+        try:
+            limit = min(int(params.get("limit", "50")), 200)
+        except ValueError:
+            raise web.HTTPBadRequest(text="limit должен быть числом")
+
+        version = user["version"] if user else 0
+        results = await _resolve(self.search_tasks(request["user_id"], query, limit)) if user else []
+        return self._json(request, {
+            "version": version,
+            "tasks": [{"projectId": project.id, **serialize_task(task)} for project, task in results],
+        }, version)
+
+    async def _authorize(self, request):
+        from aiohttp import web
+
+        init_data = request.headers.get("X-Telegram-Init-Data", "")
+        telegram_user = validate_init_data(init_data, self.bot_token, self.init_data_max_age)
+        if not telegram_user:
+            raise web.HTTPUnauthorized(text="Неверные данные авторизации")
+        request["user_id"] = telegram_user["id"]
+        return await _resolve(self.get_user(telegram_user["id"]))
+
+    @staticmethod
+    def _etag(version):
+        return f'W/"{version}"'
+
+    def _not_modified(self, request, version):
+        from aiohttp import web
+
+        if request.headers.get("If-None-Match") == self._etag(version):
+            return web.Response(status=304, headers={"ETag": self._etag(version)})
+        return None
+
+    def _json(self, request, data, version):
+        from aiohttp import web
+
+        return web.json_response(
+            data,
+            headers={"ETag": self._etag(version), "Cache-Control": "no-cache"},
+            dumps=lambda value: json.dumps(value, ensure_ascii=False),
+        )